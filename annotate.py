@@ -0,0 +1,262 @@
+# annotate.py
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+# Annotation engine drawing the boxes the vision model reports.
+#
+# Boxes are validated and clamped to their image all at once with NumPy:
+# corners are put in order, and boxes that are not four finite numbers or
+# have nothing left inside the image once clamped are dropped, so a
+# malformed reply can neither fail the annotation nor draw off the image.
+# Images are annotated as decoded arrays. Batches are spread over a thread
+# pool, whose threads run in parallel because OpenCV releases the GIL while
+# decoding, drawing and encoding, and every output is encoded in memory and
+# written with a single write.
+
+DEFAULT_COLOR = (0, 0, 255)  # Red, in BGR.
+DEFAULT_THICKNESS = 2
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.5
+TEXT_COLOR = (255, 255, 255)
+
+# Files of a complaint folder that annotate_backlog() reads and writes.
+IMAGE_FILE = "generated_image.png"
+DESCRIPTION_FILE = "image_description.json"
+ANNOTATED_FILE = "annotated_image.png"
+
+
+def _box_values(box):
+    # One box, as [x1, y1, x2, y2] or [[x1, y1], [x2, y2]], flattened to
+    # four numbers, or None when it is something else.
+    try:
+        values = np.asarray(box, dtype=np.float64).reshape(-1)
+    except (TypeError, ValueError):
+        return None
+    return values if values.size == 4 else None
+
+
+def normalize_boxes(boxes, shape):
+    """
+    Validates boxes and clamps them to an image.
+
+    Parameters:
+        boxes: Boxes as [x1, y1, x2, y2] or [[x1, y1], [x2, y2]], in a list
+               or an array of shape (n, 4) or (n, 2, 2).
+        shape (tuple): Shape of the image, height first.
+
+    Returns:
+    tuple: The valid boxes as an (n, 4) int32 array of [x1, y1, x2, y2]
+           with x1 < x2 and y1 < y2, all inside the image, and the indices
+           of the input boxes they come from.
+    """
+    height, width = shape[:2]
+    count = len(boxes)
+    try:
+        values = np.asarray(boxes, dtype=np.float64).reshape(count, 4)
+        kept = np.arange(count)
+    except (TypeError, ValueError):
+        # Ragged or non-numeric input: keep the boxes that are four numbers.
+        rows = [(index, _box_values(box)) for index, box in enumerate(boxes)]
+        rows = [(index, values) for index, values in rows if values is not None]
+        kept = np.array([index for index, _ in rows], dtype=np.intp)
+        values = np.array([values for _, values in rows], dtype=np.float64).reshape(-1, 4)
+
+    finite = np.isfinite(values).all(axis=1)
+    values, kept = values[finite], kept[finite]
+    xs = np.clip(np.rint(np.sort(values[:, 0::2], axis=1)), 0, width - 1)
+    ys = np.clip(np.rint(np.sort(values[:, 1::2], axis=1)), 0, height - 1)
+    # A box outside the image collapses onto its edge and is dropped.
+    inside = (xs[:, 1] > xs[:, 0]) & (ys[:, 1] > ys[:, 0])
+    normalized = np.stack([xs[:, 0], ys[:, 0], xs[:, 1], ys[:, 1]], axis=1)
+    return normalized[inside].astype(np.int32), kept[inside]
+
+
+def _draw_label(image, text, x1, y1, color):
+    # The label sits on a filled band above the box, or inside its top edge
+    # when the box touches the top of the image, and never past the right.
+    (text_width, text_height), baseline = cv2.getTextSize(text, FONT, FONT_SCALE, 1)
+    band = text_height + baseline + 4
+    top = y1 - band if y1 >= band else y1
+    left = max(0, min(x1, image.shape[1] - text_width - 4))
+    cv2.rectangle(image, (left, top), (left + text_width + 4, top + band), color, cv2.FILLED)
+    cv2.putText(image, text, (left + 2, top + text_height + 2), FONT, FONT_SCALE,
+                TEXT_COLOR, 1, cv2.LINE_AA)
+
+
+def draw_boxes(image, boxes, labels=None, color=DEFAULT_COLOR,
+               thickness=DEFAULT_THICKNESS, copy=True):
+    """
+    Draws boxes, and their labels, on a decoded image.
+
+    Parameters:
+        image (numpy.ndarray): The decoded BGR image.
+        boxes: The boxes, see normalize_boxes(). Invalid ones are skipped.
+        labels (list): Optional text drawn with each box, None or "" for none.
+        copy (bool): Draw on a copy, leaving image untouched.
+
+    Returns:
+    numpy.ndarray: The annotated image.
+    """
+    if copy:
+        image = image.copy()
+    normalized, kept = normalize_boxes(boxes, image.shape)
+    for (x1, y1, x2, y2), index in zip(normalized.tolist(), kept.tolist()):
+        cv2.rectangle(image, (x1, y1), (x2, y2), color, thickness)
+        if labels is not None and index < len(labels) and labels[index]:
+            _draw_label(image, str(labels[index]), x1, y1, color)
+    return image
+
+
+def encode_image(image, extension=".png"):
+    """
+    Encodes a decoded image in the format of a file extension.
+
+    Returns:
+    numpy.ndarray: The encoded bytes.
+    """
+    ok, encoded = cv2.imencode(extension, image)
+    if not ok:
+        raise RuntimeError(f"Could not encode the image as {extension}.")
+    return encoded
+
+
+def write_image(output_path, image):
+    """
+    Encodes a decoded image in the format of its path's extension and writes
+    it with one write.
+
+    Returns:
+    str: output_path.
+    """
+    encoded = encode_image(image, os.path.splitext(output_path)[1] or ".png")
+    with open(output_path, "wb") as file:
+        file.write(memoryview(encoded))
+    return output_path
+
+
+def load_image(image):
+    """
+    Returns a decoded image from an array, encoded bytes or a file path, or
+    None when it cannot be decoded.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, str):
+        with open(image, "rb") as file:
+            image = file.read()
+    return cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class AnnotationTask:
+    """
+    One image of a batch to annotate.
+
+    Parameters:
+        image: The decoded image, its encoded bytes or its path.
+        boxes: The boxes, see normalize_boxes().
+        labels (list): Optional text drawn with each box.
+        output_path (str): File receiving the annotated image, or None to
+                           return it instead.
+    """
+
+    __slots__ = ("image", "boxes", "labels", "output_path")
+
+    def __init__(self, image, boxes, labels=None, output_path=None):
+        self.image = image
+        self.boxes = boxes
+        self.labels = labels
+        self.output_path = output_path
+
+
+def annotate(task, color=DEFAULT_COLOR, thickness=DEFAULT_THICKNESS):
+    """
+    Runs one AnnotationTask.
+
+    Returns:
+    The annotated image, or its output path when it was written.
+    """
+    image = load_image(task.image)
+    if image is None:
+        raise ValueError("The image could not be decoded.")
+    # Images decoded here belong to the task, so they are drawn on in place.
+    annotated = draw_boxes(image, task.boxes, task.labels, color, thickness,
+                           copy=image is task.image)
+    if task.output_path is None:
+        return annotated
+    return write_image(task.output_path, annotated)
+
+
+def annotate_batch(tasks, max_workers=8, color=DEFAULT_COLOR, thickness=DEFAULT_THICKNESS):
+    """
+    Annotates many images over a thread pool.
+
+    Returns:
+    list: For every task in order, what annotate() returned, or the
+          exception that stopped it.
+    """
+    def run(task):
+        try:
+            return annotate(task, color, thickness)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="annotate") as pool:
+        return list(pool.map(run, tasks))
+
+
+def backlog_tasks(root):
+    """
+    Lists the complaint folders under root holding a generated image and the
+    saved description with its bounding box.
+
+    Returns:
+    list: An AnnotationTask per folder, writing its annotated image.
+    """
+    tasks = []
+    for name in sorted(os.listdir(root)):
+        folder = os.path.join(root, name)
+        description_path = os.path.join(folder, DESCRIPTION_FILE)
+        image_path = os.path.join(folder, IMAGE_FILE)
+        if not (os.path.isfile(description_path) and os.path.isfile(image_path)):
+            continue
+        with open(description_path, "r") as file:
+            box = json.load(file).get("bounding_box")
+        if box is not None:
+            tasks.append(AnnotationTask(image_path, [box],
+                                        output_path=os.path.join(folder, ANNOTATED_FILE)))
+    return tasks
+
+
+def annotate_backlog(root, max_workers=8):
+    """
+    Annotates again the images of every complaint folder under root, such
+    as the output of main.run_batch().
+
+    Returns:
+    dict: Output path to None when written, or to the exception that
+          stopped it.
+    """
+    tasks = backlog_tasks(root)
+    results = annotate_batch(tasks, max_workers=max_workers)
+    return {task.output_path: result if isinstance(result, Exception) else None
+            for task, result in zip(tasks, results)}
+
+
+# Example Usage (for testing purposes, remove/comment when deploying):
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Annotate again the images of a folder of complaints.")
+    parser.add_argument("root", nargs="?", default="output/batch")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    results = annotate_backlog(args.root, max_workers=args.workers)
+    failed = {path: error for path, error in results.items() if error is not None}
+    for path, error in failed.items():
+        print(f"Failed to annotate {path}: {error}")
+    print(f"Annotated {len(results) - len(failed)} image(s) under {args.root}.")
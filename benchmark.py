@@ -0,0 +1,412 @@
+# benchmark.py
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from mock_azure import MockAzureServer, make_png, mock_environment
+
+# Benchmarks of the pipeline against the local mock Azure OpenAI server.
+#
+# Every scenario runs in a fresh process, inside a scratch copy of the
+# inputs, so its peak RSS is its own and nothing is written to output/.
+# The stage cache is turned off, so every call reaches the mock server.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_AUDIO = os.path.join("audio", "sample_complaint_audio.mp3")
+
+STAGE_SCENARIOS = ("transcribe", "generate_image", "describe", "classify")
+SCENARIOS = STAGE_SCENARIOS + ("pipeline", "main")
+
+# Modules whose cold import --startup measures: what a short-lived batch job,
+# worker or serverless invocation loads before its first call.
+STARTUP_MODULES = ("main", "workqueue", "whisper", "gpt", "dalle", "vision", "service")
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile of a list of numbers, or None when
+    it is empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(name, latencies, wall_seconds, errors=0):
+    """
+    Returns the report row of a set of timed calls.
+    """
+    return {
+        "name": name,
+        "calls": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / wall_seconds if wall_seconds else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the current process, in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def prepare_workspace(root, requests):
+    """
+    Creates the inputs the scenarios read: the categories, the sample audio,
+    a batch folder of audio copies and a generated image to describe.
+    """
+    os.makedirs(os.path.join(root, "audio"), exist_ok=True)
+    os.makedirs(os.path.join(root, "output"), exist_ok=True)
+    os.makedirs(os.path.join(root, "batch"), exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, "categories.json"), root)
+    shutil.copy(os.path.join(REPO_DIR, SAMPLE_AUDIO), os.path.join(root, SAMPLE_AUDIO))
+    for index in range(requests):
+        os.symlink(os.path.join(root, SAMPLE_AUDIO),
+                   os.path.join(root, "batch", f"complaint_{index:05d}.mp3"))
+    with open(os.path.join(root, "image.png"), "wb") as file:
+        file.write(make_png())
+
+
+def _stage_call(scenario, index, categories, use_async):
+    # Returns a function (or coroutine function) running one call of a stage.
+    import main
+    from whisper import transcribe_audio, transcribe_audio_async
+    from dalle import generate_image, generate_image_async
+    from vision import describe_image, describe_image_async
+    from gpt import classify_with_gpt, classify_with_gpt_async
+
+    complaint = "My rubber duck arrived with a hole in it and does not float."
+    if scenario == "transcribe":
+        fn = transcribe_audio_async if use_async else transcribe_audio
+        return lambda: fn(SAMPLE_AUDIO, *main.whisper_settings())
+    if scenario == "generate_image":
+        fn = generate_image_async if use_async else generate_image
+        return lambda: fn(complaint, os.path.join("output", f"generated_{index}.png"),
+                          **main.gpt_settings(), **main.dalle_settings())
+    if scenario == "describe":
+        fn = describe_image_async if use_async else describe_image
+        return lambda: fn("image.png", complaint,
+                          os.path.join("output", f"annotated_{index}.png"),
+                          **main.gpt_settings())
+    fn = classify_with_gpt_async if use_async else classify_with_gpt
+    return lambda: fn(complaint, categories, **main.gpt_settings())
+
+
+def _run_stage(scenario, concurrency, requests, use_async):
+    import main
+    categories = main.read_categories()
+    calls = [_stage_call(scenario, index, categories, use_async)
+             for index in range(requests)]
+    latencies = []
+    errors = []
+
+    def timed(call):
+        start = time.perf_counter()
+        try:
+            call()
+        except Exception as e:
+            errors.append(e)
+            return
+        latencies.append(time.perf_counter() - start)
+
+    async def timed_async(call, limit):
+        async with limit:
+            start = time.perf_counter()
+            try:
+                await call()
+            except Exception as e:
+                errors.append(e)
+                return
+            latencies.append(time.perf_counter() - start)
+
+    async def run_async():
+        from clients import close_async_clients
+        limit = asyncio.Semaphore(concurrency)
+        try:
+            await asyncio.gather(*(timed_async(call, limit) for call in calls))
+        finally:
+            await close_async_clients()
+
+    start = time.perf_counter()
+    if use_async:
+        asyncio.run(run_async())
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, calls))
+    wall = time.perf_counter() - start
+    if errors:
+        print(f"{scenario}: {len(errors)} call(s) failed, first error: {errors[0]}")
+    return [summarize(scenario, latencies, wall, len(errors))]
+
+
+def _timed_stages(stages, timings):
+    # Wraps the stages of main.py to record how long every call takes.
+    def wrap(name, stage):
+        if asyncio.iscoroutinefunction(stage):
+            async def timed(job):
+                start = time.perf_counter()
+                job = await stage(job)
+                timings.setdefault(name, []).append(time.perf_counter() - start)
+                return job
+        else:
+            def timed(job):
+                start = time.perf_counter()
+                job = stage(job)
+                timings.setdefault(name, []).append(time.perf_counter() - start)
+                return job
+        return timed
+
+    stages[:] = [(name, wrap(name, stage)) for name, stage in stages]
+
+
+def _run_pipeline(concurrency, requests, use_async, mode):
+    import main
+    timings = {}
+    _timed_stages(main.pipeline_stages(mode, use_async), timings)
+
+    start = time.perf_counter()
+    if use_async:
+        results = asyncio.run(main.run_batch_async(
+            "batch", output_root=os.path.join("output", "batch"),
+            max_concurrency=concurrency, mode=mode))
+    else:
+        results = main.run_batch("batch", output_root=os.path.join("output", "batch"),
+                                 max_workers=concurrency, mode=mode)
+    wall = time.perf_counter() - start
+
+    errors = sum(1 for result in results.values() if isinstance(result, Exception))
+    complete = len(results) - errors
+    rows = [dict(summarize("pipeline", [], wall, errors), calls=complete,
+                 throughput=complete / wall if wall else 0.0)]
+    for name, latencies in timings.items():
+        rows.append(summarize(f"pipeline/{name}", latencies, wall))
+    return rows
+
+
+def _run_main(runs):
+    import main
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(runs):
+        run_start = time.perf_counter()
+        main.main()
+        latencies.append(time.perf_counter() - run_start)
+    return [summarize("main", latencies, time.perf_counter() - start)]
+
+
+def run_scenario(scenario, concurrency, requests, env, workspace, use_async=False,
+                 mode="full"):
+    """
+    Runs one scenario in the current process. Meant to be the target of a
+    fresh process, see benchmark().
+
+    Returns:
+    list: Report rows, see summarize(), with the concurrency and peak RSS.
+    """
+    os.environ.update(env)
+    os.chdir(workspace)
+    sys.path.insert(0, REPO_DIR)
+
+    if scenario in STAGE_SCENARIOS:
+        rows = _run_stage(scenario, concurrency, requests, use_async)
+    elif scenario == "pipeline":
+        rows = _run_pipeline(concurrency, requests, use_async, mode)
+    elif scenario == "main":
+        rows = _run_main(requests)
+    else:
+        raise ValueError(f"Unknown scenario '{scenario}', expected one of {SCENARIOS}.")
+
+    rss = peak_rss_mb()
+    return [dict(row, concurrency=concurrency, peak_rss_mb=rss) for row in rows]
+
+
+def benchmark(scenarios=SCENARIOS, concurrency_levels=(1, 8, 32), requests=32,
+              latencies=None, error_rate=0.0, use_async=False, mode="full",
+              main_runs=3):
+    """
+    Runs every scenario at every concurrency level against a mock server.
+
+    Parameters:
+        scenarios (list): Names from SCENARIOS. The stage scenarios call one
+                          stage function, "pipeline" runs main.run_batch() and
+                          "main" runs main.main() main_runs times in a row.
+        concurrency_levels (list): Calls in flight at once. "main" runs
+                                   sequentially, so it runs only once.
+        requests (int): Calls, or complaints, per scenario and level.
+        latencies (dict): Mock latency specs, see MockAzureServer.
+        error_rate (float): Fraction of mock calls answered with a 429.
+        use_async (bool): Benchmark the async stages and run_batch_async().
+        mode (str): Pipeline mode of the "pipeline" scenario.
+
+    Returns:
+    list: Report rows, see summarize().
+    """
+    with open(os.path.join(REPO_DIR, "categories.json"), "r") as file:
+        categories = json.load(file)
+
+    rows = []
+    context = multiprocessing.get_context("spawn")
+    with MockAzureServer(latencies, error_rate, categories) as server:
+        env = dict(mock_environment(server.url), PIPELINE_CACHE_DIR="")
+        with tempfile.TemporaryDirectory(prefix="benchmark-") as root:
+            for scenario in scenarios:
+                levels = [1] if scenario == "main" else concurrency_levels
+                for concurrency in levels:
+                    workspace = os.path.join(root, f"{scenario}-{concurrency}")
+                    prepare_workspace(workspace, requests)
+                    count = main_runs if scenario == "main" else requests
+                    with context.Pool(1) as pool:
+                        scenario_rows = pool.apply(run_scenario, (
+                            scenario, concurrency, count, env, workspace,
+                            use_async, mode))
+                    print_rows(scenario_rows)
+                    rows.extend(scenario_rows)
+    return rows
+
+
+def parse_importtime(report):
+    """
+    Parses the report `python -X importtime` writes to stderr.
+
+    Returns:
+    dict: Every top-level import to its cumulative time in seconds and the
+          (name, seconds) pairs of the modules it imported first, slowest
+          first.
+    """
+    imports = {}
+    children = []
+    for line in report.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # The header line.
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        seconds = int(fields[1]) / 1e6
+        if depth == 1:
+            children.append((name.strip(), seconds))
+        elif depth == 0:
+            imports[name.strip()] = (seconds, sorted(children, key=lambda c: -c[1]))
+            children = []
+    return imports
+
+
+def startup_benchmark(modules=STARTUP_MODULES, runs=5):
+    """
+    Imports every module in fresh interpreters and times it, the way a
+    short-lived job pays for it on every start.
+
+    Returns:
+    list: One row per module with the p50 and worst wall time of the whole
+          interpreter run, the p50 import time of the module alone, and its
+          slowest direct imports. Modules whose dependencies are missing get
+          the error instead.
+    """
+    rows = []
+    for module in modules:
+        walls, imports, error = [], [], None
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                    cwd=REPO_DIR, capture_output=True, text=True)
+            walls.append(time.perf_counter() - start)
+            if result.returncode != 0:
+                error = result.stderr.strip().splitlines()[-1]
+                break
+            imports.append(parse_importtime(result.stderr)[module])
+        row = {"name": module, "runs": len(walls), "error": error,
+               "p50": percentile(walls, 0.50), "max": max(walls)}
+        if error is None:
+            row["import_p50"] = percentile([seconds for seconds, _ in imports], 0.50)
+            row["slowest"] = imports[-1][1][:3]
+        rows.append(row)
+    return rows
+
+
+def print_startup_rows(rows):
+    print(f"{'module':<14}{'runs':>6}{'p50 s':>9}{'max s':>9}{'import s':>10}  slowest imports")
+    for row in rows:
+        if row["error"] is not None:
+            print(f"{row['name']:<14}{row['runs']:>6}{'-':>9}{'-':>9}{'-':>10}  {row['error']}")
+            continue
+        slowest = ", ".join(f"{name} {seconds:.3f}" for name, seconds in row["slowest"])
+        print(f"{row['name']:<14}{row['runs']:>6}{_seconds(row['p50']):>9}"
+              f"{_seconds(row['max']):>9}{_seconds(row['import_p50']):>10}  {slowest}")
+
+
+def _seconds(value):
+    return "-" if value is None else f"{value:.3f}"
+
+
+def print_rows(rows, header=False):
+    if header:
+        print(f"{'scenario':<26}{'conc':>6}{'calls':>7}{'errors':>7}{'per s':>9}"
+              f"{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'RSS MiB':>9}")
+    for row in rows:
+        print(f"{row['name']:<26}{row['concurrency']:>6}{row['calls']:>7}"
+              f"{row['errors']:>7}{row['throughput']:>9.2f}{_seconds(row['p50']):>9}"
+              f"{_seconds(row['p95']):>9}{_seconds(row['p99']):>9}"
+              f"{row['peak_rss_mb']:>9.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline against a mock Azure OpenAI server.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run, may be repeated (default: all)")
+    parser.add_argument("--concurrency", default="1,8,32",
+                        help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32,
+                        help="calls, or complaints, per scenario and level")
+    parser.add_argument("--main-runs", type=int, default=3,
+                        help="number of times the main scenario runs main.main()")
+    parser.add_argument("--latency", action="append", default=[], metavar="ENDPOINT=SPEC",
+                        help="mock latency of an endpoint (chat, audio, images, "
+                             "download), e.g. chat=lognormal:0.8:0.4")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of mock calls answered with a 429")
+    parser.add_argument("--use-async", action="store_true",
+                        help="benchmark the async stages")
+    parser.add_argument("--mode", choices=("full", "fast", "combined"), default="full",
+                        help="pipeline mode of the pipeline scenario")
+    parser.add_argument("--startup", action="store_true",
+                        help="time the cold import of the modules instead, "
+                             "without a mock server")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="fresh interpreters started per module with --startup")
+    parser.add_argument("--json", metavar="PATH", help="also write the rows as JSON")
+    args = parser.parse_args()
+
+    if args.startup:
+        rows = startup_benchmark(runs=args.startup_runs)
+        print_startup_rows(rows)
+    else:
+        print_rows([], header=True)
+        rows = benchmark(args.scenario or SCENARIOS,
+                         [int(level) for level in args.concurrency.split(",")],
+                         requests=args.requests,
+                         latencies=dict(spec.split("=", 1) for spec in args.latency),
+                         error_rate=args.error_rate, use_async=args.use_async,
+                         mode=args.mode, main_runs=args.main_runs)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(rows, file, indent=2)
@@ -0,0 +1,182 @@
+# cache.py
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Content-addressed, on-disk cache for the results of the pipeline stages.
+#
+# Every entry is keyed by a hash of everything that determines the stage's
+# result: its inputs, the prompt sent to the model and the deployment name.
+# Changing the prompt of one stage therefore changes the keys of that stage
+# and, through its new output, of every stage downstream of it, while the
+# stages upstream keep hitting the cache.
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # 1 GiB
+# Share of max_bytes eviction brings the cache down to, so the cache is only
+# walked once every so many puts instead of on every put past the cap.
+LOW_WATER_RATIO = 0.9
+
+
+def hash_bytes(data):
+    """
+    Returns the SHA-256 hex digest of bytes or a string.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Returns the SHA-256 hex digest of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Stores stage results as files named after their key, with a size cap
+    enforced by evicting the least recently used entries.
+
+    Parameters:
+        root (str): Directory holding the cache entries.
+        max_bytes (int): Total size the entries may take before eviction.
+        low_water (float): Share of max_bytes eviction brings the size down to.
+    """
+
+    def __init__(self, root="cache", max_bytes=DEFAULT_MAX_BYTES, low_water=LOW_WATER_RATIO):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_water_bytes = int(max_bytes * low_water)
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, stage, *parts):
+        """
+        Builds the cache key of a stage from the parts its result depends on.
+
+        Parameters:
+            stage (str): Name of the stage, so equal inputs of different stages
+                         never share an entry.
+            parts: Strings, bytes, or JSON-serializable objects.
+
+        Returns:
+        str: The hex digest used as the entry name.
+        """
+        digest = hashlib.sha256(stage.encode("utf-8"))
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            elif not isinstance(part, bytes):
+                part = json.dumps(part, sort_keys=True).encode("utf-8")
+            # Length-prefix every part so ("ab", "c") and ("a", "bc") differ.
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        """
+        Returns the bytes stored under key, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Mark the entry as recently used.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """
+        Stores bytes under key, then evicts old entries if the cache grew past
+        its size cap.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see partial entries.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+
+        with self._lock:
+            # An entry replaced under the same key no longer takes its space.
+            try:
+                self._size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        size = sum(entry[2] for entry in entries)
+        for path, _, entry_size in entries:
+            if size <= self.low_water_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def get_text(self, key):
+        data = self.get(key)
+        return None if data is None else data.decode("utf-8")
+
+    def put_text(self, key, text):
+        self.put(key, text.encode("utf-8"))
+
+
+def open_cache(root=None, max_bytes=None):
+    """
+    Opens the stage cache configured by the PIPELINE_CACHE_DIR and
+    PIPELINE_CACHE_MAX_BYTES environment variables.
+
+    Returns:
+    StageCache: The cache, or None when PIPELINE_CACHE_DIR is set to an
+                empty string to turn caching off.
+    """
+    if root is None:
+        root = os.getenv("PIPELINE_CACHE_DIR", "cache")
+    if not root:
+        return None
+    if max_bytes is None:
+        max_bytes = int(os.getenv("PIPELINE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+    return StageCache(root, max_bytes=max_bytes)
@@ -0,0 +1,234 @@
+# catalog.py
+
+import difflib
+import json
+import re
+import sys
+from functools import lru_cache
+
+# The category taxonomy of categories.json, loaded and validated once.
+#
+# Prompts get a compact rendering of it, one category per line followed by
+# its subcategories, instead of the pretty-printed JSON with its quotes and
+# indentation, unless the compact one makes the static prompt prefix too
+# short for the server's prompt cache (see prompt_prefix.cacheable()).
+# Classifications coming back from the model are checked against it, and a
+# pair with a typo, a different case or "and" for "&" is snapped to the real
+# pair rather than stored as a new category.
+
+NORMALIZE_RE = re.compile(r"[^a-z0-9]+")
+
+# Minimum similarity, between 0 and 1, for a misspelled name to be snapped.
+SNAP_CUTOFF = 0.85
+
+
+def normalize(name):
+    """
+    Returns the lookup key of a category or subcategory name: lower case,
+    "&" read as "and", punctuation and extra spaces dropped.
+    """
+    name = name.lower().replace("&", " and ")
+    return " ".join(NORMALIZE_RE.sub(" ", name).split())
+
+
+class CategoryCatalog:
+    """
+    Validated category taxonomy with normalized-name indexes.
+
+    Parameters:
+        categories (dict): Category to list of subcategories, as in categories.json.
+
+    Raises:
+    ValueError: When the taxonomy is not a mapping of names to lists of
+                names, or two names only differ in case or punctuation.
+    """
+
+    def __init__(self, categories):
+        if not isinstance(categories, dict) or not categories:
+            raise ValueError("The categories must be a non-empty JSON object.")
+
+        # Category to its subcategories, in file order.
+        self.categories = {}
+        self.subcategory_sets = {}
+        self._category_keys = {}
+        # Category to {normalized subcategory: subcategory}.
+        self._subcategory_keys = {}
+        # Normalized subcategory to the pairs it names, across categories.
+        self._pairs_by_subcategory = {}
+        self._prompts = {}
+
+        for category, subcategories in categories.items():
+            if not isinstance(category, str) or not category.strip():
+                raise ValueError(f"Invalid category name {category!r}.")
+            if not isinstance(subcategories, list) or not subcategories:
+                raise ValueError(f"Category '{category}' needs a non-empty list of subcategories.")
+            category = sys.intern(category)
+            key = normalize(category)
+            if key in self._category_keys:
+                raise ValueError(f"Categories '{self._category_keys[key]}' and "
+                                 f"'{category}' have the same name.")
+            self._category_keys[key] = category
+
+            names = []
+            keys = {}
+            for subcategory in subcategories:
+                if not isinstance(subcategory, str) or not subcategory.strip():
+                    raise ValueError(f"Invalid subcategory {subcategory!r} in '{category}'.")
+                subcategory = sys.intern(subcategory)
+                sub_key = normalize(subcategory)
+                if sub_key in keys:
+                    raise ValueError(f"Subcategories '{keys[sub_key]}' and '{subcategory}' "
+                                     f"of '{category}' have the same name.")
+                keys[sub_key] = subcategory
+                names.append(subcategory)
+                self._pairs_by_subcategory.setdefault(sub_key, []).append((category, subcategory))
+
+            self.categories[category] = tuple(names)
+            self.subcategory_sets[category] = frozenset(names)
+            self._subcategory_keys[category] = keys
+
+    @classmethod
+    def from_json(cls, text):
+        """
+        Builds a catalog from the contents of a categories metadata file.
+        """
+        try:
+            categories = json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"The categories are not valid JSON: {e}") from e
+        return cls(categories)
+
+    def pairs(self):
+        """
+        Returns:
+        list: Every (category, subcategory) pair, in file order.
+        """
+        return [(category, subcategory)
+                for category, subcategories in self.categories.items()
+                for subcategory in subcategories]
+
+    def is_valid(self, category, subcategory):
+        return subcategory in self.subcategory_sets.get(category, ())
+
+    def prompt(self, verbose=False):
+        """
+        Returns the taxonomy as prompt text, one "Category: Sub | Sub" line
+        per category, or as pretty-printed JSON when verbose. Each form is
+        rendered once per catalog.
+        """
+        text = self._prompts.get(verbose)
+        if text is None:
+            if verbose:
+                text = json.dumps(self.categories, indent=2)
+            else:
+                text = "\n".join(f"{category}: {' | '.join(subcategories)}"
+                                 for category, subcategories in self.categories.items())
+            self._prompts[verbose] = text
+        return text
+
+    def _match(self, key, keys):
+        # Returns the name of the exact or closest normalized key, or None.
+        if key in keys:
+            return keys[key]
+        close = difflib.get_close_matches(key, keys, n=1, cutoff=SNAP_CUTOFF)
+        return keys[close[0]] if close else None
+
+    def snap(self, category, subcategory):
+        """
+        Returns the real pair a classification names, allowing for typos,
+        case and punctuation differences, and a wrong category when the
+        subcategory only exists in one.
+
+        Returns:
+        tuple: The (category, subcategory) pair, or None when the
+               classification matches no pair closely enough.
+        """
+        if not isinstance(category, str) or not isinstance(subcategory, str):
+            return None
+        if self.is_valid(category, subcategory):
+            return category, subcategory
+
+        sub_key = normalize(subcategory)
+        matched_category = self._match(normalize(category), self._category_keys)
+        if matched_category is not None:
+            matched = self._match(sub_key, self._subcategory_keys[matched_category])
+            if matched is not None:
+                return matched_category, matched
+
+        pairs = self._pairs_by_subcategory.get(sub_key)
+        if pairs is None:
+            close = difflib.get_close_matches(sub_key, self._pairs_by_subcategory,
+                                              n=1, cutoff=SNAP_CUTOFF)
+            pairs = self._pairs_by_subcategory[close[0]] if close else []
+        return pairs[0] if len(pairs) == 1 else None
+
+    def snap_classification(self, classification_obj):
+        """
+        Snaps the category and subcategory of a classification dict in place.
+
+        Returns:
+        bool: Whether the classification now names a real pair.
+        """
+        pair = self.snap(classification_obj.get("category"),
+                         classification_obj.get("subcategory"))
+        if pair is None:
+            return False
+        classification_obj["category"], classification_obj["subcategory"] = pair
+        return True
+
+
+@lru_cache(maxsize=None)
+def load_catalog(categories_meta_path="categories.json"):
+    """
+    Loads and validates the categories metadata file, once per path.
+
+    Returns:
+    CategoryCatalog: The catalog.
+    """
+    with open(categories_meta_path, "r") as file:
+        return CategoryCatalog.from_json(file.read())
+
+
+@lru_cache(maxsize=16)
+def _catalog_from_text(text):
+    return CategoryCatalog.from_json(text)
+
+
+def as_catalog(categories):
+    """
+    Returns the catalog of categories given as a CategoryCatalog or as the
+    text of a categories metadata file, parsing each text only once.
+    """
+    if isinstance(categories, CategoryCatalog):
+        return categories
+    return _catalog_from_text(categories)
+
+
+def snap_classification(msg, categories):
+    """
+    Snaps the pair of a classification JSON string to the catalog.
+
+    Returns:
+    str: The classification, unchanged when it already names a real pair or
+         cannot be parsed or matched.
+    """
+    try:
+        classification_obj = json.loads(msg)
+    except ValueError:
+        return msg
+    if not isinstance(classification_obj, dict):
+        return msg
+    catalog = as_catalog(categories)
+    before = (classification_obj.get("category"), classification_obj.get("subcategory"))
+    if not catalog.snap_classification(classification_obj):
+        return msg
+    if (classification_obj["category"], classification_obj["subcategory"]) == before:
+        return msg
+    return json.dumps(classification_obj)
+
+
+# Example Usage (for testing purposes, remove/comment when deploying):
+if __name__ == "__main__":
+    catalog = load_catalog()
+    print(catalog.prompt())
+    print(catalog.snap("electronics", "Audio and headphone"))
@@ -0,0 +1,125 @@
+# clients.py
+
+import asyncio
+import threading
+import weakref
+from functools import lru_cache
+import httpx
+from openai import AzureOpenAI, AsyncAzureOpenAI
+import tracing
+
+# Connection pool settings shared by every client. Connections are kept
+# alive between requests so complaints in flight reuse open sockets
+# instead of paying a TLS handshake per call.
+MAX_CONNECTIONS = 256
+MAX_KEEPALIVE_CONNECTIONS = 64
+KEEPALIVE_EXPIRY = 30.0
+TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+# Every client reports the requests it sends, retries included, to the
+# current tracing span. The SDK does not retry on its own: retries are
+# scheduled by ratelimit.py, which shares every deployment's quota between
+# the stages.
+
+# Async clients are bound to the event loop they were created in, so they
+# are cached per loop. Entries go away together with their loop.
+_async_clients = weakref.WeakKeyDictionary()
+_async_lock = threading.Lock()
+
+
+def _limits():
+    return httpx.Limits(max_connections=MAX_CONNECTIONS,
+                        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+@lru_cache(maxsize=None)
+def get_client(api_version, api_key, endpoint):
+    """
+    Returns the process-wide AzureOpenAI client for an endpoint.
+
+    Returns:
+    AzureOpenAI: A client created on first use and reused afterwards.
+    """
+    return AzureOpenAI(
+        api_version=api_version,
+        api_key=api_key,
+        azure_endpoint=endpoint,
+        max_retries=0,
+        http_client=httpx.Client(limits=_limits(), timeout=TIMEOUT,
+                                 event_hooks=tracing.event_hooks())
+    )
+
+
+@lru_cache(maxsize=None)
+def get_http_session():
+    """
+    Returns the process-wide HTTP session used for plain downloads.
+    """
+    return httpx.Client(limits=_limits(), timeout=TIMEOUT, follow_redirects=True,
+                        event_hooks=tracing.event_hooks())
+
+
+def _loop_clients():
+    loop = asyncio.get_running_loop()
+    with _async_lock:
+        clients = _async_clients.get(loop)
+        if clients is None:
+            clients = {}
+            _async_clients[loop] = clients
+        return clients
+
+
+def get_async_client(api_version, api_key, endpoint):
+    """
+    Returns the AsyncAzureOpenAI client for an endpoint, shared by every
+    coroutine running in the current event loop.
+
+    Returns:
+    AsyncAzureOpenAI: A client created on first use and reused afterwards.
+    """
+    clients = _loop_clients()
+    key = ("openai", api_version, api_key, endpoint)
+    client = clients.get(key)
+    if client is None:
+        client = AsyncAzureOpenAI(
+            api_version=api_version,
+            api_key=api_key,
+            azure_endpoint=endpoint,
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=_limits(), timeout=TIMEOUT,
+                event_hooks=tracing.event_hooks(use_async=True))
+        )
+        clients[key] = client
+    return client
+
+
+def get_async_http_session():
+    """
+    Returns the async HTTP session used for plain downloads in the current
+    event loop.
+    """
+    clients = _loop_clients()
+    session = clients.get("http")
+    if session is None:
+        session = httpx.AsyncClient(limits=_limits(), timeout=TIMEOUT,
+                                    follow_redirects=True,
+                                    event_hooks=tracing.event_hooks(use_async=True))
+        clients["http"] = session
+    return session
+
+
+async def close_async_clients():
+    """
+    Closes the async clients of the current event loop. Call this before the
+    loop shuts down so pooled connections are released cleanly.
+    """
+    loop = asyncio.get_running_loop()
+    with _async_lock:
+        clients = _async_clients.pop(loop, {})
+    for client in clients.values():
+        if isinstance(client, httpx.AsyncClient):
+            await client.aclose()
+        else:
+            await client.close()
@@ -1,25 +1,20 @@
 # dalle.py
 
-from openai import AzureOpenAI
+import asyncio
+import base64
 import json
-import requests
 import os
-import pdb
-
-# Function to generate an image representing the customer complaint
+from clients import get_http_session, get_async_http_session
+import tracing
+import ratelimit
+import routing
+import prompt_prefix
+from image_profile import ImageProfile
 
 
-def generate_image(complaint, target_image_path,
-                   gpt_api_version=None, gpt_api_key=None,
-                   gpt_endpoint=None,gpt_deployment_name=None,
-                   dalle_api_version=None, dalle_api_key=None,
-                   dalle_endpoint=None, dalle_deployment_name=None):
-    """
-    Generates an image based on a prompt using OpenAI's DALL-E model.
-
-    Returns:
-    str: The path to the generated image.
-    """
+def _check_credentials(gpt_api_version, gpt_api_key, gpt_endpoint,
+                       gpt_deployment_name, dalle_api_version, dalle_api_key,
+                       dalle_endpoint, dalle_deployment_name):
     if not gpt_api_version or not gpt_api_key \
        or not gpt_endpoint or not gpt_deployment_name:
         raise ValueError(
@@ -32,67 +27,281 @@ def generate_image(complaint, target_image_path,
             "Azure OpenAI DALL-E credentials not set. "
             "Make sure DALL-E settings are defined."
         )
-    # Create a prompt to represent the customer complaint.
-    complaint_prompt = """
-Convert the customer complaint at the end of this message to a DALL-E prompt to generate a visual representation of the complaint. Keep in mind the following:
+
+
+# Instructions to write a DALL-E prompt, sent ahead of the complaint so every
+# call starts with the same bytes (see prompt_prefix.py).
+IMAGE_PROMPT_INSTRUCTIONS = """You are a helpful assistant.
+
+Convert the customer complaint of the next message to a DALL-E prompt to generate a visual representation of the complaint. Keep in mind the following:
 
 - I only need the prompt and not the image itself.
 - Create a realistic photo.
-- Focus only on the object and not the emotion or anything abstract from the caller.
-
-Here's the complaint:
-
-"""
-    complaint_prompt = complaint_prompt + complaint
-
-    gptclient = AzureOpenAI(
-        api_version=gpt_api_version,
-        api_key=gpt_api_key,
-        azure_endpoint=gpt_endpoint
-    )
-
-    response = gptclient.chat.completions.create(
-        model=gpt_deployment_name,
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": complaint_prompt}
-                ]
-            }
-        ],
-        max_tokens=1024
-    )
-    image_prompt = response.choices[0].message.content
+- Focus only on the object and not the emotion or anything abstract from the caller."""
+
+
+def build_image_prompt_messages(complaint):
+    """
+    Builds the chat messages asking the model to turn a complaint into a
+    DALL-E prompt: the instructions first, the complaint last.
+
+    Returns:
+    list: The messages to send to the chat completions API.
+    """
+    return [
+        {"role": "system", "content": IMAGE_PROMPT_INSTRUCTIONS},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": f"Here's the complaint:\n\n{complaint}"}
+            ]
+        }
+    ]
+
+
+def _download(image_url):
+    # Raises on error statuses, so ratelimit.call() retries the ones that
+    # are worth it and the last failure reaches the caller.
+    response = get_http_session().get(image_url)
+    response.raise_for_status()
+    return response
+
+
+async def _download_async(image_url):
+    response = await get_async_http_session().get(image_url)
+    response.raise_for_status()
+    return response
+
+
+def _downloaded_image(response, cache=None, cache_key=None):
+    print("Image downloaded successfully.")
+    if cache_key is not None:
+        cache.put(cache_key, response.content)
+    return response.content
+
+
+def _inline_image(b64_json, cache=None, cache_key=None):
+    image_bytes = base64.b64decode(b64_json)
+    print("Image received inline.")
+    if cache_key is not None:
+        cache.put(cache_key, image_bytes)
+    return image_bytes
+
+
+def _image_key_parts(image_prompt, dalle_deployment_name, profile):
+    # The size changes the image, the response format does not. Images of
+    # the deployment's default size keep the keys they always had.
+    parts = [image_prompt, dalle_deployment_name]
+    if profile.size is not None:
+        parts.append(profile.size)
+    return parts
+
+
+def _save_image(image_bytes, target_image_path):
+    # Save the image to a file
+    with open(target_image_path, "wb") as file:
+        file.write(image_bytes)
+    return target_image_path
+
+
+def _cache_lookup(cache, stage, *parts):
+    # Returns the cache key and the cached bytes (None on a miss, or when
+    # caching is off).
+    if cache is None:
+        return None, None
+    cache_key = cache.key(stage, *parts)
+    return cache_key, cache.get(cache_key)
+
+
+def _cached_image(image_bytes):
+    print("Image loaded from cache.")
+    return image_bytes
+
+
+# Function to generate an image representing the customer complaint
+
+
+def generate_image(complaint, target_image_path,
+                   gpt_api_version=None, gpt_api_key=None,
+                   gpt_endpoint=None,gpt_deployment_name=None,
+                   dalle_api_version=None, dalle_api_key=None,
+                   dalle_endpoint=None, dalle_deployment_name=None,
+                   cache=None, profile=None):
+    """
+    Generates an image based on a prompt using OpenAI's DALL-E model.
+
+    Parameters:
+        cache (StageCache): Optional cache. The DALL-E prompt is keyed by the
+                            prompt-writing messages (complaint included) and
+                            the GPT deployment, the image by the DALL-E prompt,
+                            the DALL-E deployment and the image size.
+        profile (ImageProfile): Size of the image, and whether it comes back
+                                inline or as a URL to download.
+
+    Returns:
+    str: The path to the generated image.
+    """
+    image_bytes = generate_image_bytes(
+        complaint, gpt_api_version=gpt_api_version, gpt_api_key=gpt_api_key,
+        gpt_endpoint=gpt_endpoint, gpt_deployment_name=gpt_deployment_name,
+        dalle_api_version=dalle_api_version, dalle_api_key=dalle_api_key,
+        dalle_endpoint=dalle_endpoint, dalle_deployment_name=dalle_deployment_name,
+        cache=cache, profile=profile)
+    return _save_image(image_bytes, target_image_path)
+
+
+def generate_image_bytes(complaint,
+                         gpt_api_version=None, gpt_api_key=None,
+                         gpt_endpoint=None, gpt_deployment_name=None,
+                         dalle_api_version=None, dalle_api_key=None,
+                         dalle_endpoint=None, dalle_deployment_name=None,
+                         cache=None, profile=None):
+    """
+    Generates an image like generate_image(), but returns it in memory so
+    the next stage can use it without reading it back from disk.
+
+    Returns:
+    bytes: The PNG data of the generated image.
+    """
+    _check_credentials(gpt_api_version, gpt_api_key, gpt_endpoint,
+                       gpt_deployment_name, dalle_api_version, dalle_api_key,
+                       dalle_endpoint, dalle_deployment_name)
+
+    # Create a prompt to represent the customer complaint.
+    messages = build_image_prompt_messages(complaint)
+    prompt_key, cached_prompt = _cache_lookup(cache, "image_prompt", messages,
+                                              gpt_deployment_name)
+    if cached_prompt is not None:
+        image_prompt = cached_prompt.decode("utf-8")
+    else:
+        gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                                   gpt_endpoint, gpt_deployment_name)
+
+        with tracing.span("dalle.image_prompt", deployment=gpt_deployment_name) as span:
+            prompt_prefix.check("dalle.image_prompt", messages, gpt_deployment_name, span)
+            response = routing.call(
+                gptpool, "chat.completions.create",
+                messages=messages,
+                max_tokens=1024,
+                tokens=ratelimit.estimate_tokens(messages, 1024)
+            )
+            span.record_usage(response)
+        image_prompt = response.choices[0].message.content
+        if prompt_key is not None:
+            cache.put_text(prompt_key, image_prompt)
+
+    profile = profile or ImageProfile()
+    image_key, cached_image = _cache_lookup(
+        cache, "image", *_image_key_parts(image_prompt, dalle_deployment_name, profile))
+    if cached_image is not None:
+        return _cached_image(cached_image)
 
     # Configure OpenAI to use Azure
-    dalleclient = AzureOpenAI(
-        api_version=dalle_api_version,
-        api_key=dalle_api_key,
-        azure_endpoint=dalle_endpoint
-    )
+    dallepool = routing.get_pool("DALLE", dalle_api_version, dalle_api_key,
+                                 dalle_endpoint, dalle_deployment_name)
 
     # Call the DALL-E model to generate an image based on the prompt.
-    result = dalleclient.images.generate(
-        model=dalle_deployment_name,
-        prompt=image_prompt
-    )
+    with tracing.span("dalle.generate", deployment=dalle_deployment_name):
+        result = routing.call(
+            dallepool, "images.generate",
+            prompt=image_prompt,
+            **profile.generation_args()
+        )
 
     json_response = json.loads(result.model_dump_json())
+    if json_response["data"][0].get("b64_json"):
+        # The image came inline, no download needed.
+        return _inline_image(json_response["data"][0]["b64_json"], cache, image_key)
     image_url = json_response["data"][0]["url"]
 
-    # Download the generated image and save it locally.
-    response = requests.get(image_url)
-    if response.status_code == 200:
-        # Save the image to a file
-        with open(target_image_path, "wb") as file:
-            file.write(response.content)
-        print("Image downloaded successfully.")
-        return target_image_path
+    # Download the generated image.
+    with tracing.span("dalle.download"):
+        response = ratelimit.call(None, None, _download, image_url)
+    return _downloaded_image(response, cache, image_key)
+
+
+async def generate_image_async(complaint, target_image_path,
+                               gpt_api_version=None, gpt_api_key=None,
+                               gpt_endpoint=None, gpt_deployment_name=None,
+                               dalle_api_version=None, dalle_api_key=None,
+                               dalle_endpoint=None, dalle_deployment_name=None,
+                               cache=None, profile=None):
+    """
+    Async version of generate_image() using the shared AsyncAzureOpenAI
+    clients and async HTTP session.
+
+    Returns:
+    str: The path to the generated image.
+    """
+    image_bytes = await generate_image_bytes_async(
+        complaint, gpt_api_version=gpt_api_version, gpt_api_key=gpt_api_key,
+        gpt_endpoint=gpt_endpoint, gpt_deployment_name=gpt_deployment_name,
+        dalle_api_version=dalle_api_version, dalle_api_key=dalle_api_key,
+        dalle_endpoint=dalle_endpoint, dalle_deployment_name=dalle_deployment_name,
+        cache=cache, profile=profile)
+    return await asyncio.to_thread(_save_image, image_bytes, target_image_path)
+
+
+async def generate_image_bytes_async(complaint,
+                                     gpt_api_version=None, gpt_api_key=None,
+                                     gpt_endpoint=None, gpt_deployment_name=None,
+                                     dalle_api_version=None, dalle_api_key=None,
+                                     dalle_endpoint=None, dalle_deployment_name=None,
+                                     cache=None, profile=None):
+    """
+    Async version of generate_image_bytes().
+
+    Returns:
+    bytes: The PNG data of the generated image.
+    """
+    _check_credentials(gpt_api_version, gpt_api_key, gpt_endpoint,
+                       gpt_deployment_name, dalle_api_version, dalle_api_key,
+                       dalle_endpoint, dalle_deployment_name)
+
+    messages = build_image_prompt_messages(complaint)
+    prompt_key, cached_prompt = _cache_lookup(cache, "image_prompt", messages,
+                                              gpt_deployment_name)
+    if cached_prompt is not None:
+        image_prompt = cached_prompt.decode("utf-8")
     else:
-        print(f"Failed to download image. HTTP status code: {response.status_code}")
-    return None    
+        gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                                   gpt_endpoint, gpt_deployment_name)
+        with tracing.span("dalle.image_prompt", deployment=gpt_deployment_name) as span:
+            prompt_prefix.check("dalle.image_prompt", messages, gpt_deployment_name, span)
+            response = await routing.call_async(
+                gptpool, "chat.completions.create",
+                messages=messages,
+                max_tokens=1024,
+                tokens=ratelimit.estimate_tokens(messages, 1024)
+            )
+            span.record_usage(response)
+        image_prompt = response.choices[0].message.content
+        if prompt_key is not None:
+            cache.put_text(prompt_key, image_prompt)
+
+    profile = profile or ImageProfile()
+    image_key, cached_image = await asyncio.to_thread(
+        _cache_lookup, cache, "image",
+        *_image_key_parts(image_prompt, dalle_deployment_name, profile))
+    if cached_image is not None:
+        return _cached_image(cached_image)
+
+    dallepool = routing.get_pool("DALLE", dalle_api_version, dalle_api_key,
+                                 dalle_endpoint, dalle_deployment_name)
+    with tracing.span("dalle.generate", deployment=dalle_deployment_name):
+        result = await routing.call_async(
+            dallepool, "images.generate",
+            prompt=image_prompt,
+            **profile.generation_args()
+        )
+    if result.data[0].b64_json:
+        return await asyncio.to_thread(_inline_image, result.data[0].b64_json,
+                                       cache, image_key)
+    image_url = result.data[0].url
+
+    with tracing.span("dalle.download"):
+        response = await ratelimit.call_async(None, None, _download_async, image_url)
+    return await asyncio.to_thread(_downloaded_image, response, cache, image_key)
 
 # Example Usage (for testing purposes, remove/comment when deploying):
 if __name__ == "__main__":
@@ -1,5 +1,134 @@
 import os
-from moviepy import VideoFileClip
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import media
+
+# Extensions of the video files whose audio is extracted.
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".webm", ".avi")
+
+# Folder of the video directory receiving the audio files by default. Audio
+# written next to the videos would be batched along with them, each video
+# and its audio making the same complaint twice.
+DEFAULT_OUTPUT_SUBDIR = "extracted_audio"
+
+
+def audio_output_path(video_path, output_dir=None, audio_format="m4a"):
+    """
+    Returns the path of the audio file extracted from a video: the video's
+    name with the extension of audio_format, in output_dir or in the
+    DEFAULT_OUTPUT_SUBDIR folder of the video's directory.
+    """
+    name = os.path.splitext(os.path.basename(video_path))[0] + "." + audio_format
+    if not output_dir:
+        output_dir = os.path.join(os.path.dirname(video_path), DEFAULT_OUTPUT_SUBDIR)
+    return os.path.join(output_dir, name)
+
+
+def is_up_to_date(video_path, audio_path):
+    """
+    Tells whether audio_path exists and was written after video_path last
+    changed, so extracting it again would produce the same file.
+    """
+    try:
+        return os.path.getmtime(audio_path) >= os.path.getmtime(video_path)
+    except FileNotFoundError:
+        return False
+
+
+def extract_audio(video_path, audio_path, audio_format="m4a"):
+    """
+    Extracts the audio of one video file.
+
+    The audio is written to a temporary file next to audio_path and moved in
+    place once complete, so an interrupted run never leaves a truncated file
+    that looks up to date.
+
+    Returns:
+    str: "copied" when the audio stream was copied as is, "encoded" when it
+         had to be re-encoded.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(audio_path) or ".",
+                                    suffix="." + audio_format)
+    os.close(fd)
+    try:
+        copied = media.extract_audio_track(video_path, tmp_path, audio_format)
+        os.replace(tmp_path, audio_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return "copied" if copied else "encoded"
+
+
+def extract_audio_in_directory(directory, output_dir=None, audio_format="m4a",
+                               max_workers=None, force=False):
+    """
+    Extracts the audio of every video file in a directory, in parallel.
+
+    Only the audio stream is read: AAC audio is copied into an .m4a file
+    without decoding anything, other codecs are decoded and re-encoded as
+    16 kHz mono. Both are accepted by Whisper as they are. Videos whose audio
+    file is newer than the video are skipped.
+
+    Parameters:
+        directory (str): Path to the directory containing video files.
+        output_dir (str): Directory receiving the audio files. Defaults to
+                          its DEFAULT_OUTPUT_SUBDIR folder.
+        audio_format (str): "m4a" or "mp3", see media.AUDIO_FORMATS.
+        max_workers (int): Number of ffmpeg processes run at once. Defaults
+                           to the number of CPUs.
+        force (bool): Extract again even when the audio file is up to date.
+
+    Returns:
+    dict: Video path to "copied", "encoded", "skipped", or the exception
+          that stopped its extraction.
+    """
+    if not os.path.isdir(directory):
+        print(f"The provided path '{directory}' is not a valid directory.")
+        return {}
+
+    video_files = sorted(
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if f.lower().endswith(VIDEO_EXTENSIONS)
+    )
+    if not video_files:
+        print("No video files found in the directory.")
+        return {}
+    output_dir = output_dir or os.path.join(directory, DEFAULT_OUTPUT_SUBDIR)
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    pending = {}
+    for video_path in video_files:
+        audio_path = audio_output_path(video_path, output_dir, audio_format)
+        if not force and is_up_to_date(video_path, audio_path):
+            results[video_path] = "skipped"
+        else:
+            pending[video_path] = audio_path
+
+    print(f"Found {len(video_files)} video file(s), {len(pending)} to extract.")
+    if not pending:
+        return results
+
+    # Each extraction runs its own ffmpeg process; the pool bounds how many
+    # run at once.
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(extract_audio, video_path, audio_path, audio_format): video_path
+            for video_path, audio_path in pending.items()
+        }
+        for future in as_completed(futures):
+            video_path = futures[future]
+            try:
+                results[video_path] = future.result()
+                print(f"Extracted ({results[video_path]}): {video_path} -> "
+                      f"{pending[video_path]}")
+            except Exception as e:
+                print(f"Failed to extract {video_path}: {e}")
+                results[video_path] = e
+    return results
+
 
 def convert_mp4_to_mp3_in_directory(directory):
     """
@@ -8,33 +137,23 @@ def convert_mp4_to_mp3_in_directory(directory):
     Parameters:
         directory (str): Path to the directory containing MP4 files.
     """
-    if not os.path.isdir(directory):
-        print(f"The provided path '{directory}' is not a valid directory.")
-        return
-
-    # Get a list of all MP4 files in the directory
-    mp4_files = [f for f in os.listdir(directory) if f.endswith('.mp4')]
-
-    if not mp4_files:
-        print("No MP4 files found in the directory.")
-        return
-
-    print(f"Found {len(mp4_files)} MP4 file(s). Converting to MP3...")
-
-    for mp4_file in mp4_files:
-        mp4_path = os.path.join(directory, mp4_file)
-        mp3_file = os.path.splitext(mp4_file)[0] + '.mp3'
-        mp3_path = os.path.join(directory, mp3_file)
-
-        try:
-            # Load the video file and extract audio
-            video = VideoFileClip(mp4_path)
-            video.audio.write_audiofile(mp3_path)
-            print(f"Converted: {mp4_file} -> {mp3_file}")
-        except Exception as e:
-            print(f"Failed to convert {mp4_file}: {e}")
-        finally:
-            video.close()
-
-directory_path = "audio" 
-convert_mp4_to_mp3_in_directory(directory_path)
+    return extract_audio_in_directory(directory, audio_format="mp3")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the audio of call videos.")
+    parser.add_argument("directory", nargs="?", default="audio",
+                        help="directory containing the video files")
+    parser.add_argument("--output", help="directory receiving the audio files, by default "
+                                         f"the {DEFAULT_OUTPUT_SUBDIR} folder of the videos")
+    parser.add_argument("--format", choices=sorted(media.AUDIO_FORMATS), default="m4a",
+                        help="audio format written; m4a copies AAC audio untouched")
+    parser.add_argument("--workers", type=int,
+                        help="number of files extracted at once")
+    parser.add_argument("--force", action="store_true",
+                        help="extract again even when the audio file is up to date")
+    args = parser.parse_args()
+
+    extract_audio_in_directory(args.directory, output_dir=args.output,
+                               audio_format=args.format, max_workers=args.workers,
+                               force=args.force)
@@ -1,66 +1,625 @@
 # gpt.py
 
 import os
-from openai import AzureOpenAI
+import asyncio
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+import tracing
+import ratelimit
+import routing
+from catalog import as_catalog, snap_classification
+import prompt_prefix
+import replies
+from replies import Classification
+
+SYSTEM_PROMPT = "You are a helpful assistant"
+
+# Instructions of the classification prompts. They go in the system message,
+# ahead of the complaint, so every call starts with the same bytes and the
+# server can reuse its cached prefix (see prompt_prefix.py).
+CLASSIFICATION_INSTRUCTIONS = """Respond with a JSON string that is formatted as follows:
+
+{
+    "product": [product],
+    "category": [category],
+    "subcategory": [subcategory]
+}
+Start and end with json, no additional text.
+
+Determine the product, category, and subcategory of the complaint described in the next message.
+
+The list of categories and subcategories are available here, one category per line followed by its subcategories:
+
+"""
+
+BATCH_CLASSIFICATION_INSTRUCTIONS = """Respond with a JSON object holding one classification per complaint, formatted as follows:
+
+{
+    "classifications": [
+        {
+            "id": [complaint id],
+            "product": [product],
+            "category": [category],
+            "subcategory": [subcategory]
+        }
+    ]
+}
+Start and end with json, no additional text.
+
+For every complaint of the next message, determine the product, category, and subcategory. Use the complaint ids exactly as given.
+
+The list of categories and subcategories are available here, one category per line followed by its subcategories:
+
+"""
+
+
+@lru_cache(maxsize=16)
+def _system_prompt(instructions, catalog):
+    # Built once per catalog, so the prefix is byte-identical on every call.
+    return prompt_prefix.cacheable(
+        f"{SYSTEM_PROMPT}\n\n{instructions}{catalog.prompt()}",
+        f"{SYSTEM_PROMPT}\n\n{instructions}{catalog.prompt(verbose=True)}")
+
+
+def build_classification_messages(image_description, categories,
+                                  description_kind="image description"):
+    """
+    Builds the chat messages asking the model to classify a complaint: the
+    instructions and categories first, the complaint last.
+
+    Parameters:
+        categories (CategoryCatalog): The categories, or the text of the
+                                      categories metadata file.
+        description_kind (str): What the text describing the complaint is,
+                                e.g. "customer complaint transcription" when
+                                classifying without an image.
+
+    Returns:
+    list: The messages to send to the chat completions API.
+    """
+    system_prompt = _system_prompt(CLASSIFICATION_INSTRUCTIONS, as_catalog(categories))
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text",
+                 "text": f"{description_kind.capitalize()}: {image_description}"},
+            ]
+        }
+    ]
+
+
+def _valid_cached(cached):
+    # Entries written before replies were validated may not parse.
+    if cached is None:
+        return None
+    try:
+        Classification.parse(cached)
+    except replies.ReplyError:
+        return None
+    return cached
+
 
 # Function to classify the customer complaint based on the image description
 
 def classify_with_gpt(image_description, categories,
                      gpt_api_version=None, gpt_api_key=None,
-                     gpt_endpoint=None,gpt_deployment_name=None):
+                     gpt_endpoint=None,gpt_deployment_name=None,
+                     cache=None, description_kind="image description"):
     """
     Classifies the customer complaint into a category/subcategory based on the image description.
 
+    Parameters:
+        cache (StageCache): Optional cache of classifications, keyed by the
+                            prompt (description and categories included) and
+                            the deployment name.
+        description_kind (str): What image_description holds, see
+                                build_classification_messages().
+
     Returns:
     str: The category and subcategory of the complaint.
     """
     # Create a prompt that includes the image description and other relevant details.
+    messages = build_classification_messages(image_description, categories,
+                                             description_kind)
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key("classify", messages, gpt_deployment_name)
+        cached = _valid_cached(cache.get_text(cache_key))
+        if cached is not None:
+            return cached
 
     # Call the GPT model to classify the complaint based on the prompt.
-    system_prompt = "You are a helpful assistant"
+    gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                               gpt_endpoint, gpt_deployment_name)
 
-    prompt = f"""Respond with a JSON string that is formatted as follows:
+    with tracing.span("gpt.classify", deployment=gpt_deployment_name) as span:
+        prompt_prefix.check("gpt.classify", messages, gpt_deployment_name, span)
+        # A reply without a valid classification is asked for again.
+        classification = replies.call_parsed(
+            lambda: routing.call(
+                gptpool, "chat.completions.create",
+                messages=messages,
+                max_tokens=1024,
+                tokens=ratelimit.estimate_tokens(messages, 1024),
+                **replies.response_format_args("classification", replies.CLASSIFICATION_SCHEMA)
+            ),
+            Classification.parse, span)
 
-{{
-    "product": [product],
-    "category": [category],
-    "subcategory": [subcategory]
-}}
-Start and end with json, no additional text.
+    # Return the classification result, with typos in the category or
+    # subcategory fixed.
+    msg = snap_classification(classification.to_json(), categories)
+    if cache_key is not None:
+        cache.put_text(cache_key, msg)
+    return msg
 
-Determine the product, category, and subcategory from an image description.
 
-The list of categories and subcategories are available here:
+async def classify_with_gpt_async(image_description, categories,
+                                  gpt_api_version=None, gpt_api_key=None,
+                                  gpt_endpoint=None, gpt_deployment_name=None,
+                                  cache=None, description_kind="image description"):
+    """
+    Async version of classify_with_gpt() using the shared AsyncAzureOpenAI client.
 
-{categories}
+    Returns:
+    str: The category and subcategory of the complaint.
+    """
+    messages = build_classification_messages(image_description, categories,
+                                             description_kind)
 
-Image description: {image_description}"""
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key("classify", messages, gpt_deployment_name)
+        cached = _valid_cached(cache.get_text(cache_key))
+        if cached is not None:
+            return cached
+    gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                               gpt_endpoint, gpt_deployment_name)
 
-    gptclient = AzureOpenAI(
-        api_version=gpt_api_version,
-        api_key=gpt_api_key,
-        azure_endpoint=gpt_endpoint
-    )
+    with tracing.span("gpt.classify", deployment=gpt_deployment_name) as span:
+        prompt_prefix.check("gpt.classify", messages, gpt_deployment_name, span)
+        classification = await replies.call_parsed_async(
+            lambda: routing.call_async(
+                gptpool, "chat.completions.create",
+                messages=messages,
+                max_tokens=1024,
+                tokens=ratelimit.estimate_tokens(messages, 1024),
+                **replies.response_format_args("classification", replies.CLASSIFICATION_SCHEMA)
+            ),
+            Classification.parse, span)
 
-    response = gptclient.chat.completions.create(
-        model=gpt_deployment_name,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                ]
-            }
-        ],
-        max_tokens=1024
-    )
+    msg = snap_classification(classification.to_json(), categories)
+    if cache_key is not None:
+        cache.put_text(cache_key, msg)
+    return msg
 
-    # Extract and return the classification result.
-    msg = response.choices[0].message.content.replace("```json", "")
-    msg = msg.replace("```", "")
 
-    return msg
+# Batched classification. The categories make up most of the prompt, so
+# classifying several complaints per request pays for them only once.
+
+# Rough size of a classification in the reply, used to size max_tokens.
+TOKENS_PER_CLASSIFICATION = 60
+# Rough number of characters per token, used to keep batches under a budget.
+CHARS_PER_TOKEN = 4
+
+
+def build_batch_classification_messages(descriptions, categories,
+                                        description_kind="image description"):
+    """
+    Builds the chat messages asking the model to classify several complaints
+    at once.
+
+    Parameters:
+        descriptions (dict): Complaint id to the text to classify.
+
+    Returns:
+    list: The messages to send to the chat completions API.
+    """
+    system_prompt = _system_prompt(BATCH_CLASSIFICATION_INSTRUCTIONS,
+                                   as_catalog(categories))
+
+    prompt = f"""Complaints, as a JSON object mapping complaint ids to each {description_kind}:
+
+{json.dumps(descriptions, indent=1)}"""
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+            ]
+        }
+    ]
+
+
+def parse_batch_classification(msg, expected_ids, catalog=None):
+    """
+    Extracts the well-formed classifications of a batch reply. Items with an
+    unknown id or a missing field are dropped, so their complaints can be
+    submitted again. With a CategoryCatalog, the pairs of the other items are
+    snapped to real ones.
+
+    Returns:
+    dict: Complaint id to its classification dict.
+    """
+    try:
+        items = replies.extract_json(msg, "[{")
+    except replies.ReplyError:
+        return {}
+    # Accept a bare list, or an object keyed by complaint id, as well.
+    if isinstance(items, dict) and isinstance(items.get("classifications"), list):
+        items = items["classifications"]
+    elif isinstance(items, dict):
+        items = [dict(value, id=key) for key, value in items.items()
+                 if isinstance(value, dict)]
+    if not isinstance(items, list):
+        return {}
+
+    expected_ids = set(expected_ids)
+    results = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        complaint_id = str(item.get("id"))
+        if complaint_id not in expected_ids:
+            continue
+        try:
+            results[complaint_id] = Classification.parse(item).to_dict()
+        except replies.ReplyError:
+            continue
+        if catalog is not None:
+            catalog.snap_classification(results[complaint_id])
+    return results
+
+
+def split_batches(descriptions, batch_size=10, max_prompt_tokens=None):
+    """
+    Splits complaints into batches of at most batch_size complaints, and
+    at most max_prompt_tokens (estimated) of complaint text each.
+
+    Returns:
+    list: Lists of complaint ids.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for complaint_id, text in descriptions.items():
+        tokens = len(text) // CHARS_PER_TOKEN + 1
+        too_big = max_prompt_tokens is not None and batch \
+            and batch_tokens + tokens > max_prompt_tokens
+        if len(batch) >= batch_size or too_big:
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(complaint_id)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class BatchStats:
+    """
+    Counts the requests and complaints of batched classification.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.complaints = 0
+        self.resubmitted = 0
+        self.fallbacks = 0
+        self.failed = 0
+
+    def complaints_per_request(self):
+        return self.complaints / self.requests if self.requests else 0.0
+
+    def report(self):
+        return (f"Batched classification: {self.complaints} complaint(s) in "
+                f"{self.requests} request(s), {self.complaints_per_request():.1f} "
+                f"complaints per request, {self.resubmitted} resubmitted, "
+                f"{self.fallbacks} classified alone after their batch failed, "
+                f"{self.failed} failed.")
+
+
+def _batch_max_tokens(batch):
+    return min(4096, TOKENS_PER_CLASSIFICATION * len(batch) + 100)
+
+
+def _batch_request(messages, pending):
+    return dict(messages=messages,
+                max_tokens=_batch_max_tokens(pending),
+                tokens=ratelimit.estimate_tokens(messages, _batch_max_tokens(pending)),
+                **replies.response_format_args("batch_classification",
+                                               replies.BATCH_CLASSIFICATION_SCHEMA))
+
+
+def _fallback_results(pending, outcomes, error, stats):
+    # Classifications of the complaints of a failed batch, classified one by
+    # one. Complaints failing on their own too are left out.
+    print(f"A batch of {len(pending)} complaint(s) failed ({type(error).__name__}: "
+          f"{error}), classifying them one by one.")
+    results = {}
+    for complaint_id, outcome in zip(pending, outcomes):
+        if not isinstance(outcome, BaseException):
+            results[complaint_id] = json.loads(outcome)
+    with stats.lock:
+        stats.fallbacks += len(pending)
+    return results
+
+
+def classify_batch_with_gpt(descriptions, categories,
+                            gpt_api_version=None, gpt_api_key=None,
+                            gpt_endpoint=None, gpt_deployment_name=None,
+                            batch_size=10, max_prompt_tokens=None, max_attempts=3,
+                            max_workers=4, description_kind="image description",
+                            stats=None):
+    """
+    Classifies several complaints with one chat completion per batch.
+
+    Complaints the model dropped or mangled in its reply are submitted again,
+    on their own batch, up to max_attempts times. The complaints of a batch
+    whose request fails are classified one by one with classify_with_gpt(),
+    so one failed request does not lose the results of the other batches.
+
+    Parameters:
+        descriptions (dict): Complaint id to the text to classify.
+        batch_size (int): Maximum number of complaints per request.
+        max_prompt_tokens (int): Optional budget of complaint text per request,
+                                 estimated at CHARS_PER_TOKEN characters a token.
+        max_attempts (int): Number of times a complaint is submitted.
+        max_workers (int): Number of batch requests in flight at once.
+        stats (BatchStats): Optional counters to update.
+
+    Returns:
+    dict: Complaint id to its classification dict. Complaints still missing
+          after max_attempts, or failing on their own, are left out.
+    """
+    descriptions = {str(key): value for key, value in descriptions.items()}
+    stats = stats or BatchStats()
+    gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                               gpt_endpoint, gpt_deployment_name)
+
+    def classify_alone(complaint_id):
+        try:
+            return classify_with_gpt(
+                descriptions[complaint_id], categories, gpt_api_version=gpt_api_version,
+                gpt_api_key=gpt_api_key, gpt_endpoint=gpt_endpoint,
+                gpt_deployment_name=gpt_deployment_name, description_kind=description_kind)
+        except Exception as e:
+            return e
+
+    def run_batch(batch):
+        results = {}
+        pending = batch
+        for attempt in range(max_attempts):
+            messages = build_batch_classification_messages(
+                {complaint_id: descriptions[complaint_id] for complaint_id in pending},
+                categories, description_kind)
+            with tracing.span("gpt.classify_batch", deployment=gpt_deployment_name,
+                              complaints=list(pending), attempt=attempt) as span:
+                prompt_prefix.check("gpt.classify_batch", messages, gpt_deployment_name, span)
+                try:
+                    response = routing.call(gptpool, "chat.completions.create",
+                                            **_batch_request(messages, pending))
+                except Exception as e:
+                    span.error = f"{type(e).__name__}: {e}"
+                    error = e
+                else:
+                    error = None
+                    span.record_usage(response)
+            if error is not None:
+                results.update(_fallback_results(
+                    pending, [classify_alone(complaint_id) for complaint_id in pending],
+                    error, stats))
+                pending = [complaint_id for complaint_id in pending
+                           if complaint_id not in results]
+                break
+            results.update(parse_batch_classification(
+                response.choices[0].message.content, pending, as_catalog(categories)))
+
+            with stats.lock:
+                stats.requests += 1
+                if attempt > 0:
+                    stats.resubmitted += len(pending)
+            pending = [complaint_id for complaint_id in pending
+                       if complaint_id not in results]
+            if not pending:
+                break
+
+        with stats.lock:
+            stats.complaints += len(results)
+            stats.failed += len(pending)
+        return results
+
+    batches = split_batches(descriptions, batch_size, max_prompt_tokens)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for batch_results in pool.map(tracing.run_in_context(run_batch), batches):
+            results.update(batch_results)
+    return results
+
+
+async def classify_batch_with_gpt_async(descriptions, categories,
+                                        gpt_api_version=None, gpt_api_key=None,
+                                        gpt_endpoint=None, gpt_deployment_name=None,
+                                        batch_size=10, max_prompt_tokens=None,
+                                        max_attempts=3,
+                                        description_kind="image description",
+                                        stats=None):
+    """
+    Async version of classify_batch_with_gpt(). Every batch is sent at once.
+
+    Returns:
+    dict: Complaint id to its classification dict.
+    """
+    descriptions = {str(key): value for key, value in descriptions.items()}
+    stats = stats or BatchStats()
+    gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                               gpt_endpoint, gpt_deployment_name)
+
+    async def run_batch(batch):
+        results = {}
+        pending = batch
+        for attempt in range(max_attempts):
+            messages = build_batch_classification_messages(
+                {complaint_id: descriptions[complaint_id] for complaint_id in pending},
+                categories, description_kind)
+            with tracing.span("gpt.classify_batch", deployment=gpt_deployment_name,
+                              complaints=list(pending), attempt=attempt) as span:
+                prompt_prefix.check("gpt.classify_batch", messages, gpt_deployment_name, span)
+                try:
+                    response = await routing.call_async(gptpool, "chat.completions.create",
+                                                        **_batch_request(messages, pending))
+                except Exception as e:
+                    span.error = f"{type(e).__name__}: {e}"
+                    error = e
+                else:
+                    error = None
+                    span.record_usage(response)
+            if error is not None:
+                outcomes = await asyncio.gather(
+                    *(classify_with_gpt_async(
+                        descriptions[complaint_id], categories,
+                        gpt_api_version=gpt_api_version, gpt_api_key=gpt_api_key,
+                        gpt_endpoint=gpt_endpoint, gpt_deployment_name=gpt_deployment_name,
+                        description_kind=description_kind)
+                      for complaint_id in pending),
+                    return_exceptions=True)
+                results.update(_fallback_results(pending, outcomes, error, stats))
+                pending = [complaint_id for complaint_id in pending
+                           if complaint_id not in results]
+                break
+            results.update(parse_batch_classification(
+                response.choices[0].message.content, pending, as_catalog(categories)))
+
+            with stats.lock:
+                stats.requests += 1
+                if attempt > 0:
+                    stats.resubmitted += len(pending)
+            pending = [complaint_id for complaint_id in pending
+                       if complaint_id not in results]
+            if not pending:
+                break
+
+        with stats.lock:
+            stats.complaints += len(results)
+            stats.failed += len(pending)
+        return results
+
+    batches = split_batches(descriptions, batch_size, max_prompt_tokens)
+    results = {}
+    for batch_results in await asyncio.gather(*(run_batch(b) for b in batches)):
+        results.update(batch_results)
+    return results
+
+
+class ClassificationBatcher:
+    """
+    Groups classify_with_gpt() calls made from many threads into batched
+    requests.
+
+    classify() has the signature of classify_with_gpt(), so the batcher can be
+    used wherever a classify function is expected. A call blocks until its
+    batch is sent, which happens when batch_size calls are waiting or when
+    the oldest one has waited max_wait seconds.
+
+    Parameters:
+        batch_size (int): Number of complaints per request.
+        max_wait (float): Longest time a complaint waits for its batch to fill.
+        max_attempts (int): Number of times a complaint is submitted.
+    """
+
+    def __init__(self, batch_size=10, max_wait=0.5, max_attempts=3):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.stats = BatchStats()
+        self._lock = threading.Lock()
+        # Waiting calls, grouped by everything but their description.
+        self._pending = {}
+        self._counter = 0
+
+    def classify(self, image_description, categories,
+                 gpt_api_version=None, gpt_api_key=None,
+                 gpt_endpoint=None, gpt_deployment_name=None,
+                 cache=None, description_kind="image description"):
+        """
+        Classifies one complaint as part of a batch.
+
+        Returns:
+        str: The classification JSON string, as classify_with_gpt returns it.
+        """
+        settings = (categories, gpt_api_version, gpt_api_key, gpt_endpoint,
+                    gpt_deployment_name, description_kind)
+
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.key("classify_batch", image_description,
+                                  as_catalog(categories).prompt(),
+                                  description_kind, gpt_deployment_name)
+            cached = cache.get_text(cache_key)
+            if cached is not None:
+                return cached
+
+        future = Future()
+        with self._lock:
+            self._counter += 1
+            group = self._pending.setdefault(settings, [])
+            group.append((str(self._counter), image_description, future))
+            if len(group) >= self.batch_size:
+                batch = self._pending.pop(settings)
+            else:
+                batch = None
+                if len(group) == 1:
+                    timer = threading.Timer(self.max_wait, self._flush_stale, (settings, group))
+                    timer.daemon = True
+                    timer.start()
+
+        if batch is not None:
+            self._send(settings, batch)
+
+        msg = future.result()
+        if cache_key is not None:
+            cache.put_text(cache_key, msg)
+        return msg
+
+    def _flush_stale(self, settings, group):
+        with self._lock:
+            # Only flush the group the timer was started for.
+            if self._pending.get(settings) is not group:
+                return
+            batch = self._pending.pop(settings)
+        self._send(settings, batch)
+
+    def _send(self, settings, batch):
+        categories, api_version, api_key, endpoint, deployment_name, kind = settings
+        try:
+            results = classify_batch_with_gpt(
+                {complaint_id: text for complaint_id, text, _ in batch}, categories,
+                gpt_api_version=api_version, gpt_api_key=api_key,
+                gpt_endpoint=endpoint, gpt_deployment_name=deployment_name,
+                batch_size=len(batch), max_attempts=self.max_attempts,
+                max_workers=1, description_kind=kind, stats=self.stats)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for complaint_id, _, future in batch:
+            if complaint_id in results:
+                future.set_result(json.dumps(results[complaint_id]))
+            else:
+                future.set_exception(RuntimeError(
+                    f"The model did not classify the complaint after "
+                    f"{self.max_attempts} attempt(s)."))
+
 
 # Example Usage (for testing purposes, remove/comment when deploying):
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+# image_profile.py
+
+import os
+from functools import lru_cache
+
+# How images are generated and sent to the vision model.
+#
+# The default profile keeps the original behavior: DALL-E's default size,
+# a URL to download the image from, and the full PNG sent to the vision
+# model. The "fast" profile gets the image inline as base64, and sends the
+# vision model a downscaled JPEG at low detail, which cuts the bytes
+# uploaded and the time the model takes to look at the image.
+
+# Encodings the image can be re-encoded to for the vision call:
+# format -> (OpenCV extension, MIME type).
+VISION_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+    "png": (".png", "image/png"),
+}
+
+DETAILS = ("low", "high", "auto")
+
+
+class ImageProfile:
+    """
+    Settings of image generation and of the image sent to the vision model.
+
+    Parameters:
+        size (str): Size asked from DALL-E, e.g. "1024x1024", or None for the
+                    deployment's default.
+        response_format (str): "url" to download the generated image, or
+                               "b64_json" to get it inline in the reply.
+        vision_max_side (int): Longest side of the image sent to the vision
+                               model. Larger images are downscaled; None
+                               keeps the original size.
+        vision_format (str): Encoding of the image sent to the vision model,
+                             a key of VISION_FORMATS, or None to send the
+                             generated image as it is.
+        vision_quality (int): JPEG or WebP quality, 1-100.
+        detail (str): Vision detail level, one of DETAILS, or None to leave
+                      it to the model.
+    """
+
+    def __init__(self, size=None, response_format="url", vision_max_side=None,
+                 vision_format=None, vision_quality=85, detail=None):
+        if response_format not in ("url", "b64_json"):
+            raise ValueError(f"Unknown response format '{response_format}', "
+                             f"expected 'url' or 'b64_json'.")
+        if vision_format is not None and vision_format not in VISION_FORMATS:
+            raise ValueError(f"Unknown vision format '{vision_format}', "
+                             f"expected one of {sorted(VISION_FORMATS)}.")
+        if detail is not None and detail not in DETAILS:
+            raise ValueError(f"Unknown detail level '{detail}', expected one of {DETAILS}.")
+        self.size = size
+        self.response_format = response_format
+        self.vision_max_side = vision_max_side
+        self.vision_format = vision_format
+        self.vision_quality = vision_quality
+        self.detail = detail
+
+    def reencodes(self):
+        """
+        Tells whether the image is re-encoded before the vision call.
+        """
+        return self.vision_format is not None or self.vision_max_side is not None
+
+    def generation_args(self):
+        """
+        Returns the extra arguments of the image generation call.
+        """
+        args = {}
+        if self.size is not None:
+            args["size"] = self.size
+        if self.response_format != "url":
+            args["response_format"] = self.response_format
+        return args
+
+
+PROFILES = {
+    "default": {},
+    "fast": {"response_format": "b64_json", "vision_max_side": 512,
+             "vision_format": "jpeg", "vision_quality": 80, "detail": "low"},
+}
+
+
+def _int_or_none(value):
+    return int(value) if value else None
+
+
+@lru_cache(maxsize=None)
+def load_profile(name=None):
+    """
+    Returns the image profile named by IMAGE_PROFILE ("default" or "fast"),
+    with its settings overridden by IMAGE_SIZE, IMAGE_RESPONSE_FORMAT,
+    VISION_MAX_SIDE, VISION_FORMAT, VISION_QUALITY and VISION_DETAIL when set.
+    """
+    name = name or os.getenv("IMAGE_PROFILE") or "default"
+    if name not in PROFILES:
+        raise ValueError(f"Unknown image profile '{name}', expected one of {sorted(PROFILES)}.")
+    settings = dict(PROFILES[name])
+    overrides = {
+        "size": os.getenv("IMAGE_SIZE"),
+        "response_format": os.getenv("IMAGE_RESPONSE_FORMAT"),
+        "vision_max_side": _int_or_none(os.getenv("VISION_MAX_SIDE")),
+        "vision_format": os.getenv("VISION_FORMAT"),
+        "vision_quality": _int_or_none(os.getenv("VISION_QUALITY")),
+        "detail": os.getenv("VISION_DETAIL"),
+    }
+    settings.update({key: value for key, value in overrides.items() if value})
+    return ImageProfile(**settings)
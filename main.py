@@ -1,22 +1,694 @@
 # main.py
 
-# Import functions from other modules
-from whisper import transcribe_audio
-from dalle import generate_image
-from vision import describe_image
-from gpt import classify_with_gpt
+# Import functions from other modules. The stage modules (whisper, dalle,
+# vision, gpt, preclassifier and clients) are imported by the functions
+# using them: they load the OpenAI SDK, OpenCV and NumPy, so a command only
+# pays for the stages it runs, and enqueueing or --help start at once.
+from cache import open_cache
+from store import ClassificationStore
+from image_profile import load_profile
+from catalog import load_catalog
+from replies import Classification, Description
+from workqueue import WorkQueue, LeaseLost, STAGE_STATES, STORING
+import tracing
+from tracing import traced_stage
 import os
-from dotenv import load_dotenv, find_dotenv
-import pandas as pd
+import argparse
+import asyncio
+import socket
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import Counter
+from functools import lru_cache
 import json
 
+# Audio formats accepted by the Whisper deployment.
+AUDIO_EXTENSIONS = (".flac", ".m4a", ".mp3", ".mp4", ".mpeg", ".mpga",
+                    ".oga", ".ogg", ".wav", ".webm")
+
+# Pipeline modes. "full" classifies from the description of the generated
+# image. "fast" classifies straight from the transcription, and only renders
+# and describes images for a sampled fraction of complaints. "combined" renders
+# every image like "full", but describes it and classifies the complaint in a
+# single vision call.
+MODES = ("full", "fast", "combined")
+
+# Azure OpenAI settings read from the environment, in the form the stage
+# functions expect them.
+
+
+def whisper_settings():
+    return [os.getenv("WHISPER_API_VERSION"),
+            os.getenv("WHISPER_API_KEY"),
+            os.getenv("WHISPER_ENDPOINT"),
+            os.getenv("WHISPER_DEPLOYMENT_NAME")]
+
+
+def gpt_settings():
+    return {
+        "gpt_api_version": os.getenv("GPT_API_VERSION"),
+        "gpt_api_key": os.getenv("GPT_API_KEY"),
+        "gpt_endpoint": os.getenv("GPT_ENDPOINT"),
+        "gpt_deployment_name": os.getenv("GPT_DEPLOYMENT_NAME"),
+    }
+
+
+def dalle_settings():
+    return {
+        "dalle_api_version": os.getenv("DALLE_API_VERSION"),
+        "dalle_api_key": os.getenv("DALLE_API_KEY"),
+        "dalle_endpoint": os.getenv("DALLE_ENDPOINT"),
+        "dalle_deployment_name": os.getenv("DALLE_DEPLOYMENT_NAME"),
+    }
+
+
+@lru_cache(maxsize=None)
+def stage_cache():
+    """
+    Returns the cache shared by every stage, configured through the
+    PIPELINE_CACHE_DIR and PIPELINE_CACHE_MAX_BYTES environment variables.
+    """
+    return open_cache()
+
+
+@lru_cache(maxsize=None)
+def stage_preclassifier():
+    """
+    Returns the local pre-classifier placed in front of GPT classification.
+
+    It is turned on by setting PRECLASSIFIER_THRESHOLD, the minimum
+    similarity for a complaint to skip GPT. PRECLASSIFIER_MARGIN,
+    PRECLASSIFIER_SHADOW_RATE and PRECLASSIFIER_LEARN_LIMIT tune it further,
+    see preclassifier.PreClassifier.
+    """
+    threshold = os.getenv("PRECLASSIFIER_THRESHOLD")
+    if not threshold:
+        return None
+    from preclassifier import load_preclassifier
+    return load_preclassifier(
+        threshold=float(threshold),
+        margin=float(os.getenv("PRECLASSIFIER_MARGIN", 0.15)),
+        shadow_rate=float(os.getenv("PRECLASSIFIER_SHADOW_RATE", 0.0)),
+        learn_limit=int(os.getenv("PRECLASSIFIER_LEARN_LIMIT", 0)))
+
+
+# Complaints the classify stage of the running threaded pipeline handles at
+# once, set by run_batch(). None elsewhere, as in main(), where a complaint
+# has no other complaint to share a batch with.
+_classify_workers = None
+
+
+@lru_cache(maxsize=None)
+def stage_batcher(max_workers):
+    """
+    Returns the batcher packing classifications of concurrent complaints into
+    one GPT request, turned on by setting CLASSIFY_BATCH_SIZE above 1, for a
+    classify stage running max_workers complaints at once.
+
+    A batch never holds more than max_workers complaints, as no more can be
+    waiting for one. CLASSIFY_BATCH_MAX_WAIT sets how long a complaint waits
+    for its batch to fill.
+    """
+    batch_size = min(int(os.getenv("CLASSIFY_BATCH_SIZE") or 0), max_workers)
+    if batch_size <= 1:
+        return None
+    from gpt import ClassificationBatcher
+    return ClassificationBatcher(
+        batch_size=batch_size,
+        max_wait=float(os.getenv("CLASSIFY_BATCH_MAX_WAIT", 0.5)))
+
+
+def current_batcher():
+    """
+    Returns the batcher of the running threaded pipeline, or None when
+    classifications are not batched.
+    """
+    if _classify_workers is None:
+        return None
+    return stage_batcher(_classify_workers)
+
+
+@lru_cache(maxsize=None)
+def stage_near_duplicates():
+    """
+    Returns the index of processed complaints whose results near-duplicate
+    complaints reuse, turned on by setting NEAR_DUPLICATE_INDEX to its path.
+
+    NEAR_DUPLICATE_MAX_DISTANCE sets how many bits, out of 64, transcription
+    fingerprints may differ by (default 3), and NEAR_DUPLICATE_MIN_TOKENS the
+    fewest words a transcription needs to take part (default 8), see
+    neardup.NearDuplicateIndex.
+    """
+    path = os.getenv("NEAR_DUPLICATE_INDEX")
+    if not path:
+        return None
+    from neardup import DEFAULT_MIN_TOKENS, NearDuplicateIndex
+    return NearDuplicateIndex(
+        path, max_distance=int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", 3)),
+        min_tokens=int(os.getenv("NEAR_DUPLICATE_MIN_TOKENS", DEFAULT_MIN_TOKENS)))
+
+
+def report_preclassifier():
+    if stage_preclassifier() is not None:
+        print(stage_preclassifier().stats.report())
+    if current_batcher() is not None:
+        print(current_batcher().stats.report())
+
+
+def report_routing():
+    # Only pools of several deployments have something to report.
+    if any(os.getenv(f"{prefix}_ENDPOINTS") for prefix in ("WHISPER", "GPT", "DALLE")):
+        import routing
+        for line in routing.report():
+            print(line)
+
+
+def report_trace():
+    tracer = tracing.get_tracer()
+    if tracer is not None and tracer.path:
+        print(f"Trace saved to {tracer.path}, run `python tracing.py` to summarize it.")
+
+
+def save_transcription(job, transcription):
+    transcription_filepath = os.path.join(job["output_dir"], "transcription.txt")
+
+    # Open the file in write mode and save the text
+    with open(transcription_filepath, "w") as file:
+        file.write(transcription)
+
+    print(f"Transcription saved to {transcription_filepath}")
+    job["transcription"] = transcription
+    return job
+
+
+@lru_cache(maxsize=None)
+def image_writer():
+    """
+    Returns the thread pool writing the images of the complaints to disk
+    while the pipeline goes on with the images in memory, or None when
+    PIPELINE_SAVE_IMAGES is set to 0 and images are not written at all.
+    """
+    if os.getenv("PIPELINE_SAVE_IMAGES", "1") == "0":
+        return None
+    return ThreadPoolExecutor(max_workers=int(os.getenv("PIPELINE_IMAGE_WRITERS", 2)),
+                              thread_name_prefix="image_writer")
+
+
+def write_in_background(job, write, *args):
+    """
+    Submits write(*args) to the image writer. The job keeps the future so
+    wait_for_writes() can report a failed write.
+    """
+    writer = image_writer()
+    if writer is not None:
+        job.setdefault("writes", []).append(writer.submit(write, *args))
+
+
+def wait_for_writes(job):
+    # A failed write loses a copy of an image, not the complaint's results.
+    for future in job.pop("writes", []):
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Failed to save an image of complaint {job['id']}: {e}")
+
+
+def _write_bytes(path, data):
+    with open(path, "wb") as file:
+        file.write(data)
+    return path
+
+
+def save_generated_image(job, image_bytes):
+    # The image stays in memory for the describe stage; the PNG on disk is
+    # only a copy for people to look at.
+    image_path = os.path.join(job["output_dir"], "generated_image.png")
+    job["image_bytes"] = image_bytes
+    job["image_path"] = image_path
+    write_in_background(job, _write_bytes, image_path, image_bytes)
+    return job
+
+
+def save_annotated_image(job, annotated):
+    # The encoded image is no longer needed once the annotation is drawn.
+    job.pop("image_bytes", None)
+    if annotated is not None:
+        from vision import save_image
+        write_in_background(job, save_image,
+                            os.path.join(job["output_dir"], "annotated_image.png"),
+                            annotated)
+    return job
+
+
+def save_description(job, description):
+    description_filepath = os.path.join(job["output_dir"], "image_description.txt")
+    parsed = Description.parse(description)
+    description_text = parsed.message
+    with open(description_filepath, "w") as file:
+        file.write(description_text)
+    # The bounding box is kept too, for `python annotate.py` to draw again.
+    with open(os.path.join(job["output_dir"], "image_description.json"), "w") as file:
+        file.write(parsed.to_json())
+
+    print(f"Image description saved to {description_filepath}")
+    job["description"] = description_text
+    return job
+
+
+def save_classification_result(job, classification):
+    job["classification"] = Classification.parse(classification).to_dict()
+    return job
+
+
+def reuse_near_duplicate(job):
+    """
+    Gives a transcribed complaint the image, description and classification
+    of a near duplicate already processed, when the near-duplicate index is
+    on and holds one. The link is saved in the complaint's folder as
+    duplicate_of.json, and the stages after transcription skip the complaint.
+    Transcriptions too short to fingerprint reliably are not looked up, and
+    so never indexed either.
+    """
+    index = stage_near_duplicates()
+    if index is None or job.get("categories") is None:
+        return job
+    if not index.accepts(job["transcription"]):
+        return job
+    from neardup import fingerprint
+    job["fingerprint"] = fingerprint(job["transcription"])
+    match = index.find(job["fingerprint"])
+    if match is None:
+        return job
+    classification = match.get("classification") or {}
+    # Results filed under categories that have since changed are not reused.
+    if not job["categories"].is_valid(classification.get("category"),
+                                      classification.get("subcategory")):
+        return job
+
+    job["duplicate_of"] = match["id"]
+    job["render_image"] = False
+    job["path"] = "duplicate"
+    job["classification"] = classification
+    if match.get("image_path"):
+        job["image_path"] = match["image_path"]
+    if match.get("description"):
+        job["description"] = match["description"]
+        with open(os.path.join(job["output_dir"], "image_description.txt"), "w") as file:
+            file.write(match["description"])
+    with open(os.path.join(job["output_dir"], "duplicate_of.json"), "w") as file:
+        json.dump({"id": match["id"], "distance": match["distance"]}, file)
+    print(f"Complaint {job['id']} is a near duplicate of {match['id']}, "
+          f"reusing its results.")
+    return job
+
+
+def remember_complaint(job):
+    """
+    Adds a complaint that went through every stage to the near-duplicate
+    index, so later near duplicates reuse its results.
+    """
+    index = stage_near_duplicates()
+    if index is None or "fingerprint" not in job or "duplicate_of" in job:
+        return
+    index.add(job["id"], job["fingerprint"], classification=job["classification"],
+              description=job.get("description"), image_path=job.get("image_path"))
+
+
+# Stages of the workflow. Each stage takes the complaint's job dict, adds
+# its own results to it and returns it. The stage lists below wrap every
+# stage in a tracing span tagged with the complaint id.
+
+
+def whisper_chunk_seconds():
+    """
+    Returns the chunk length set by WHISPER_CHUNK_SECONDS, above which calls
+    are transcribed in parallel chunks, or None to send every file whole.
+    """
+    chunk_seconds = os.getenv("WHISPER_CHUNK_SECONDS")
+    return float(chunk_seconds) if chunk_seconds else None
+
+
+def whisper_preprocess():
+    """
+    Returns the codec set by WHISPER_PREPROCESS ("opus" or "mp3") that
+    recordings are shrunk to before they are uploaded, or None to upload
+    them as they are, see media.preprocess_speech().
+    """
+    return os.getenv("WHISPER_PREPROCESS") or None
+
+
+def transcribe_chunked(job):
+    from whisper import transcribe_audio_chunked
+    return transcribe_audio_chunked(
+        job["audio_path"], *whisper_settings(),
+        chunk_seconds=whisper_chunk_seconds(),
+        max_workers=int(os.getenv("WHISPER_CHUNK_WORKERS", 4)),
+        cache=stage_cache(), preprocess=whisper_preprocess())
+
+
+def transcribe_stage(job):
+    # Call the function to transcribe the audio complaint.
+    if whisper_chunk_seconds():
+        transcription = transcribe_chunked(job)
+    else:
+        from whisper import transcribe_audio
+        transcription = transcribe_audio(job["audio_path"], *whisper_settings(),
+                                         cache=stage_cache(),
+                                         preprocess=whisper_preprocess())
+    return reuse_near_duplicate(save_transcription(job, transcription))
+
+
+def generate_image_stage(job):
+    if not job["render_image"]:
+        return job
+    # Create a prompt from the transcription.
+    # Generate an image based on the prompt.
+    from dalle import generate_image_bytes
+    image_bytes = generate_image_bytes(job["transcription"],
+        **gpt_settings(), **dalle_settings(), cache=stage_cache(),
+        profile=load_profile())
+    return save_generated_image(job, image_bytes)
+
+
+def describe_stage(job):
+    if not job["render_image"]:
+        return job
+    # Describe the generated image.
+    # Annotate the reported issue in the image.
+    from vision import describe_image_bytes
+    description, annotated = describe_image_bytes(job["image_bytes"], job["transcription"],
+        **gpt_settings(), cache=stage_cache(), profile=load_profile())
+    return save_description(save_annotated_image(job, annotated), description)
+
+
+def classification_input(job):
+    """
+    Returns the text a complaint is classified from, and what that text is.
+    """
+    if job["mode"] == "fast":
+        return job["transcription"], "customer complaint transcription"
+    return job["description"], "image description"
+
+
+def classify_stage(job):
+    # Classify the complaint based on the image description (or the
+    # transcription in fast mode), locally when the pre-classifier is
+    # confident enough. Near duplicates already have theirs.
+    if "duplicate_of" in job:
+        return job
+    from gpt import classify_with_gpt
+    text, description_kind = classification_input(job)
+    classify_fn = classify_with_gpt
+    batcher = current_batcher()
+    if batcher is not None:
+        classify_fn = batcher.classify
+
+    preclassifier = stage_preclassifier()
+    if preclassifier is not None:
+        classification = preclassifier.classify(text, job["categories"],
+                                                classify_fn,
+                                                **gpt_settings(), cache=stage_cache(),
+                                                description_kind=description_kind)
+    else:
+        classification = classify_fn(text, job["categories"],
+                                     **gpt_settings(), cache=stage_cache(),
+                                     description_kind=description_kind)
+    return save_classification_result(job, classification)
+
+
+def describe_classify_stage(job):
+    # Describe the generated image, annotate the issue and classify the
+    # complaint from the image and the transcription, in one call.
+    if "duplicate_of" in job:
+        return job
+    from vision import describe_and_classify_image_bytes
+    description, classification, annotated = describe_and_classify_image_bytes(
+        job["image_bytes"], job["transcription"], job["categories"],
+        **gpt_settings(), cache=stage_cache(), profile=load_profile())
+    job = save_description(save_annotated_image(job, annotated), description)
+    return save_classification_result(job, classification)
+
+
+STAGES = [
+    ("transcribe", traced_stage("transcribe", transcribe_stage)),
+    ("generate_image", traced_stage("generate_image", generate_image_stage)),
+    ("describe", traced_stage("describe", describe_stage)),
+    ("classify", traced_stage("classify", classify_stage)),
+]
+
+# In fast mode classification comes right after transcription, and the image
+# stages run afterwards for the sampled complaints only.
+FAST_STAGES = [
+    ("transcribe", traced_stage("transcribe", transcribe_stage)),
+    ("classify", traced_stage("classify", classify_stage)),
+    ("generate_image", traced_stage("generate_image", generate_image_stage)),
+    ("describe", traced_stage("describe", describe_stage)),
+]
+
+# In combined mode the describe and classify stages are one model call.
+COMBINED_STAGES = [
+    ("transcribe", traced_stage("transcribe", transcribe_stage)),
+    ("generate_image", traced_stage("generate_image", generate_image_stage)),
+    ("describe_classify", traced_stage("describe_classify", describe_classify_stage)),
+]
+
+# Async versions of the stages, built on the pooled AsyncAzureOpenAI clients.
+# Writing the small output files stays synchronous.
+
+
+async def transcribe_stage_async(job):
+    if whisper_chunk_seconds():
+        # Chunking runs ffmpeg and its own thread pool.
+        transcription = await asyncio.to_thread(transcribe_chunked, job)
+    else:
+        from whisper import transcribe_audio_async
+        transcription = await transcribe_audio_async(job["audio_path"], *whisper_settings(),
+                                                     cache=stage_cache(),
+                                                     preprocess=whisper_preprocess())
+    return reuse_near_duplicate(save_transcription(job, transcription))
+
+
+async def generate_image_stage_async(job):
+    if not job["render_image"]:
+        return job
+    from dalle import generate_image_bytes_async
+    image_bytes = await generate_image_bytes_async(job["transcription"],
+        **gpt_settings(), **dalle_settings(), cache=stage_cache(),
+        profile=load_profile())
+    return save_generated_image(job, image_bytes)
+
+
+async def describe_stage_async(job):
+    if not job["render_image"]:
+        return job
+    from vision import describe_image_bytes_async
+    description, annotated = await describe_image_bytes_async(
+        job["image_bytes"], job["transcription"], **gpt_settings(), cache=stage_cache(),
+        profile=load_profile())
+    return save_description(save_annotated_image(job, annotated), description)
+
+
+async def classify_stage_async(job):
+    if "duplicate_of" in job:
+        return job
+    from gpt import classify_with_gpt_async
+    text, description_kind = classification_input(job)
+    preclassifier = stage_preclassifier()
+    if preclassifier is not None:
+        classification = await preclassifier.classify_async(
+            text, job["categories"], classify_with_gpt_async,
+            **gpt_settings(), cache=stage_cache(), description_kind=description_kind)
+    else:
+        classification = await classify_with_gpt_async(text, job["categories"],
+                                                       **gpt_settings(),
+                                                       cache=stage_cache(),
+                                                       description_kind=description_kind)
+    return save_classification_result(job, classification)
+
+
+async def describe_classify_stage_async(job):
+    if "duplicate_of" in job:
+        return job
+    from vision import describe_and_classify_image_bytes_async
+    description, classification, annotated = await describe_and_classify_image_bytes_async(
+        job["image_bytes"], job["transcription"], job["categories"],
+        **gpt_settings(), cache=stage_cache(), profile=load_profile())
+    job = save_description(save_annotated_image(job, annotated), description)
+    return save_classification_result(job, classification)
+
+
+ASYNC_STAGES = [
+    ("transcribe", traced_stage("transcribe", transcribe_stage_async)),
+    ("generate_image", traced_stage("generate_image", generate_image_stage_async)),
+    ("describe", traced_stage("describe", describe_stage_async)),
+    ("classify", traced_stage("classify", classify_stage_async)),
+]
+
+FAST_ASYNC_STAGES = [
+    ("transcribe", traced_stage("transcribe", transcribe_stage_async)),
+    ("classify", traced_stage("classify", classify_stage_async)),
+    ("generate_image", traced_stage("generate_image", generate_image_stage_async)),
+    ("describe", traced_stage("describe", describe_stage_async)),
+]
+
+COMBINED_ASYNC_STAGES = [
+    ("transcribe", traced_stage("transcribe", transcribe_stage_async)),
+    ("generate_image", traced_stage("generate_image", generate_image_stage_async)),
+    ("describe_classify", traced_stage("describe_classify", describe_classify_stage_async)),
+]
+
+
+def pipeline_stages(mode, use_async=False):
+    """
+    Returns the list of (name, stage) pairs to run for a pipeline mode.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown pipeline mode '{mode}', expected one of {MODES}.")
+    if use_async:
+        return {"fast": FAST_ASYNC_STAGES,
+                "combined": COMBINED_ASYNC_STAGES}.get(mode, ASYNC_STAGES)
+    return {"fast": FAST_STAGES, "combined": COMBINED_STAGES}.get(mode, STAGES)
+
+
+def is_sampled(complaint_id, image_sample_rate):
+    """
+    Tells whether a complaint belongs to the sampled fraction that gets images
+    in fast mode. The choice is derived from the complaint id, so re-running
+    a batch samples the same complaints.
+    """
+    if image_sample_rate >= 1:
+        return True
+    return zlib.crc32(complaint_id.encode("utf-8")) % 10000 < image_sample_rate * 10000
+
+
+def new_job(audio_file_path, output_dir, categories_meta, complaint_id=None,
+            mode="full", image_sample_rate=0.0):
+    """
+    Creates the job dict that is passed from stage to stage.
+
+    Parameters:
+        audio_file_path (str): Path to the audio complaint.
+        output_dir (str): Directory receiving this complaint's output files.
+        categories_meta (CategoryCatalog): The categories, see read_categories().
+        complaint_id (str): Identifier of the complaint. Defaults to the
+                            audio file name without its extension.
+        mode (str): "full", "fast" or "combined", see MODES.
+        image_sample_rate (float): Fraction of complaints still getting an
+                                   image and a description in fast mode.
+    """
+    if complaint_id is None:
+        complaint_id = os.path.splitext(os.path.basename(audio_file_path))[0]
+    os.makedirs(output_dir, exist_ok=True)
+
+    render_image = mode != "fast" or is_sampled(complaint_id, image_sample_rate)
+    if mode != "fast":
+        path = mode
+    elif render_image:
+        path = "transcription+image"
+    else:
+        path = "transcription"
+
+    return {
+        "id": complaint_id,
+        "audio_path": audio_file_path,
+        "output_dir": output_dir,
+        "categories": categories_meta,
+        "mode": mode,
+        "render_image": render_image,
+        # Which path the complaint took, recorded with its classification.
+        "path": path,
+    }
+
+
+def process_complaint(audio_file_path, output_dir, categories_meta, mode="full",
+                      image_sample_rate=0.0):
+    """
+    Runs every stage of the workflow, one after another, for a single complaint.
+
+    Returns:
+    dict: The classification of the complaint.
+    """
+    job = new_job(audio_file_path, output_dir, categories_meta, mode=mode,
+                  image_sample_rate=image_sample_rate)
+    with tracing.complaint(job["id"]), tracing.span("complaint", mode=mode):
+        for _, stage in pipeline_stages(mode):
+            job = stage(job)
+    wait_for_writes(job)
+    remember_complaint(job)
+    return job["classification"]
+
+
+def render_images(complaint_dir):
+    """
+    Generates, describes and annotates the image of a complaint processed in
+    fast mode without one, from the transcription saved in its folder.
+
+    Parameters:
+        complaint_dir (str): The complaint's output folder.
+
+    Returns:
+    str: The description of the generated image.
+    """
+    with open(os.path.join(complaint_dir, "transcription.txt"), "r") as file:
+        transcription = file.read()
+
+    job = new_job(None, complaint_dir, None,
+                  complaint_id=os.path.basename(os.path.normpath(complaint_dir)))
+    job["transcription"] = transcription
+    job = describe_stage(generate_image_stage(job))
+    wait_for_writes(job)
+    return job["description"]
+
+
+def save_classification(classification_obj, store, complaint_id=None, path=None,
+                        duplicate_of=None):
+    """
+    Appends a classification result to the classification store, with the
+    complaint it was reused from for near duplicates.
+
+    The store only ever appends a line, so saving costs the same however many
+    results it already holds. Run `python store.py` to compact it and export
+    output/classification.txt.
+    """
+    fields = {}
+    if path is not None:
+        fields["path"] = path
+    if duplicate_of is not None:
+        fields["duplicate_of"] = duplicate_of
+    store.append(classification_obj, complaint_id=complaint_id, **fields)
+    print(f"Classification saved to {store.path}")
+
+
+def read_categories(categories_meta_path="categories.json"):
+    """
+    Loads the categories metadata file. It is read and validated once per
+    process, and every complaint shares the catalog.
+
+    Returns:
+    CategoryCatalog: The categories, or None when the file cannot be read
+                     or is invalid.
+    """
+    try:
+        return load_catalog(categories_meta_path)
+    except FileNotFoundError:
+        print(f"The file at {categories_meta_path} was not found.")
+    except IOError:
+        print("An error occurred while trying to read the file.")
+    except ValueError as e:
+        print(f"The file at {categories_meta_path} is invalid: {e}")
+    return None
+
+
 # Main function to orchestrate the workflow
 
 
 def main():
     """
     Orchestrates the workflow for handling customer complaints.
-    
+
     Steps include:
     1. Transcribe the audio complaint.
     2. Create a prompt from the transcription.
@@ -24,109 +696,477 @@ def main():
     4. Describe the generated image.
     5. Annotate the reported issue in the image.
     6. Classify the complaint into a category/subcategory pair.
-    
+
     Returns:
     None
     """
+    from dotenv import load_dotenv, find_dotenv
 
     dotenv_path = find_dotenv()
     load_dotenv(dotenv_path)
 
-    # Call the function to transcribe the audio complaint.
-    transcription = transcribe_audio("audio/sample_complaint_audio.mp3",
-                                     os.getenv("WHISPER_API_VERSION"),
-                                     os.getenv("WHISPER_API_KEY"),
-                                     os.getenv("WHISPER_ENDPOINT"),
-                                     os.getenv("WHISPER_DEPLOYMENT_NAME"))
+    categories_meta = read_categories()
+    if categories_meta is None:
+        return
 
-    transcription_filepath = "output/transcription.txt"
+    audio_file_path = "audio/sample_complaint_audio.mp3"
+    classification_obj = process_complaint(audio_file_path, "output", categories_meta)
 
-    # Open the file in write mode and save the text
-    with open(transcription_filepath, "w") as file:
-        file.write(transcription)
+    # Print or store the results as required.
+    store = ClassificationStore("output/classification.jsonl")
+    complaint_id = os.path.splitext(os.path.basename(audio_file_path))[0]
+    save_classification(classification_obj, store, complaint_id)
+    report_preclassifier()
+    report_routing()
+    report_trace()
 
-    print(f"Transcription saved to {transcription_filepath}")
 
-    # Create a prompt from the transcription.
-    # Generate an image based on the prompt.
-    image_path = generate_image(transcription,
-        "output/generated_image.png",
-        gpt_api_version=os.getenv("GPT_API_VERSION"),
-        gpt_api_key=os.getenv("GPT_API_KEY"),
-        gpt_endpoint=os.getenv("GPT_ENDPOINT"),
-        gpt_deployment_name=os.getenv("GPT_DEPLOYMENT_NAME"),
+def list_audio_files(source):
+    """
+    Lists the audio complaints found in a directory or a manifest file.
 
-        dalle_api_version=os.getenv("DALLE_API_VERSION"),
-        dalle_api_key=os.getenv("DALLE_API_KEY"),
-        dalle_endpoint=os.getenv("DALLE_ENDPOINT"),
-        dalle_deployment_name=os.getenv("DALLE_DEPLOYMENT_NAME"))
+    Parameters:
+        source (str): A directory containing audio files, or a text file
+                      listing one audio path per line. Relative paths in a
+                      manifest are resolved against the manifest's directory.
 
+    Returns:
+    list: Paths of the audio files, in a stable order.
+    """
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(source, f) for f in os.listdir(source)
+            if f.lower().endswith(AUDIO_EXTENSIONS)
+        )
 
-    # Describe the generated image.
-    # Annotate the reported issue in the image.
-    description = describe_image("output/generated_image.png", transcription,
-        "output/annotated_image.png",
-        gpt_api_version=os.getenv("GPT_API_VERSION"),
-        gpt_api_key=os.getenv("GPT_API_KEY"),
-        gpt_endpoint=os.getenv("GPT_ENDPOINT"),
-        gpt_deployment_name=os.getenv("GPT_DEPLOYMENT_NAME"))
-
-    description_filepath = "output/image_description.txt"
-    description_obj = json.loads(classification)
-    description_text = description_obj["message"]
-    with open(description_filepath, "w") as file:
-        file.write(description_text)
+    base_dir = os.path.dirname(source)
+    paths = []
+    with open(source, "r") as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            paths.append(os.path.join(base_dir, line))
+    return paths
 
-    print(f"Image description saved to {description_filepath}")
 
-    # Classify the complaint based on the image description.
-    categories_meta_path = "categories.json"
+class StagePipeline:
+    """
+    Runs jobs through a list of stages, where each stage has its own pool of
+    worker threads.
+
+    A complaint moves on to the next stage's pool as soon as its current stage
+    finishes, so different complaints are in different stages at the same time
+    and the throughput of a batch is bound by the slowest stage rather than
+    by the sum of all of them.
+    """
+
+    def __init__(self, stages, max_workers=8):
+        self.stages = stages
+        self.pools = [
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+            for name, _ in stages
+        ]
+
+    def submit(self, job):
+        """
+        Submits a job to the first stage.
+
+        Returns:
+        Future: Resolves to the job once it went through every stage.
+        """
+        done = Future()
+        self._run_stage(0, job, done)
+        return done
+
+    def _run_stage(self, index, job, done):
+        if index == len(self.stages):
+            done.set_result(job)
+            return
+
+        _, stage = self.stages[index]
+        future = self.pools[index].submit(stage, job)
+
+        def next_stage(f):
+            if f.exception() is not None:
+                done.set_exception(f.exception())
+                return
+            self._run_stage(index + 1, f.result(), done)
+
+        future.add_done_callback(next_stage)
+
+    def shutdown(self):
+        for pool in self.pools:
+            pool.shutdown(wait=True)
+
+
+def complaint_ids(audio_files):
+    """
+    Returns the complaint id of every audio file of a batch: its file name
+    without the extension, or with the extension appended ("call_mp4") when
+    several files of the batch share that name, as a video and the audio
+    extracted from it do.
+
+    Raises:
+    ValueError: When two files still get the same id, such as files of the
+                same name in two folders of a manifest.
+    """
+    names = [os.path.splitext(os.path.basename(path)) for path in audio_files]
+    counts = Counter(stem for stem, _ in names)
+    ids = [f"{stem}_{extension[1:].lower()}" if counts[stem] > 1 else stem
+           for stem, extension in names]
+    paths = {}
+    for audio_file_path, complaint_id in zip(audio_files, ids):
+        if complaint_id in paths:
+            raise ValueError(f"{paths[complaint_id]} and {audio_file_path} would both be "
+                             f"complaint '{complaint_id}', rename one of them.")
+        paths[complaint_id] = audio_file_path
+    return ids
+
+
+def _batch_jobs(audio_files, output_root, categories_meta, mode, image_sample_rate):
+    # Ids are checked for the whole batch before its first job is created.
+    for audio_file_path, complaint_id in zip(audio_files, complaint_ids(audio_files)):
+        yield new_job(audio_file_path,
+                      os.path.join(output_root, complaint_id),
+                      categories_meta, complaint_id=complaint_id,
+                      mode=mode, image_sample_rate=image_sample_rate)
+
 
+def finish_job(job, store):
+    """
+    Saves the classification of a job that went through every stage, to its
+    folder and to the store.
+
+    Returns:
+    dict: The classification.
+    """
+    wait_for_writes(job)
+    with open(os.path.join(job["output_dir"], "classification.json"), "w") as file:
+        json.dump(job["classification"], file)
+    save_classification(job["classification"], store, job["id"], path=job["path"],
+                        duplicate_of=job.get("duplicate_of"))
+    remember_complaint(job)
+    return job["classification"]
+
+
+def run_batch(source, output_root="output/batch", max_workers=8,
+              categories_meta_path="categories.json", mode="full",
+              image_sample_rate=0.0):
+    """
+    Processes a whole directory or manifest of audio complaints.
+
+    Every complaint gets its own folder under output_root, named after the
+    audio file (see complaint_ids()), holding the same files main() writes to output/. The
+    classifications of the batch are appended to
+    output_root/classification.jsonl.
+
+    Parameters:
+        source (str): Directory or manifest of audio files, see list_audio_files().
+        output_root (str): Directory receiving the per-complaint folders.
+        max_workers (int): Number of complaints each stage handles at once.
+        categories_meta_path (str): Path to the categories metadata file.
+        mode (str): "full", "fast" or "combined", see MODES.
+        image_sample_rate (float): Fraction of complaints still getting an
+                                   image and a description in fast mode.
+
+    Returns:
+    dict: Complaint id to its classification, or to the exception that
+          stopped it.
+    """
+    global _classify_workers
+    categories_meta = read_categories(categories_meta_path)
+    if categories_meta is None:
+        return {}
+
+    audio_files = list_audio_files(source)
+    print(f"Found {len(audio_files)} complaint(s) in {source}.")
+
+    store = ClassificationStore(os.path.join(output_root, "classification.jsonl"))
+    results = {}
+
+    pipeline = StagePipeline(pipeline_stages(mode), max_workers=max_workers)
+    # The batcher of the classify stage, sized for its workers, is only used
+    # while this pipeline runs.
+    _classify_workers = max_workers
+    futures = {}
     try:
-        with open(categories_meta_path, 'r') as file:
-            categories_meta = file.read()
+        for job in _batch_jobs(audio_files, output_root, categories_meta,
+                               mode, image_sample_rate):
+            futures[job["id"]] = pipeline.submit(job)
 
-        classification = classify_with_gpt(description, categories_meta,
-                                        gpt_api_version=os.getenv("GPT_API_VERSION"),
-                                        gpt_api_key=os.getenv("GPT_API_KEY"),
-                                        gpt_endpoint=os.getenv("GPT_ENDPOINT"),
-                                        gpt_deployment_name=os.getenv("GPT_DEPLOYMENT_NAME"))
+        for complaint_id, future in futures.items():
+            try:
+                job = future.result()
+            except Exception as e:
+                print(f"Failed to process complaint {complaint_id}: {e}")
+                results[complaint_id] = e
+                continue
+
+            results[complaint_id] = finish_job(job, store)
+    finally:
+        pipeline.shutdown()
+        report_preclassifier()
+        _classify_workers = None
+
+    report_routing()
+    report_trace()
+    return results
+
+
+async def run_batch_async(source, output_root="output/batch", max_concurrency=100,
+                          categories_meta_path="categories.json", mode="full",
+                          image_sample_rate=0.0):
+    """
+    Processes a whole directory or manifest of audio complaints on a single
+    event loop.
+
+    Works like run_batch(), but every stage call is a coroutine sharing the
+    pooled async clients, so one process keeps up to max_concurrency
+    complaints in flight per stage without a thread for each of them.
+
+    Returns:
+    dict: Complaint id to its classification, or to the exception that
+          stopped it.
+    """
+    categories_meta = read_categories(categories_meta_path)
+    if categories_meta is None:
+        return {}
+
+    audio_files = list_audio_files(source)
+    print(f"Found {len(audio_files)} complaint(s) in {source}.")
+
+    store = ClassificationStore(os.path.join(output_root, "classification.jsonl"))
+    stages = pipeline_stages(mode, use_async=True)
+    limits = [asyncio.Semaphore(max_concurrency) for _ in stages]
+
+    async def run_job(job):
+        for (_, stage), limit in zip(stages, limits):
+            async with limit:
+                job = await stage(job)
+        return job
+
+    jobs = list(_batch_jobs(audio_files, output_root, categories_meta,
+                            mode, image_sample_rate))
+    try:
+        outcomes = await asyncio.gather(*(run_job(job) for job in jobs),
+                                        return_exceptions=True)
+    finally:
+        from clients import close_async_clients
+        await close_async_clients()
+
+    results = {}
+    for job, outcome in zip(jobs, outcomes):
+        if isinstance(outcome, Exception):
+            print(f"Failed to process complaint {job['id']}: {outcome}")
+            results[job["id"]] = outcome
+            continue
+        results[job["id"]] = finish_job(outcome, store)
+
+    report_preclassifier()
+    report_routing()
+    report_trace()
+    return results
+
+
+# Durable queue mode. Complaints are enqueued once, then any number of worker
+# processes lease them from the queue and checkpoint their job dict after
+# every stage, so a crashed worker only loses the stage it was running.
+
+
+def enqueue_batch(source, queue, output_root="output/batch", mode="full",
+                  image_sample_rate=0.0):
+    """
+    Adds the audio complaints of a directory or manifest to a work queue.
+    Complaints already in the queue are left as they are. A file whose id
+    is already queued for another file raises ValueError, see
+    WorkQueue.enqueue().
+
+    Returns:
+    int: The number of complaints added.
+    """
+    added = 0
+    for job in _batch_jobs(list_audio_files(source), output_root, None,
+                           mode, image_sample_rate):
+        added += queue.enqueue(_durable_job(job))
+    print(f"Queued {added} new complaint(s) from {source} in {queue.path}.")
+    return added
+
+
+def _durable_job(job):
+    # The part of a job dict saved in the queue. The generated image is
+    # saved as a file, and read back by a worker resuming the complaint.
+    wait_for_writes(job)
+    image_bytes = job.get("image_bytes")
+    if image_bytes is not None and not os.path.exists(job["image_path"]):
+        _write_bytes(job["image_path"], image_bytes)
+    return {key: value for key, value in job.items()
+            if key not in ("categories", "image_bytes", "writes")}
+
+
+def _restore_job(saved, categories_meta):
+    job = dict(saved, categories=categories_meta)
+    if "image_path" in job and "description" not in job \
+            and os.path.exists(job["image_path"]):
+        with open(job["image_path"], "rb") as file:
+            job["image_bytes"] = file.read()
+    return job
+
+
+def _store_once(job, store, stored_before):
+    # Appends the classification under a result id saved in the queue
+    # beforehand. When an earlier lease got as far as storing, the store is
+    # searched for that id first, so a result is never stored twice.
+    if stored_before and any(row.get("result_id") == job["result_id"]
+                             for row in store.rows()):
+        return
+    with open(os.path.join(job["output_dir"], "classification.json"), "w") as file:
+        json.dump(job["classification"], file)
+    fields = {"duplicate_of": job["duplicate_of"]} if "duplicate_of" in job else {}
+    store.append(job["classification"], complaint_id=job["id"], path=job["path"],
+                 result_id=job["result_id"], **fields)
+    print(f"Classification saved to {store.path}")
+
+
+def run_leased(queue, lease, store, categories_meta, owner, lease_seconds=600,
+               max_attempts=3):
+    """
+    Runs the remaining stages of a leased complaint, checkpointing it after
+    each one, then stores its classification and marks it done.
+
+    Returns:
+    bool: Whether the complaint is done.
+    """
+    job = _restore_job(lease.job, categories_meta)
+    stages = pipeline_stages(job["mode"])
+    try:
+        with tracing.complaint(job["id"]), tracing.span("complaint", mode=job["mode"],
+                                                        resumed_at=lease.next_stage):
+            for index in range(lease.next_stage, len(stages)):
+                name, stage = stages[index]
+                job = stage(job)
+                queue.checkpoint(job["id"], owner, index + 1, STAGE_STATES[name],
+                                 _durable_job(job), lease_seconds)
+
+            stored_before = lease.state == STORING
+            if not stored_before:
+                job["result_id"] = uuid.uuid4().hex
+                queue.checkpoint(job["id"], owner, len(stages), STORING,
+                                 _durable_job(job), lease_seconds)
+            _store_once(job, store, stored_before)
+            remember_complaint(job)
+        queue.complete(job["id"], owner)
+        return True
+    except LeaseLost as e:
+        # Another worker took the complaint over; its result wins.
+        print(e)
+        return False
+    except Exception as e:
+        give_up = lease.attempts >= max_attempts
+        print(f"Failed to process complaint {job['id']} (attempt {lease.attempts}"
+              f"{', giving up' if give_up else ''}): {e}")
+        queue.release(job["id"], owner, f"{type(e).__name__}: {e}", give_up=give_up)
+        return False
+
+
+def run_worker(queue, output_root="output/batch", categories_meta_path="categories.json",
+               max_workers=8, lease_seconds=600, max_attempts=3, wait=False,
+               poll_seconds=2.0):
+    """
+    Processes complaints from a work queue until it is empty.
+
+    Every complaint is leased for lease_seconds, renewed after each stage,
+    so the lease must outlast the slowest stage. A complaint whose stage
+    fails is retried, by this or another worker, up to max_attempts leases.
+    Classifications are appended once to output_root/classification.jsonl.
+
+    Parameters:
+        queue (WorkQueue): The queue, see enqueue_batch().
+        max_workers (int): Number of complaints processed at once.
+        wait (bool): Keep polling for new complaints once the queue is empty.
+
+    Returns:
+    int: The number of complaints this worker finished.
+    """
+    categories_meta = read_categories(categories_meta_path)
+    if categories_meta is None:
+        return 0
+    store = ClassificationStore(os.path.join(output_root, "classification.jsonl"))
+    owner_prefix = f"{socket.gethostname()}:{os.getpid()}"
+    done = []
+
+    def work():
+        owner = f"{owner_prefix}:{uuid.uuid4().hex[:8]}"
+        while True:
+            lease = queue.lease(owner, lease_seconds)
+            if lease is None:
+                if not wait:
+                    return
+                time.sleep(poll_seconds)
+                continue
+            if run_leased(queue, lease, store, categories_meta, owner,
+                          lease_seconds, max_attempts):
+                done.append(lease.complaint_id)
+
+    threads = [threading.Thread(target=work, name=f"worker_{index}")
+               for index in range(max_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f"Worker finished {len(done)} complaint(s). Queue: {queue.counts()}")
+    report_preclassifier()
+    report_routing()
+    report_trace()
+    return len(done)
 
-    except FileNotFoundError:
-        print(f"The file at {categories_meta_path} was not found.")
-    except IOError:
-        print("An error occurred while trying to read the file.")
 
-    # Print or store the results as required.
-    classification_filepath = "output/classification.txt"
-    
-    # Define the column names for the DataFrame
-    columns = ['product', 'category', 'subcategory']
-
-    # Check if the file exists
-    if os.path.exists(classification_filepath):
-        # If the file exists, read it as a CSV
-        try:
-            df = pd.read_csv(classification_filepath)
-        except Exception as e:
-            df = pd.DataFrame(columns=columns)
-    else:
-        # If the file does not exist, create an empty DataFrame
-        df = pd.DataFrame(columns=columns)
-    
-    # Append data with classification result
-    classification_obj = json.loads(classification)
-    new_row = pd.DataFrame([classification_obj])
-    df = pd.concat([df, new_row], ignore_index=True)
-
-    # Save file
-    df.to_csv(classification_filepath, index=False)
-    print(f"Classification saved to {classification_filepath}")
-        
 # Example Usage (for testing purposes, remove/comment when deploying):
 if __name__ == "__main__":
     from dotenv import load_dotenv, find_dotenv
     dotenv_path = find_dotenv()
     load_dotenv(dotenv_path)
 
-    main()
+    parser = argparse.ArgumentParser(description="Customer complaint classification.")
+    parser.add_argument("--batch", metavar="SOURCE",
+                        help="directory or manifest of audio complaints to process")
+    parser.add_argument("--output", default="output/batch",
+                        help="directory receiving one folder per complaint")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="number of complaints each stage handles at once")
+    parser.add_argument("--use-async", action="store_true",
+                        help="run the batch on one event loop with async clients")
+    parser.add_argument("--mode", choices=MODES, default="full",
+                        help="fast classifies straight from the transcription")
+    parser.add_argument("--image-sample-rate", type=float, default=0.0,
+                        help="fraction of complaints still getting images in fast mode")
+    parser.add_argument("--render-images", metavar="COMPLAINT_DIR",
+                        help="generate the images of a complaint processed in fast mode")
+    parser.add_argument("--queue", metavar="DATABASE",
+                        help="durable work queue: with --batch, enqueue the complaints; "
+                             "otherwise, run a worker processing the queue")
+    parser.add_argument("--wait", action="store_true",
+                        help="keep the worker polling the queue once it is empty")
+    parser.add_argument("--lease-seconds", type=float, default=600,
+                        help="how long a worker holds a complaint between checkpoints")
+    args = parser.parse_args()
+
+    if args.render_images:
+        print(render_images(args.render_images))
+    elif args.queue and args.batch:
+        enqueue_batch(args.batch, WorkQueue(args.queue), output_root=args.output,
+                      mode=args.mode, image_sample_rate=args.image_sample_rate)
+    elif args.queue:
+        run_worker(WorkQueue(args.queue), output_root=args.output,
+                   max_workers=args.workers, lease_seconds=args.lease_seconds,
+                   wait=args.wait)
+    elif args.batch and args.use_async:
+        asyncio.run(run_batch_async(args.batch, output_root=args.output,
+                                    max_concurrency=args.workers, mode=args.mode,
+                                    image_sample_rate=args.image_sample_rate))
+    elif args.batch:
+        run_batch(args.batch, output_root=args.output, max_workers=args.workers,
+                  mode=args.mode, image_sample_rate=args.image_sample_rate)
+    else:
+        main()
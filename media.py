@@ -0,0 +1,264 @@
+# media.py
+
+import os
+import re
+import shutil
+import subprocess
+from functools import lru_cache
+
+# Helpers running ffmpeg on audio and video files. ffmpeg streams its input,
+# so none of them hold a whole decoded recording in memory.
+
+DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+SILENCE_START_RE = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+SILENCE_END_RE = re.compile(r"silence_end: (\d+(?:\.\d+)?)")
+TIME_RE = re.compile(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+@lru_cache(maxsize=None)
+def ffmpeg_exe():
+    """
+    Returns the path to the ffmpeg executable: the one on PATH, or the one
+    bundled with moviepy through imageio-ffmpeg.
+    """
+    path = shutil.which("ffmpeg")
+    if path:
+        return path
+    try:
+        import imageio_ffmpeg
+    except ImportError:
+        raise RuntimeError(
+            "ffmpeg not found. Install it, or install imageio-ffmpeg."
+        )
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def run_ffmpeg(args, capture_stdout=False):
+    """
+    Runs ffmpeg with the given arguments.
+
+    Returns:
+    bytes: What ffmpeg wrote to stdout when capture_stdout is set, else None.
+    """
+    result = subprocess.run(
+        [ffmpeg_exe(), "-hide_banner", "-nostdin", "-y"] + list(args),
+        stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        message = result.stderr.decode("utf-8", "replace").strip().splitlines()
+        raise RuntimeError(f"ffmpeg failed: {message[-1] if message else result.returncode}")
+    return result.stdout if capture_stdout else None
+
+
+def _seconds(hours, minutes, seconds):
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def probe_duration(path):
+    """
+    Returns the duration of a media file in seconds, read from its header.
+    """
+    result = subprocess.run([ffmpeg_exe(), "-hide_banner", "-nostdin", "-i", path],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    match = DURATION_RE.search(result.stderr.decode("utf-8", "replace"))
+    if match is None:
+        raise RuntimeError(f"Could not read the duration of '{path}'.")
+    return _seconds(*match.groups())
+
+
+def detect_silences(path, noise_db=-35, min_silence=0.5):
+    """
+    Finds the silent stretches of an audio file with ffmpeg's silencedetect
+    filter, reading its report line by line as the file is decoded.
+
+    Parameters:
+        noise_db (float): Level in dB below which audio counts as silence.
+        min_silence (float): Shortest stretch, in seconds, reported as silence.
+
+    Returns:
+    list: (start, end) pairs in seconds. A silence running to the end of the
+          file has end None.
+    """
+    # -nostats keeps the progress lines, which end in carriage returns, out
+    # of the report parsed below.
+    process = subprocess.Popen(
+        [ffmpeg_exe(), "-hide_banner", "-nostats", "-nostdin", "-i", path, "-vn",
+         "-af", f"silencedetect=noise={noise_db}dB:duration={min_silence}",
+         "-f", "null", "-"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    silences = []
+    start = None
+    for line in process.stderr:
+        line = line.decode("utf-8", "replace")
+        match = SILENCE_START_RE.search(line)
+        if match:
+            start = max(0.0, float(match.group(1)))
+            continue
+        match = SILENCE_END_RE.search(line)
+        if match and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+    process.wait()
+    if start is not None:
+        silences.append((start, None))
+    return silences
+
+
+def extract_audio_segment(path, start, duration, sample_rate=16000, bitrate="32k"):
+    """
+    Decodes one segment of a media file and re-encodes it as mono MP3.
+
+    Only the requested segment is decoded, since -ss before -i seeks in the
+    input.
+
+    Returns:
+    bytes: The MP3 data of the segment.
+    """
+    return run_ffmpeg(
+        ["-ss", f"{start:.3f}", "-t", f"{duration:.3f}", "-i", path,
+         "-vn", "-ac", "1", "-ar", str(sample_rate), "-c:a", "libmp3lame",
+         "-b:a", bitrate, "-f", "mp3", "pipe:1"],
+        capture_stdout=True,
+    )
+
+
+AUDIO_CODEC_RE = re.compile(r"Stream #\S+.*?: Audio: (\w+)")
+
+# Audio-only outputs Whisper accepts as they are: extension -> (ffmpeg muxer,
+# codec that can be stream-copied into it, encoder used otherwise).
+AUDIO_FORMATS = {
+    "m4a": ("mp4", "aac", "aac"),
+    "mp3": ("mp3", "mp3", "libmp3lame"),
+}
+
+
+def probe_audio_codec(path):
+    """
+    Returns the codec name of the first audio stream of a media file, read
+    from its header, or None when it has no audio.
+    """
+    result = subprocess.run([ffmpeg_exe(), "-hide_banner", "-nostdin", "-i", path],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    match = AUDIO_CODEC_RE.search(result.stderr.decode("utf-8", "replace"))
+    return match.group(1) if match else None
+
+
+def extract_audio_track(path, output_path, audio_format="m4a", sample_rate=16000,
+                        bitrate="32k"):
+    """
+    Writes the first audio stream of a media file to an audio-only file.
+
+    Video frames are never decoded. When the audio stream already has the
+    codec of the output format it is copied as is, otherwise it is decoded
+    and re-encoded as mono at sample_rate.
+
+    Parameters:
+        audio_format (str): A key of AUDIO_FORMATS.
+
+    Returns:
+    bool: True when the stream was copied, False when it was re-encoded.
+    """
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Unknown audio format '{audio_format}', "
+                         f"expected one of {sorted(AUDIO_FORMATS)}.")
+    muxer, copy_codec, encoder = AUDIO_FORMATS[audio_format]
+
+    codec = probe_audio_codec(path)
+    if codec is None:
+        raise RuntimeError(f"'{path}' has no audio stream.")
+
+    copy = codec == copy_codec
+    if copy:
+        codec_args = ["-c:a", "copy"]
+    else:
+        codec_args = ["-ac", "1", "-ar", str(sample_rate), "-c:a", encoder,
+                      "-b:a", bitrate]
+    run_ffmpeg(["-i", path, "-map", "0:a:0", "-vn", "-sn", "-dn"] + codec_args
+               + ["-f", muxer, output_path])
+    return copy
+
+
+# Compact speech encodings for preprocess_speech(), both accepted by Whisper:
+# name -> (ffmpeg muxer, encoder, file extension).
+SPEECH_CODECS = {
+    "opus": ("ogg", "libopus", ".ogg"),
+    "mp3": ("mp3", "libmp3lame", ".mp3"),
+}
+
+
+class PreprocessedAudio:
+    """
+    A recording shrunk by preprocess_speech(), with what it saved.
+    """
+
+    __slots__ = ("data", "extension", "source_bytes", "source_seconds", "seconds")
+
+    def __init__(self, data, extension, source_bytes, source_seconds, seconds):
+        self.data = data
+        self.extension = extension
+        self.source_bytes = source_bytes
+        self.source_seconds = source_seconds
+        self.seconds = seconds
+
+    def report(self, name):
+        """
+        Returns:
+        str: A one-line summary of the bytes and audio seconds saved.
+        """
+        saved = 1 - len(self.data) / self.source_bytes if self.source_bytes else 0.0
+        return (f"Preprocessed {name}: {self.source_bytes / 1024:.0f} kB -> "
+                f"{len(self.data) / 1024:.0f} kB ({saved:.0%} smaller), "
+                f"{self.source_seconds:.1f} s -> {self.seconds:.1f} s of audio.")
+
+
+def preprocess_speech(path, codec="opus", sample_rate=16000, bitrate="24k",
+                      noise_db=-40, max_silence=1.0, keep_silence=0.3):
+    """
+    Shrinks a recording before it is uploaded for transcription, in a single
+    ffmpeg run streaming from decoding to encoding.
+
+    The audio is downmixed to mono at sample_rate, which is all Whisper
+    uses. Leading silence and every silent stretch longer than max_silence,
+    such as a silent hold, are cut down to keep_silence seconds. The rest
+    is encoded with a speech codec.
+
+    Parameters:
+        codec (str): A key of SPEECH_CODECS.
+        noise_db (float): Level in dB below which audio counts as silence.
+
+    Returns:
+    PreprocessedAudio: The encoded audio and what it saved.
+    """
+    if codec not in SPEECH_CODECS:
+        raise ValueError(f"Unknown speech codec '{codec}', expected one of "
+                         f"{sorted(SPEECH_CODECS)}.")
+    muxer, encoder, extension = SPEECH_CODECS[codec]
+    silence = (f"silenceremove=start_periods=1:start_threshold={noise_db}dB"
+               f":start_silence={keep_silence}:stop_periods=-1"
+               f":stop_duration={max_silence}:stop_threshold={noise_db}dB"
+               f":stop_silence={keep_silence}")
+    codec_args = ["-c:a", encoder, "-b:a", bitrate]
+    if encoder == "libopus":
+        codec_args += ["-application", "voip"]
+
+    result = subprocess.run(
+        [ffmpeg_exe(), "-hide_banner", "-nostdin", "-i", path, "-vn", "-sn", "-dn",
+         "-af", silence, "-ac", "1", "-ar", str(sample_rate)] + codec_args
+        + ["-f", muxer, "pipe:1"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    report = result.stderr.decode("utf-8", "replace")
+    if result.returncode != 0:
+        message = report.strip().splitlines()
+        raise RuntimeError(f"ffmpeg failed: {message[-1] if message else result.returncode}")
+
+    # ffmpeg reports the input's duration in its header, and the output's
+    # in its last progress line.
+    duration = DURATION_RE.search(report)
+    times = TIME_RE.findall(report)
+    return PreprocessedAudio(
+        result.stdout, extension, os.path.getsize(path),
+        _seconds(*duration.groups()) if duration else 0.0,
+        _seconds(*times[-1]) if times else 0.0)
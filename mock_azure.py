@@ -0,0 +1,337 @@
+# mock_azure.py
+
+import argparse
+import base64
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Azure OpenAI deployments used by the pipeline.
+#
+# It answers the chat completions, audio transcriptions and image generations
+# endpoints after a configurable delay, and serves the PNG that the image
+# generation reply points to. Chat replies are shaped after the prompt, so
+# every stage parses them as it would a real reply.
+
+DEPLOYMENT_RE = re.compile(r"^/openai/deployments/([^/]+)/(.+)$")
+
+# Default latency of every endpoint, in the form accepted by parse_latency().
+DEFAULT_LATENCIES = {
+    "chat": "lognormal:0.8:0.4",
+    "audio": "lognormal:1.5:0.3",
+    "images": "lognormal:6:0.25",
+    "download": "lognormal:0.2:0.3",
+}
+
+MOCK_TRANSCRIPTION = (
+    "Hi there, I'm calling about an issue with an order I received. I recently "
+    "purchased a rubber duck from your store and it arrived with a hole in it. "
+    "It can't float properly and keeps filling up with water. I'd like a "
+    "replacement or a refund."
+)
+MOCK_IMAGE_PROMPT = "A realistic photo of a yellow rubber duck with a hole in its side."
+MOCK_DESCRIPTION = "A yellow rubber duck with a visible hole on its side."
+
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution.
+
+    Parameters:
+        spec (str): "fixed:SECONDS", "uniform:LOW:HIGH" or
+                    "lognormal:MEDIAN:SIGMA".
+
+    Returns:
+    callable: Returns a delay in seconds every time it is called.
+    """
+    kind, *values = spec.split(":")
+    try:
+        values = [float(value) for value in values]
+    except ValueError:
+        raise ValueError(f"Invalid latency '{spec}'.")
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        if median <= 0:
+            return lambda: 0.0
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    raise ValueError(f"Invalid latency '{spec}', expected fixed:S, uniform:A:B "
+                     f"or lognormal:MEDIAN:SIGMA.")
+
+
+def make_png(width=1024, height=1024, color=(255, 215, 0)):
+    """
+    Returns the bytes of a solid-color RGB PNG image.
+    """
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    row = b"\x00" + bytes(color) * width
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * height, 9))
+            + chunk(b"IEND", b""))
+
+
+def _prompt_text(messages):
+    texts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts.extend(part.get("text", "") for part in content
+                         if isinstance(part, dict))
+    return "\n".join(texts)
+
+
+def _first_category(categories):
+    for category, subcategories in categories.items():
+        if subcategories:
+            return category, subcategories[0]
+    return "Toys & Games", "Toys"
+
+
+def chat_reply(messages, categories):
+    """
+    Returns the content of a chat reply matching the stage that sent the
+    messages.
+    """
+    prompt = _prompt_text(messages)
+    category, subcategory = _first_category(categories)
+    classification = {"product": "Rubber duck", "category": category,
+                      "subcategory": subcategory}
+
+    if '"bounding_box"' in prompt:
+        reply = {"message": MOCK_DESCRIPTION, "bounding_box": [312, 300, 712, 700]}
+        if '"subcategory"' in prompt:
+            # Description and classification in one reply.
+            reply.update(classification)
+        return json.dumps(reply)
+    if '"classifications"' in prompt:
+        # The complaints are the JSON object ending the prompt.
+        start = prompt.rfind("\n{")
+        try:
+            ids = list(json.loads(prompt[start:]))
+        except ValueError:
+            ids = []
+        return json.dumps({"classifications": [dict(classification, id=complaint_id)
+                                               for complaint_id in ids]})
+    if '"subcategory"' in prompt:
+        return "```json\n" + json.dumps(classification) + "\n```"
+    return MOCK_IMAGE_PROMPT
+
+
+class MockAzureServer:
+    """
+    Threaded HTTP server imitating the Azure OpenAI endpoints.
+
+    Parameters:
+        latencies (dict): Endpoint ("chat", "audio", "images", "download") to
+                          a latency spec, see parse_latency(). Endpoints left
+                          out use DEFAULT_LATENCIES.
+        error_rate (float): Fraction of model calls answered with a 429 and a
+                            Retry-After header instead.
+        categories (dict): Categories the classification replies pick from.
+        host (str), port (int): Address to listen on. Port 0 picks a free one.
+    """
+
+    def __init__(self, latencies=None, error_rate=0.0, categories=None,
+                 host="127.0.0.1", port=0):
+        specs = dict(DEFAULT_LATENCIES, **(latencies or {}))
+        self.latencies = {name: parse_latency(spec) for name, spec in specs.items()}
+        self.error_rate = error_rate
+        self.categories = categories or {}
+        self.image = make_png()
+        self.requests = {name: 0 for name in specs}
+        self._prefixes = set()
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def cached_tokens(self, messages):
+        """
+        Imitates the server-side prompt cache: returns how many prompt tokens
+        of a chat request a previous request already had as its prefix,
+        counting every message but the last, from 1024 tokens up in steps
+        of 128.
+        """
+        prefix = messages[:-1]
+        prefix_tokens = len(_prompt_text(prefix)) // 4
+        if prefix_tokens < 1024:
+            return 0
+        key = json.dumps(prefix, sort_keys=True)
+        with self._lock:
+            seen = key in self._prefixes
+            self._prefixes.add(key)
+        return prefix_tokens // 128 * 128 if seen else 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _wait(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+        time.sleep(self.latencies[endpoint]())
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _read_body(self):
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    body = b""
+                    while True:
+                        size = int(self.rfile.readline().split(b";")[0], 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return body
+                        body += self.rfile.read(size)
+                        self.rfile.readline()
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def _send(self, status, body, content_type="application/json", headers=()):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.split("?")[0].startswith("/images/"):
+                    server._wait("download")
+                    self._send(200, server.image, "image/png")
+                else:
+                    self._send(404, {"error": {"message": "Not found"}})
+
+            def do_POST(self):
+                body = self._read_body()
+                match = DEPLOYMENT_RE.match(self.path.split("?")[0])
+                if match is None:
+                    self._send(404, {"error": {"message": "Not found"}})
+                    return
+                deployment, operation = match.groups()
+                endpoint = {"chat/completions": "chat",
+                            "audio/transcriptions": "audio",
+                            "images/generations": "images"}.get(operation)
+                if endpoint is None:
+                    self._send(404, {"error": {"message": "Not found"}})
+                    return
+
+                server._wait(endpoint)
+                if server.error_rate and random.random() < server.error_rate:
+                    self._send(429, {"error": {"code": "429", "message": "Rate limit"}},
+                               headers=[("Retry-After", "1")])
+                    return
+
+                if endpoint == "chat":
+                    self._send(200, self._chat(deployment, json.loads(body or b"{}")))
+                elif endpoint == "audio":
+                    self._send(200, {"text": MOCK_TRANSCRIPTION})
+                else:
+                    request = json.loads(body or b"{}")
+                    if request.get("response_format") == "b64_json":
+                        image = {"b64_json": base64.b64encode(server.image).decode("ascii")}
+                    else:
+                        image = {"url": f"{server.url}/images/{deployment}.png"}
+                    image["revised_prompt"] = MOCK_IMAGE_PROMPT
+                    self._send(200, {"created": int(time.time()), "data": [image]})
+
+            def _chat(self, deployment, request):
+                messages = request.get("messages", [])
+                content = chat_reply(messages, server.categories)
+                prompt_tokens = len(_prompt_text(messages)) // 4 + 1
+                completion_tokens = len(content) // 4 + 1
+                return {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": deployment,
+                    "choices": [{
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                        "prompt_tokens_details": {
+                            "cached_tokens": server.cached_tokens(messages)},
+                    },
+                }
+
+        return Handler
+
+
+def mock_environment(url):
+    """
+    Returns the environment variables pointing every stage of main.py at a
+    mock server.
+    """
+    env = {}
+    for prefix in ("WHISPER", "GPT", "DALLE"):
+        env[f"{prefix}_API_VERSION"] = "2024-06-01"
+        env[f"{prefix}_API_KEY"] = "mock-key"
+        env[f"{prefix}_ENDPOINT"] = url
+        env[f"{prefix}_DEPLOYMENT_NAME"] = prefix.lower()
+    return env
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a mock Azure OpenAI server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", action="append", default=[], metavar="ENDPOINT=SPEC",
+                        help="latency of an endpoint, e.g. chat=lognormal:0.8:0.4")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of model calls answered with a 429")
+    args = parser.parse_args()
+
+    with open("categories.json", "r") as file:
+        categories = json.load(file)
+    latencies = dict(spec.split("=", 1) for spec in args.latency)
+    with MockAzureServer(latencies, args.error_rate, categories, port=args.port) as server:
+        print(f"Mock Azure OpenAI server listening on {server.url}")
+        for name, value in mock_environment(server.url).items():
+            print(f"{name}={value}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,223 @@
+# neardup.py
+
+import argparse
+import array
+import hashlib
+import json
+import os
+import re
+import threading
+
+# Near-duplicate detection over transcriptions.
+#
+# Every complaint is fingerprinted with a 64-bit SimHash of its normalized
+# words and word pairs, so transcriptions sharing most of their wording get
+# fingerprints only a few bits apart. A complaint within max_distance bits
+# of one already processed reuses its image, description and classification
+# instead of running those stages again. Transcriptions shorter than
+# min_tokens words are neither looked up nor indexed: an empty or
+# few-word transcription ("hello", "yes thank you") has too few terms for its
+# fingerprint to tell complaints apart, and would match every other one.
+#
+# Lookups cut the fingerprint into max_distance + 1 blocks and file every
+# complaint under each of its blocks. Two fingerprints at most max_distance
+# bits apart agree on at least one whole block, so a lookup only compares
+# the complaints sharing a block with the new one: its cost follows the
+# bucket sizes, not the number of complaints indexed. Fingerprints and
+# buckets are compact arrays, about 8 * (max_distance + 3) bytes per
+# complaint.
+#
+# On disk the index is an append-only JSON lines file, one line per complaint
+# with its fingerprint and the results to reuse. Only fingerprints and line
+# offsets stay in memory, and a match reads its line back. Processes sharing
+# the file pick up each other's complaints on their next lookup.
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+BITS = 64
+MAX_BLOCKS = 8
+DEFAULT_MIN_TOKENS = 8
+
+
+def features(text):
+    """
+    Returns the normalized words of text and its pairs of neighbouring words.
+    """
+    words = TOKEN_RE.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def fingerprint(text):
+    """
+    Returns the 64-bit SimHash of a text.
+    """
+    counts = [0] * BITS
+    terms = features(text)
+    for term in terms:
+        value = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(),
+                               "big")
+        for bit in range(BITS):
+            counts[bit] += value >> bit & 1
+    # A bit is set when most terms set it.
+    half = len(terms) / 2
+    return sum(1 << bit for bit, count in enumerate(counts) if count > half)
+
+
+def distance(a, b):
+    """
+    Returns the number of bits two fingerprints differ by.
+    """
+    return bin(a ^ b).count("1")
+
+
+class NearDuplicateIndex:
+    """
+    Index of processed complaints, looked up by transcription fingerprint.
+
+    Thread-safe. Lines appended by other processes are read on the next
+    lookup.
+
+    Parameters:
+        path (str): The JSON lines file, created when missing.
+        max_distance (int): Most bits a fingerprint may differ by to count
+                            as a near duplicate, from 0 to 7.
+        min_tokens (int): Fewest words a transcription needs to be looked up
+                          or indexed, see accepts().
+    """
+
+    def __init__(self, path="output/near_duplicates.jsonl", max_distance=3,
+                 min_tokens=DEFAULT_MIN_TOKENS):
+        if not 0 <= max_distance < MAX_BLOCKS:
+            raise ValueError(f"max_distance must be between 0 and {MAX_BLOCKS - 1}, "
+                             f"got {max_distance}.")
+        self.path = path
+        self.max_distance = max_distance
+        self.min_tokens = min_tokens
+        width = BITS // (max_distance + 1)
+        # (shift, mask) of every block, the last one taking the leftover bits.
+        self._blocks = [(i * width, (1 << (width if i < max_distance else BITS - i * width)) - 1)
+                        for i in range(max_distance + 1)]
+        self._buckets = [{} for _ in self._blocks]
+        self._fingerprints = array.array("Q")
+        self._offsets = array.array("Q")
+        self._read_up_to = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._catch_up()
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def accepts(self, text):
+        """
+        Tells whether a text has enough words for its fingerprint to be
+        looked up or indexed.
+        """
+        return len(TOKEN_RE.findall((text or "").lower())) >= self.min_tokens
+
+    def _index(self, value, offset):
+        position = len(self._fingerprints)
+        self._fingerprints.append(value)
+        self._offsets.append(offset)
+        for buckets, (shift, mask) in zip(self._buckets, self._blocks):
+            key = value >> shift & mask
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = array.array("Q")
+            bucket.append(position)
+
+    def _catch_up(self):
+        # Indexes the lines appended since the last read. A line still being
+        # written has no newline yet and is left for the next read.
+        try:
+            if os.path.getsize(self.path) <= self._read_up_to:
+                return
+        except FileNotFoundError:
+            return
+        with open(self.path, "rb") as file:
+            file.seek(self._read_up_to)
+            offset = self._read_up_to
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    value = int(json.loads(line)["fingerprint"], 16)
+                except (ValueError, KeyError, TypeError):
+                    value = None  # A line garbled by a crashed writer.
+                if value is not None:
+                    self._index(value, offset)
+                offset += len(line)
+        self._read_up_to = offset
+
+    def find(self, value):
+        """
+        Looks up the processed complaint closest to a fingerprint.
+
+        Returns:
+        dict: Its saved entry with the "distance" in bits, or None when no
+              complaint is within max_distance bits.
+        """
+        with self._lock:
+            self._catch_up()
+            best = best_distance = None
+            seen = set()
+            for buckets, (shift, mask) in zip(self._buckets, self._blocks):
+                for position in buckets.get(value >> shift & mask, ()):
+                    if position in seen:
+                        continue
+                    seen.add(position)
+                    bits = distance(value, self._fingerprints[position])
+                    if bits <= self.max_distance and (best is None or bits < best_distance):
+                        best, best_distance = position, bits
+            if best is None:
+                return None
+            offset = self._offsets[best]
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            entry = json.loads(file.readline())
+        entry["distance"] = best_distance
+        return entry
+
+    def add(self, complaint_id, value, **results):
+        """
+        Records a processed complaint with the results to reuse.
+
+        Parameters:
+            complaint_id (str): The complaint.
+            value (int): The fingerprint of its transcription.
+            results: JSON-serializable results saved with it.
+        """
+        line = (json.dumps(dict(results, id=complaint_id,
+                                fingerprint=f"{value:016x}")) + "\n").encode("utf-8")
+        with self._lock:
+            # One write per line, so lines of several processes never mix.
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            # The line is indexed by reading it back, along with any line
+            # other processes appended before it.
+            self._catch_up()
+
+
+# Example Usage (for testing purposes, remove/comment when deploying):
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up a text in a near-duplicate index.")
+    parser.add_argument("text")
+    parser.add_argument("--index", default="output/near_duplicates.jsonl")
+    parser.add_argument("--max-distance", type=int, default=3)
+    parser.add_argument("--min-tokens", type=int, default=DEFAULT_MIN_TOKENS)
+    args = parser.parse_args()
+
+    index = NearDuplicateIndex(args.index, max_distance=args.max_distance,
+                               min_tokens=args.min_tokens)
+    print(f"{len(index)} complaint(s) indexed.")
+    if not index.accepts(args.text):
+        print(f"Too short to look up, fewer than {index.min_tokens} words.")
+    else:
+        match = index.find(fingerprint(args.text))
+        print(json.dumps(match, indent=2) if match else "No near duplicate.")
@@ -0,0 +1,328 @@
+# preclassifier.py
+
+import json
+import random
+import re
+import threading
+import numpy as np
+from catalog import load_catalog
+
+# Local, CPU-only classification tier in front of gpt.classify_with_gpt.
+#
+# Every category/subcategory pair of categories.json becomes a TF-IDF vector
+# over word unigrams and bigrams, built from its names and the keywords of
+# category_keywords.json. A complaint is scored against all of them with one
+# matrix-vector product, and only falls through to GPT when the best match
+# is not confident enough.
+#
+# Learning from GPT's classifications is opt-in, as the pre-classifier would
+# otherwise train on its own fallback's mistakes. Each category/subcategory
+# pair learns at most learn_limit descriptions, and learned terms reach the
+# matrix in batches of refit_every, so a refit is not paid per complaint.
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOP_WORDS = frozenset("""
+a an and are as at be but by for from has have i in is it its my of on or
+our that the their there this to was were which with you your image shows
+showing shown appears visible product item
+""".split())
+
+
+def _stem(word):
+    # Crude plural folding, enough for "ducks" to match "duck".
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """
+    Splits text into normalized words and word bigrams.
+
+    Returns:
+    list: The terms of the text.
+    """
+    words = [_stem(w) for w in TOKEN_RE.findall(text.lower()) if w not in STOP_WORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class PreClassifierStats:
+    """
+    Counts how many GPT calls the pre-classifier saved, and how often it
+    agreed with GPT when both ran.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+        self.saved_calls = 0
+        self.compared = 0
+        self.agreed = 0
+
+    def report(self):
+        """
+        Returns:
+        str: A one-line summary of the counters.
+        """
+        saved = self.saved_calls / self.total if self.total else 0.0
+        agreement = self.agreed / self.compared if self.compared else 0.0
+        return (f"Pre-classifier: {self.saved_calls}/{self.total} GPT calls saved "
+                f"({saved:.1%}), agreed with GPT on {self.agreed}/{self.compared} "
+                f"compared complaints ({agreement:.1%}).")
+
+
+class PreClassifier:
+    """
+    Classifies complaint descriptions locally with a TF-IDF index of the
+    category/subcategory pairs.
+
+    Parameters:
+        categories (dict): Category to list of subcategories, as in categories.json.
+        keywords (dict): Optional category to {subcategory: [keywords]} mapping
+                         adding product names to the index.
+        threshold (float): Minimum cosine similarity of the best match to skip GPT.
+        margin (float): Minimum lead of the best match over the runner-up.
+        shadow_rate (float): Fraction of confident complaints still sent to GPT,
+                             to keep measuring the agreement rate.
+        learn_limit (int): Most GPT-classified descriptions learned per
+                           category/subcategory pair, 0 to learn none.
+        refit_every (int): Learned descriptions between two refits of the
+                           matrix.
+    """
+
+    def __init__(self, categories, keywords=None, threshold=0.3, margin=0.15,
+                 shadow_rate=0.0, learn_limit=0, refit_every=32):
+        self.threshold = threshold
+        self.margin = margin
+        self.shadow_rate = shadow_rate
+        self.learn_limit = learn_limit
+        self.refit_every = refit_every
+        self.stats = PreClassifierStats()
+        self._lock = threading.Lock()
+
+        keywords = keywords or {}
+        self.labels = []
+        self._label_index = {}
+        self._vocabulary = {}
+        # Term counts of every label, as {column: count} until _fit() turns
+        # them into the TF-IDF matrix.
+        self._counts = []
+        self._learned = []
+        self._pending = 0
+        for category, subcategories in categories.items():
+            for subcategory in subcategories:
+                self._label_index[(category, subcategory)] = len(self.labels)
+                self.labels.append((category, subcategory))
+                self._counts.append({})
+                self._learned.append(0)
+
+                phrases = [category, subcategory]
+                phrases += keywords.get(category, {}).get(subcategory, [])
+                # Tokenize phrase by phrase so no bigram spans two keywords.
+                for phrase in phrases:
+                    self._add_terms(len(self.labels) - 1, tokenize(phrase))
+
+        self._fit()
+
+    def _add_terms(self, index, terms):
+        counts = self._counts[index]
+        for term in terms:
+            column = self._vocabulary.setdefault(term, len(self._vocabulary))
+            counts[column] = counts.get(column, 0) + 1
+
+    def _fit(self):
+        counts = np.zeros((len(self.labels), len(self._vocabulary)), dtype=np.float32)
+        for index, label_counts in enumerate(self._counts):
+            counts[index, list(label_counts)] = list(label_counts.values())
+
+        document_frequency = np.count_nonzero(counts, axis=0)
+        n_labels = len(self.labels)
+        idf = np.log((1 + n_labels) / (1 + document_frequency)) + 1
+
+        weights = np.log1p(counts) * idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self._idf = idf.astype(np.float32)
+        self._matrix = (weights / norms).astype(np.float32)
+        self._pending = 0
+
+    def _vector(self, text):
+        # Terms outside the vocabulary carry no signal, so they are dropped
+        # instead of diluting the similarity of long descriptions. So are terms
+        # learned since the last refit, which the matrix has no column for.
+        columns = self._matrix.shape[1]
+        terms = [t for t in tokenize(text) if self._vocabulary.get(t, columns) < columns]
+        vector = np.zeros(columns, dtype=np.float32)
+        if terms:
+            np.add.at(vector, [self._vocabulary[t] for t in terms], 1)
+        vector = np.log1p(vector) * self._idf
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector, terms
+
+    def predict(self, text):
+        """
+        Scores a description against every category/subcategory pair.
+
+        Returns:
+        dict: The best "category" and "subcategory", the "product" term that
+              matched it most, its "score" and its "margin" over the runner-up.
+        """
+        with self._lock:
+            if self._pending >= self.refit_every:
+                self._fit()
+            vector, terms = self._vector(text)
+            matrix = self._matrix
+        scores = matrix @ vector
+
+        order = np.argsort(scores)[::-1][:2]
+        best = int(order[0])
+        score = float(scores[best])
+        margin = score - float(scores[order[1]]) if len(order) > 1 else score
+
+        # Name the product after the matched term weighing most in the
+        # score, preferring bigrams ("rubber duck" over "duck").
+        product = None
+        if score > 0:
+            contribution = vector * matrix[best]
+            product = max(terms, key=lambda term: (
+                contribution[self._vocabulary[term]] > 0, " " in term,
+                contribution[self._vocabulary[term]]))
+
+        category, subcategory = self.labels[best]
+        return {
+            "product": product,
+            "category": category,
+            "subcategory": subcategory,
+            "score": score,
+            "margin": margin,
+        }
+
+    def is_confident(self, prediction):
+        return prediction["score"] >= self.threshold \
+            and prediction["margin"] >= self.margin
+
+    def learn(self, text, category, subcategory):
+        """
+        Adds a classified description to the index, so complaints similar to
+        ones GPT already classified can skip it next time.
+
+        Returns:
+        bool: Whether it was learned, which it is not once its pair reached
+              learn_limit.
+        """
+        index = self._label_index.get((category, subcategory))
+        if index is None:
+            return False
+        with self._lock:
+            if self._learned[index] >= self.learn_limit:
+                return False
+            self._learned[index] += 1
+            self._add_terms(index, tokenize(text))
+            self._pending += 1
+        return True
+
+    def _record(self, prediction, classification_obj):
+        agreed = classification_obj.get("category") == prediction["category"] \
+            and classification_obj.get("subcategory") == prediction["subcategory"]
+        with self.stats.lock:
+            self.stats.compared += 1
+            self.stats.agreed += int(agreed)
+
+    def classify(self, image_description, categories, classify_fn, **kwargs):
+        """
+        Classifies a complaint locally when confident, otherwise with
+        classify_fn (gpt.classify_with_gpt), which receives the same arguments.
+
+        Returns:
+        str: The classification JSON string, as classify_with_gpt returns it.
+        """
+        prediction = self.predict(image_description)
+        confident = self.is_confident(prediction)
+        shadow = confident and random.random() < self.shadow_rate
+
+        with self.stats.lock:
+            self.stats.total += 1
+            if confident and not shadow:
+                self.stats.saved_calls += 1
+
+        if confident and not shadow:
+            return self._to_json(prediction)
+
+        classification = classify_fn(image_description, categories, **kwargs)
+        self._after_gpt(prediction, image_description, classification)
+        return classification
+
+    async def classify_async(self, image_description, categories, classify_fn, **kwargs):
+        """
+        Async version of classify(), for classify_with_gpt_async.
+
+        Returns:
+        str: The classification JSON string.
+        """
+        prediction = self.predict(image_description)
+        confident = self.is_confident(prediction)
+        shadow = confident and random.random() < self.shadow_rate
+
+        with self.stats.lock:
+            self.stats.total += 1
+            if confident and not shadow:
+                self.stats.saved_calls += 1
+
+        if confident and not shadow:
+            return self._to_json(prediction)
+
+        classification = await classify_fn(image_description, categories, **kwargs)
+        self._after_gpt(prediction, image_description, classification)
+        return classification
+
+    def _after_gpt(self, prediction, image_description, classification):
+        try:
+            classification_obj = json.loads(classification)
+        except (TypeError, ValueError):
+            return
+        self._record(prediction, classification_obj)
+        if self.learn_limit:
+            self.learn(image_description, classification_obj.get("category"),
+                   classification_obj.get("subcategory"))
+
+    @staticmethod
+    def _to_json(prediction):
+        return json.dumps({
+            "product": prediction["product"],
+            "category": prediction["category"],
+            "subcategory": prediction["subcategory"],
+        })
+
+
+def load_preclassifier(categories_meta_path="categories.json",
+                       keywords_path="category_keywords.json", **kwargs):
+    """
+    Builds a PreClassifier from the categories metadata and keyword files.
+
+    Returns:
+    PreClassifier: The pre-classifier. A missing keywords file only leaves
+                   the index with the category names.
+    """
+    categories = load_catalog(categories_meta_path).categories
+
+    keywords = None
+    try:
+        with open(keywords_path, "r") as file:
+            keywords = json.load(file)
+    except FileNotFoundError:
+        pass
+
+    return PreClassifier(categories, keywords=keywords, **kwargs)
+
+
+# Example Usage (for testing purposes, remove/comment when deploying):
+if __name__ == "__main__":
+    preclassifier = load_preclassifier()
+
+    test_message = "The image shows a rubber duck with visible damage, specifically a large hole on its side, rendering it defective and likely unable to float properly."
+    prediction = preclassifier.predict(test_message)
+    print(prediction)
+    print("Confident:", preclassifier.is_confident(prediction))
@@ -0,0 +1,105 @@
+# prompt_prefix.py
+
+import hashlib
+import json
+import threading
+
+# Checks that prompts keep a stable prefix.
+#
+# Azure OpenAI caches the prompt prefixes it has seen recently, from 1024
+# tokens up, and bills and processes cached tokens at a discount. A call
+# only benefits when its prompt starts with the same bytes as an earlier
+# one. The prompts of gpt.py, dalle.py and vision.py therefore put their
+# instructions, and the categories where needed, in a system message built
+# once, and the complaint's data in the user message after it.
+#
+# check() fingerprints everything before the last message of every call. A
+# prompt whose fingerprint changes between calls of the same kind, which
+# silently defeats the cache, is reported once per change.
+
+# Shortest prefix the server caches, and the rough token size used to
+# estimate prefixes against it, as ratelimit.py does for quotas.
+CACHE_MIN_TOKENS = 1024
+CHARS_PER_TOKEN = 4
+
+
+def static_prefix(messages):
+    """
+    Returns the part of a prompt meant to be identical across calls: every
+    message but the last one.
+    """
+    return messages[:-1]
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN
+
+
+def cacheable(compact, verbose):
+    """
+    Picks between two renderings of a static prefix: the compact one, unless
+    it is too short to be cached and the verbose one is long enough.
+
+    Returns:
+    str: The rendering to send.
+    """
+    if estimate_tokens(compact) < CACHE_MIN_TOKENS <= estimate_tokens(verbose):
+        return verbose
+    return compact
+
+
+def fingerprint(messages):
+    """
+    Returns a short hash of the static prefix of a prompt.
+    """
+    encoded = json.dumps(static_prefix(messages), sort_keys=True,
+                         separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+class PrefixMonitor:
+    """
+    Remembers the prefix fingerprint of every kind of call and tells when it
+    changes.
+    """
+
+    def __init__(self):
+        self.changes = 0
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def check(self, name, messages, deployment=None):
+        """
+        Returns:
+        tuple: The fingerprint of the prompt prefix, and whether it matches
+               the one of the previous call of the same name and deployment
+               (True for the first call).
+        """
+        current = fingerprint(messages)
+        with self._lock:
+            previous = self._fingerprints.get((name, deployment))
+            self._fingerprints[(name, deployment)] = current
+            stable = previous is None or previous == current
+            if not stable:
+                self.changes += 1
+        if not stable:
+            print(f"Warning: the prompt prefix of {name} changed ({previous} -> "
+                  f"{current}), so calls miss the server-side prompt cache.")
+        return current, stable
+
+
+_monitor = PrefixMonitor()
+
+
+def check(name, messages, deployment=None, span=None):
+    """
+    Checks the prompt prefix of a call with the shared monitor, and records
+    its fingerprint on the call's tracing span.
+
+    Returns:
+    bool: Whether the prefix is the same as on the previous call.
+    """
+    current, stable = _monitor.check(name, messages, deployment)
+    if span is not None:
+        span.set(prefix=current, prefix_stable=stable)
+    return stable
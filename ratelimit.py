@@ -0,0 +1,350 @@
+# ratelimit.py
+
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+import httpx
+import openai
+
+# Rate limiting and retries shared by every stage.
+#
+# Azure OpenAI grants every deployment a quota of requests and tokens per
+# minute. Each deployment gets one DeploymentLimiter, shared by every stage
+# and thread calling it, with a token bucket per quota. Calls reserve their
+# share of the buckets before going out, so a burst of complaints is spread
+# over the minute instead of being answered with 429s.
+#
+# Calls that still fail with a 429, a 5xx or a connection error are retried
+# with jittered exponential backoff, waiting at least as long as the
+# Retry-After header asks. A 429 also pauses every other caller of the
+# deployment for that long and lowers its rate, which then recovers step by
+# step with every successful call. The tokens reserved for a failed attempt
+# are given back, so retries do not drain the bucket twice.
+
+# Status codes worth another attempt.
+RETRY_STATUS_CODES = frozenset((408, 409, 429, 500, 502, 503, 504))
+
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+# Rough token cost of the inputs, as Azure counts them against the quota.
+CHARS_PER_TOKEN = 4
+TOKENS_PER_IMAGE = 765
+TOKENS_PER_LOW_DETAIL_IMAGE = 85
+
+# Bounds and steps of the adaptive rate scale.
+MIN_RATE_SCALE = 0.1
+RATE_DECREASE = 0.5
+RATE_INCREASE = 0.05
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at per_minute tokens a minute, holding
+    at most per_minute tokens.
+
+    Takers reserve tokens even when the bucket is empty and wait for the
+    refill, so callers are served in the order they arrive.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now, rate_scale):
+        rate = self.per_minute * rate_scale / 60.0
+        self.tokens = min(float(self.per_minute),
+                          self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return rate
+
+    def reserve(self, amount, now, rate_scale=1.0):
+        """
+        Takes amount tokens.
+
+        Returns:
+        float: Seconds to wait before the tokens are really available.
+        """
+        rate = self._refill(now, rate_scale)
+        self.tokens -= amount
+        return max(0.0, -self.tokens / rate)
+
+    def give_back(self, amount):
+        self.tokens = min(float(self.per_minute), self.tokens + amount)
+
+
+class DeploymentLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limits of one deployment.
+
+    Parameters:
+        rpm (int): Requests per minute, or None for no request limit.
+        tpm (int): Tokens per minute, or None for no token limit.
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.rate_scale = 1.0
+        self.paused_until = 0.0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=0):
+        """
+        Reserves one request and tokens against the quotas.
+
+        Returns:
+        float: Seconds to wait before sending the request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now, self.rate_scale))
+            if self.tokens is not None and tokens:
+                wait = max(wait, self.tokens.reserve(tokens, now, self.rate_scale))
+            return wait
+
+    def settle(self, reserved, used):
+        """
+        Returns the tokens reserved for a call but not used by it.
+        """
+        if self.tokens is None or used is None or used >= reserved:
+            return
+        with self._lock:
+            self.tokens.give_back(reserved - used)
+
+    def refund(self, reserved):
+        """
+        Returns the tokens reserved for a call that failed, so its retries do
+        not take them from the quota again.
+        """
+        self.settle(reserved, 0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate_scale = min(1.0, self.rate_scale + RATE_INCREASE)
+
+    def throttle(self, retry_after):
+        """
+        Pauses every caller for retry_after seconds and lowers the rate after
+        the deployment answered with a 429.
+        """
+        with self._lock:
+            self.throttled += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.rate_scale = max(MIN_RATE_SCALE, self.rate_scale * RATE_DECREASE)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def configure(endpoint, deployment, rpm=None, tpm=None):
+    """
+    Sets the quotas of a deployment, replacing its current limiter.
+    """
+    with _limiters_lock:
+        _limiters[(endpoint, deployment)] = DeploymentLimiter(rpm, tpm)
+
+
+@lru_cache(maxsize=None)
+def configure_from_env():
+    """
+    Sets the quotas of the deployments of main.py from the <PREFIX>_RPM and
+    <PREFIX>_TPM environment variables, where PREFIX is WHISPER, GPT or DALLE.
+    """
+    for prefix in ("WHISPER", "GPT", "DALLE"):
+        rpm = os.getenv(f"{prefix}_RPM")
+        tpm = os.getenv(f"{prefix}_TPM")
+        if rpm or tpm:
+            configure(os.getenv(f"{prefix}_ENDPOINT"), os.getenv(f"{prefix}_DEPLOYMENT_NAME"),
+                      rpm=int(rpm) if rpm else None, tpm=int(tpm) if tpm else None)
+
+
+def get_limiter(endpoint, deployment):
+    """
+    Returns the limiter shared by every caller of a deployment. Deployments
+    without configured quotas get a limiter that only coordinates 429 pauses.
+    """
+    configure_from_env()
+    with _limiters_lock:
+        limiter = _limiters.get((endpoint, deployment))
+        if limiter is None:
+            limiter = _limiters[(endpoint, deployment)] = DeploymentLimiter()
+        return limiter
+
+
+def estimate_tokens(messages, max_tokens=0):
+    """
+    Estimates the tokens a chat completion counts against the quota: its
+    prompt, plus the max_tokens the deployment reserves for the reply.
+    """
+    tokens = max_tokens
+    for message in messages:
+        content = message.get("content")
+        parts = [content] if isinstance(content, str) else content or []
+        for part in parts:
+            if isinstance(part, str):
+                tokens += len(part) // CHARS_PER_TOKEN + 1
+            elif part.get("type") == "image_url":
+                low = part["image_url"].get("detail") == "low"
+                tokens += TOKENS_PER_LOW_DETAIL_IMAGE if low else TOKENS_PER_IMAGE
+            else:
+                tokens += len(part.get("text", "")) // CHARS_PER_TOKEN + 1
+    return tokens
+
+
+def status_code(error):
+    """
+    Returns the HTTP status code of a failed call, or None.
+    """
+    status = getattr(error, "status_code", None)
+    if status is None and isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+    return status
+
+
+def is_retryable(error):
+    """
+    Tells whether a failed call is worth another attempt.
+    """
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    return status_code(error) in RETRY_STATUS_CODES
+
+
+def retry_after(error):
+    """
+    Returns the delay, in seconds, asked for by the Retry-After (or
+    retry-after-ms) header of a failed call, or None.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def backoff_delay(attempt, error, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+    """
+    Returns how long to wait before the next attempt: a full-jitter
+    exponential delay, but never less than the server asked for.
+    """
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    requested = retry_after(error)
+    if requested is not None:
+        delay = max(delay, min(requested, max_delay))
+    return delay
+
+
+def used_tokens(result):
+    """
+    Returns the tokens a reply reports it used, or None.
+    """
+    usage = getattr(result, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def max_attempts():
+    """
+    Returns the number of attempts a call gets, from RATE_LIMIT_MAX_ATTEMPTS.
+    """
+    return int(os.getenv("RATE_LIMIT_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+
+
+def after_failure(limiter, error, attempt, attempts):
+    """
+    Returns the delay before the next attempt of a failed call, throttling
+    its limiter on a 429, or raises the error when it is final.
+    """
+    if not is_retryable(error) or attempt + 1 >= attempts:
+        raise error
+    delay = backoff_delay(attempt, error)
+    if status_code(error) == 429 and limiter is not None:
+        limiter.throttle(delay)
+    return delay
+
+
+def call(endpoint, deployment, fn, *args, tokens=0, **kwargs):
+    """
+    Calls fn(*args, **kwargs) within the quotas of a deployment, retrying it
+    on 429s, 5xx errors and connection errors.
+
+    Parameters:
+        endpoint (str), deployment (str): The deployment called, or None for
+                                          calls outside any quota, such as
+                                          image downloads.
+        tokens (int): Tokens the call counts against the quota, see
+                      estimate_tokens(). The unused part is given back once
+                      the reply reports its usage.
+
+    Returns:
+    The result of fn.
+    """
+    limiter = get_limiter(endpoint, deployment) if deployment else None
+    attempts = max_attempts()
+    for attempt in range(attempts):
+        if limiter is not None:
+            wait = limiter.reserve(tokens)
+            if wait:
+                time.sleep(wait)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if limiter is not None:
+                limiter.refund(tokens)
+            time.sleep(after_failure(limiter, e, attempt, attempts))
+            continue
+        if limiter is not None:
+            limiter.settle(tokens, used_tokens(result))
+            limiter.succeeded()
+        return result
+
+
+async def call_async(endpoint, deployment, fn, *args, tokens=0, **kwargs):
+    """
+    Async version of call(), for a coroutine function fn.
+    """
+    limiter = get_limiter(endpoint, deployment) if deployment else None
+    attempts = max_attempts()
+    for attempt in range(attempts):
+        if limiter is not None:
+            wait = limiter.reserve(tokens)
+            if wait:
+                await asyncio.sleep(wait)
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            if limiter is not None:
+                limiter.refund(tokens)
+            await asyncio.sleep(after_failure(limiter, e, attempt, attempts))
+            continue
+        if limiter is not None:
+            limiter.settle(tokens, used_tokens(result))
+            limiter.succeeded()
+        return result
@@ -0,0 +1,275 @@
+# replies.py
+
+import json
+import os
+
+# Parsing and validation of model replies.
+#
+# Chat prompts ask for JSON, and with GPT_RESPONSE_FORMAT the request also
+# asks the deployment to enforce it: "json_object" for JSON mode, or
+# "json_schema" for structured outputs following the schemas below. Both are
+# opt-in, as deployments and API versions without response_format reject
+# the request; the default, "text", sends none. Replies are then parsed into
+# small typed results. A reply that still holds no valid result is asked
+# for again, up to REPLY_MAX_ATTEMPTS times, so one bad reply costs one more
+# call of its stage instead of failing the complaint.
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+RESPONSE_FORMATS = ("json_object", "json_schema", "text")
+
+
+class ReplyError(ValueError):
+    """
+    Raised when a model reply holds no valid result.
+    """
+
+
+_decoder = json.JSONDecoder()
+
+
+def extract_json(text, openers="{"):
+    """
+    Returns the first JSON value of text starting with one of openers,
+    skipping code fences and any prose around it.
+
+    Raises:
+    ReplyError: When text holds no such value.
+    """
+    if not isinstance(text, str):
+        raise ReplyError("The reply is empty.")
+    stripped = text.strip()
+    # Fast path: the whole reply is the JSON value, as in JSON mode.
+    if stripped[:1] in openers:
+        try:
+            return json.loads(stripped)
+        except ValueError:
+            pass
+
+    index = 0
+    while True:
+        starts = [i for i in (stripped.find(opener, index) for opener in openers) if i >= 0]
+        if not starts:
+            raise ReplyError(f"No JSON found in the reply: {text[:200]!r}")
+        index = min(starts)
+        try:
+            value, _ = _decoder.raw_decode(stripped, index)
+            return value
+        except ValueError:
+            index += 1
+
+
+def _object(value):
+    if isinstance(value, str):
+        value = extract_json(value)
+    if not isinstance(value, dict):
+        raise ReplyError(f"Expected a JSON object, got {type(value).__name__}.")
+    return value
+
+
+def _string(obj, field):
+    value = obj.get(field)
+    if not isinstance(value, str) or not value.strip():
+        raise ReplyError(f"The reply has no '{field}' string.")
+    return value
+
+
+class Transcription:
+    """
+    Text of a transcribed recording.
+    """
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    @classmethod
+    def from_result(cls, result):
+        """
+        Builds the transcription from a Whisper reply, or its text.
+        """
+        text = result if isinstance(result, str) else getattr(result, "text", None)
+        if not isinstance(text, str):
+            raise ReplyError("The transcription reply has no text.")
+        return cls(text)
+
+
+class Description:
+    """
+    Description of an image, with the box localizing the reported issue as
+    [x1, y1, x2, y2] pixels.
+    """
+
+    __slots__ = ("message", "bounding_box")
+
+    def __init__(self, message, bounding_box):
+        self.message = message
+        self.bounding_box = bounding_box
+
+    @classmethod
+    def parse(cls, reply):
+        """
+        Builds the description from a reply, its JSON object or its text.
+        """
+        obj = _object(reply)
+        box = obj.get("bounding_box")
+        if not isinstance(box, list) or len(box) != 4 \
+                or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in box):
+            raise ReplyError("The reply has no 'bounding_box' of four numbers.")
+        return cls(_string(obj, "message"), [round(v) for v in box])
+
+    def to_dict(self):
+        return {"message": self.message, "bounding_box": list(self.bounding_box)}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+
+class Classification:
+    """
+    Product, category and subcategory of a complaint.
+    """
+
+    __slots__ = ("product", "category", "subcategory")
+
+    FIELDS = ("product", "category", "subcategory")
+
+    def __init__(self, product, category, subcategory):
+        self.product = product
+        self.category = category
+        self.subcategory = subcategory
+
+    @classmethod
+    def parse(cls, reply):
+        """
+        Builds the classification from a reply, its JSON object or its text.
+        """
+        obj = _object(reply)
+        return cls(*(_string(obj, field) for field in cls.FIELDS))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+
+def parse_description_classification(reply):
+    """
+    Parses the reply of the combined vision mode.
+
+    Returns:
+    tuple: The Description and the Classification.
+    """
+    obj = _object(reply)
+    return Description.parse(obj), Classification.parse(obj)
+
+
+# JSON schemas of the replies, for GPT_RESPONSE_FORMAT=json_schema. Strict
+# structured outputs need every property required and no extra ones.
+
+def _schema(properties):
+    return {"type": "object", "properties": properties,
+            "required": list(properties), "additionalProperties": False}
+
+
+_DESCRIPTION_PROPERTIES = {
+    "message": {"type": "string"},
+    "bounding_box": {"type": "array", "items": {"type": "integer"}},
+}
+_CLASSIFICATION_PROPERTIES = {field: {"type": "string"} for field in Classification.FIELDS}
+
+DESCRIPTION_SCHEMA = _schema(_DESCRIPTION_PROPERTIES)
+CLASSIFICATION_SCHEMA = _schema(_CLASSIFICATION_PROPERTIES)
+DESCRIPTION_CLASSIFICATION_SCHEMA = _schema(dict(_DESCRIPTION_PROPERTIES,
+                                                 **_CLASSIFICATION_PROPERTIES))
+# Structured outputs need an object at the top, so batches wrap their list.
+BATCH_CLASSIFICATION_SCHEMA = _schema({"classifications": {
+    "type": "array",
+    "items": _schema(dict({"id": {"type": "string"}}, **_CLASSIFICATION_PROPERTIES)),
+}})
+
+
+def response_format_args(name, schema):
+    """
+    Returns the response_format argument of a chat completion asking for a
+    JSON object, as set by GPT_RESPONSE_FORMAT, or no argument for "text",
+    the default.
+    """
+    mode = os.getenv("GPT_RESPONSE_FORMAT") or "text"
+    if mode not in RESPONSE_FORMATS:
+        raise ValueError(f"Unknown GPT_RESPONSE_FORMAT '{mode}', expected one of "
+                         f"{RESPONSE_FORMATS}.")
+    if mode == "text":
+        return {}
+    if mode == "json_object":
+        return {"response_format": {"type": "json_object"}}
+    return {"response_format": {"type": "json_schema", "json_schema": {
+        "name": name, "schema": schema, "strict": True}}}
+
+
+def message_text(response):
+    """
+    Returns the text of a chat completion.
+    """
+    message = response.choices[0].message
+    if getattr(message, "refusal", None):
+        raise ReplyError(f"The model refused: {message.refusal}")
+    if not message.content:
+        raise ReplyError("The reply is empty.")
+    return message.content
+
+
+def _max_attempts():
+    return int(os.getenv("REPLY_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+
+
+def call_parsed(call, parse, span=None):
+    """
+    Calls a chat completion and parses its text, calling it again when the
+    reply holds no valid result.
+
+    Parameters:
+        call (callable): Sends the request and returns the completion.
+        parse (callable): Turns the reply text into the result, raising
+                          ReplyError when it cannot.
+        span (Span): Optional tracing span recording the usage of every
+                     attempt and the number of replies parsed again.
+
+    Returns:
+    The parsed result.
+    """
+    max_attempts = _max_attempts()
+    for attempt in range(max_attempts):
+        response = call()
+        if span is not None:
+            span.record_usage(response)
+        try:
+            return parse(message_text(response))
+        except ReplyError as e:
+            _after_bad_reply(e, attempt, max_attempts, span)
+
+
+async def call_parsed_async(call, parse, span=None):
+    """
+    Async version of call_parsed(), for a call returning a coroutine.
+    """
+    max_attempts = _max_attempts()
+    for attempt in range(max_attempts):
+        response = await call()
+        if span is not None:
+            span.record_usage(response)
+        try:
+            return parse(message_text(response))
+        except ReplyError as e:
+            _after_bad_reply(e, attempt, max_attempts, span)
+
+
+def _after_bad_reply(error, attempt, max_attempts, span):
+    if attempt + 1 >= max_attempts:
+        raise error
+    if span is not None:
+        span.add("reply_retries", 1)
+    name = span.name if span is not None else "the call"
+    print(f"Invalid reply to {name}, asking again: {error}")
@@ -0,0 +1,387 @@
+# routing.py
+
+import asyncio
+import json
+import operator
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+from clients import get_client, get_async_client
+import ratelimit
+import tracing
+
+# Routing of model calls over a pool of deployments per stage.
+#
+# A stage reads one endpoint from <PREFIX>_ENDPOINT and friends, where
+# PREFIX is WHISPER, GPT or DALLE. Setting <PREFIX>_ENDPOINTS to a JSON list
+# of deployments serving the same model spreads the stage's calls over all
+# of them, each with its own quota:
+#
+#   GPT_ENDPOINTS='[{"endpoint": "https://east.openai.azure.com/", "api_key": "...",
+#                    "deployment": "gpt-4o", "weight": 2, "tpm": 450000},
+#                   {"endpoint": "https://west.openai.azure.com/", "api_key": "..."}]'
+#
+# Missing fields default to the single-endpoint variables. Every call goes
+# to the deployment with the fewest calls in flight for its weight, among
+# the healthy ones:
+#
+# - A circuit breaker opens after BREAKER_FAILURES consecutive failures
+#   (5xx, timeouts, connection errors) and keeps the deployment out for
+#   COOLDOWN_SECONDS. A single probe call then decides whether it closes
+#   again. A probe that is throttled or cancelled opens it for another
+#   cooldown, and one refused as a bad request closes it, since the
+#   deployment did answer.
+# - A deployment whose average latency exceeds LATENCY_FACTOR times the
+#   median of the pool is ejected for COOLDOWN_SECONDS.
+# - A deployment paused by a 429 is skipped while the pause lasts.
+#
+# A failed call is retried at once on another healthy deployment, and only
+# waits out the backoff of ratelimit.py when there is none. When every
+# deployment is out, calls go to the one coming back first rather than
+# failing. Throughput then grows with the deployments added.
+
+BREAKER_FAILURES = 5
+COOLDOWN_SECONDS = 30.0
+LATENCY_FACTOR = 3.0
+# Calls a deployment needs before its latency is compared, and the weight
+# of the latest call in its moving average.
+MIN_LATENCY_SAMPLES = 10
+LATENCY_ALPHA = 0.2
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class Target:
+    """
+    One deployment of a pool, with its health.
+
+    Parameters:
+        endpoint (str), api_key (str), api_version (str), deployment (str):
+            Where and how to call it.
+        weight (float): Share of the calls it takes relative to the others.
+    """
+
+    __slots__ = ("endpoint", "api_key", "api_version", "deployment", "weight",
+                 "outstanding", "latency", "samples", "failures", "state",
+                 "out_until", "calls", "errors")
+
+    def __init__(self, endpoint, api_key, api_version, deployment, weight=1.0):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.api_version = api_version
+        self.deployment = deployment
+        self.weight = weight
+        self.outstanding = 0
+        self.latency = None
+        self.samples = 0
+        self.failures = 0
+        self.state = CLOSED
+        # End of the breaker's cooldown or of a latency ejection.
+        self.out_until = 0.0
+        self.calls = 0
+        self.errors = 0
+
+    @property
+    def name(self):
+        return f"{self.endpoint}#{self.deployment}"
+
+
+class EndpointPool:
+    """
+    Deployments a stage spreads its calls over, with weighted
+    least-outstanding-requests routing, circuit breakers and latency-based
+    ejection. Thread-safe.
+    """
+
+    def __init__(self, targets, breaker_failures=BREAKER_FAILURES,
+                 cooldown=COOLDOWN_SECONDS, latency_factor=LATENCY_FACTOR):
+        if not targets:
+            raise ValueError("An endpoint pool needs at least one deployment.")
+        self.targets = list(targets)
+        self.breaker_failures = breaker_failures
+        self.cooldown = cooldown
+        self.latency_factor = latency_factor
+        self._lock = threading.Lock()
+
+    def _available(self, target, now):
+        # Only tells: the breaker turns half-open in acquire(), when the
+        # probe call is actually sent.
+        if target.state == HALF_OPEN:
+            # Only the probe call goes through until it comes back.
+            return target.outstanding == 0
+        if target.out_until > now:
+            return False
+        if target.state == OPEN:
+            return target.outstanding == 0
+        return _paused_until(target) <= now
+
+    def acquire(self):
+        """
+        Picks the deployment for the next call and counts it in flight.
+
+        Returns:
+        Target: The deployment. Pass it to release() once the call is done.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [t for t in self.targets if self._available(t, now)]
+            if not candidates:
+                candidates = [min(self.targets,
+                                  key=lambda t: max(t.out_until, _paused_until(t)))]
+            load = min(t.outstanding / t.weight for t in candidates)
+            # Ties, such as idle deployments, are broken at random in
+            # proportion to the weights, so they share calls by weight too.
+            tied = [t for t in candidates if t.outstanding / t.weight == load]
+            target = random.choices(tied, weights=[t.weight for t in tied])[0]
+            if target.state == OPEN and target.out_until <= now:
+                target.state = HALF_OPEN
+            target.outstanding += 1
+            target.calls += 1
+            return target
+
+    def release(self, target, seconds, error=None):
+        """
+        Records the outcome of a call.
+
+        Parameters:
+            seconds (float): How long the call took.
+            error (BaseException): What it raised, or None on success.
+        """
+        with self._lock:
+            target.outstanding -= 1
+            now = time.monotonic()
+            if error is None:
+                target.failures = 0
+                target.state = CLOSED
+                self._record_latency(target, seconds, now)
+                return
+            if _is_failure(error):
+                target.errors += 1
+                target.failures += 1
+                if target.state == HALF_OPEN or target.failures >= self.breaker_failures:
+                    target.state = OPEN
+                    target.out_until = now + self.cooldown
+                    print(f"Circuit opened for {target.name} after {target.failures} "
+                          f"failure(s): {type(error).__name__}: {error}")
+            elif target.state == HALF_OPEN:
+                # The probe must not leave the breaker half-open for good.
+                status = ratelimit.status_code(error)
+                if status is not None and status != 429:
+                    target.failures = 0
+                    target.state = CLOSED
+                else:
+                    target.state = OPEN
+                    target.out_until = now + self.cooldown
+                    print(f"Circuit opened again for {target.name}, its probe got "
+                          f"{type(error).__name__}: {error}")
+
+    def _record_latency(self, target, seconds, now):
+        if target.latency is None:
+            target.latency = seconds
+        else:
+            target.latency += LATENCY_ALPHA * (seconds - target.latency)
+        target.samples += 1
+        if target.samples < MIN_LATENCY_SAMPLES:
+            return
+        others = [t.latency for t in self.targets if t is not target
+                  and t.samples >= MIN_LATENCY_SAMPLES and self._available(t, now)]
+        if not others:
+            return
+        others.sort()
+        median = others[len(others) // 2]
+        if target.latency > self.latency_factor * median:
+            print(f"Ejecting {target.name} for {self.cooldown:.0f} s: "
+                  f"{target.latency:.2f} s per call against {median:.2f} s.")
+            target.out_until = now + self.cooldown
+            # It comes back with a fresh average.
+            target.latency = None
+            target.samples = 0
+
+    def has_alternative(self, target):
+        """
+        Tells whether another deployment could take a call right now.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return any(t is not target and self._available(t, now) for t in self.targets)
+
+    def report(self):
+        """
+        Returns:
+        list: One line per deployment with its calls, errors, state and
+              latency.
+        """
+        lines = []
+        for t in self.targets:
+            latency = "-" if t.latency is None else f"{t.latency:.2f} s"
+            lines.append(f"  {t.name:<60} {t.calls:>7} calls {t.errors:>5} errors "
+                         f"{t.state:>9} {latency:>9}")
+        return lines
+
+
+def _paused_until(target):
+    return ratelimit.get_limiter(target.endpoint, target.deployment).paused_until
+
+
+def _is_failure(error):
+    # Failures saying the deployment is unwell, as opposed to 429s, which
+    # pause it through its limiter, and errors of the request itself.
+    return ratelimit.is_retryable(error) and ratelimit.status_code(error) != 429
+
+
+def parse_targets(spec, api_version=None, api_key=None, deployment=None):
+    """
+    Parses the JSON list of a <PREFIX>_ENDPOINTS variable. Quotas given as
+    "rpm" and "tpm" are set on each deployment's limiter.
+
+    Returns:
+    list: The Targets.
+    """
+    entries = json.loads(spec)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("Expected a non-empty JSON list of deployments.")
+    targets = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get("endpoint"):
+            raise ValueError(f"Every deployment needs an 'endpoint': {entry!r}")
+        target = Target(entry["endpoint"], entry.get("api_key", api_key),
+                        entry.get("api_version", api_version),
+                        entry.get("deployment", deployment),
+                        float(entry.get("weight", 1.0)))
+        if entry.get("rpm") or entry.get("tpm"):
+            ratelimit.configure(target.endpoint, target.deployment,
+                                rpm=entry.get("rpm"), tpm=entry.get("tpm"))
+        targets.append(target)
+    return targets
+
+
+_pools = {}
+
+
+@lru_cache(maxsize=None)
+def get_pool(prefix, api_version, api_key, endpoint, deployment):
+    """
+    Returns the pool of a stage: the deployments of <PREFIX>_ENDPOINTS when
+    it is set, or else the single deployment the stage was given.
+    """
+    # Quotas of the single-endpoint variables are set first, so the ones
+    # given per deployment take precedence.
+    ratelimit.configure_from_env()
+    spec = os.getenv(f"{prefix}_ENDPOINTS")
+    if spec:
+        targets = parse_targets(spec, api_version, api_key, deployment)
+    else:
+        targets = [Target(endpoint, api_key, api_version, deployment)]
+    pool = EndpointPool(
+        targets,
+        breaker_failures=int(os.getenv("ROUTING_BREAKER_FAILURES", BREAKER_FAILURES)),
+        cooldown=float(os.getenv("ROUTING_COOLDOWN_SECONDS", COOLDOWN_SECONDS)),
+        latency_factor=float(os.getenv("ROUTING_LATENCY_FACTOR", LATENCY_FACTOR)))
+    _pools[(prefix, deployment)] = pool
+    return pool
+
+
+def report():
+    """
+    Returns:
+    list: Lines describing every pool of more than one deployment.
+    """
+    lines = []
+    for (prefix, deployment), pool in sorted(_pools.items()):
+        if len(pool.targets) > 1:
+            lines.append(f"{prefix} pool of {deployment}:")
+            lines.extend(pool.report())
+    return lines
+
+
+def _record_target(target):
+    span = tracing.current_span()
+    if span is not None:
+        span.set(endpoint=target.endpoint, routed_deployment=target.deployment)
+
+
+def _retry_delay(pool, target, limiter, error, attempt, attempts):
+    # Raises the error when it is final. Otherwise the next attempt goes at
+    # once to another healthy deployment, or waits out the backoff.
+    delay = ratelimit.after_failure(limiter, error, attempt, attempts)
+    return 0.0 if pool.has_alternative(target) else delay
+
+
+def call(pool, operation, *, tokens=0, **kwargs):
+    """
+    Calls a client method on the pool's deployments, within their quotas,
+    failing over and retrying like ratelimit.call().
+
+    Parameters:
+        pool (EndpointPool): The stage's pool, see get_pool().
+        operation (str): Path of the client method, such as
+                         "chat.completions.create". It is called with the
+                         chosen deployment as model, and kwargs.
+        tokens (int): Tokens the call counts against the quota.
+
+    Returns:
+    The result of the call.
+    """
+    attempts = ratelimit.max_attempts()
+    for attempt in range(attempts):
+        target = pool.acquire()
+        limiter = ratelimit.get_limiter(target.endpoint, target.deployment)
+        start = time.perf_counter()
+        reserved = 0
+        try:
+            wait = limiter.reserve(tokens)
+            reserved = tokens
+            if wait:
+                time.sleep(wait)
+            _record_target(target)
+            client = get_client(target.api_version, target.api_key, target.endpoint)
+            start = time.perf_counter()
+            result = operator.attrgetter(operation)(client)(model=target.deployment, **kwargs)
+        except BaseException as e:
+            pool.release(target, time.perf_counter() - start, e)
+            limiter.refund(reserved)
+            if not isinstance(e, Exception):
+                raise
+            time.sleep(_retry_delay(pool, target, limiter, e, attempt, attempts))
+            continue
+        pool.release(target, time.perf_counter() - start)
+        limiter.settle(tokens, ratelimit.used_tokens(result))
+        limiter.succeeded()
+        return result
+
+
+async def call_async(pool, operation, *, tokens=0, **kwargs):
+    """
+    Async version of call(), using the AsyncAzureOpenAI clients.
+    """
+    attempts = ratelimit.max_attempts()
+    for attempt in range(attempts):
+        target = pool.acquire()
+        limiter = ratelimit.get_limiter(target.endpoint, target.deployment)
+        start = time.perf_counter()
+        reserved = 0
+        try:
+            wait = limiter.reserve(tokens)
+            reserved = tokens
+            if wait:
+                await asyncio.sleep(wait)
+            _record_target(target)
+            client = get_async_client(target.api_version, target.api_key, target.endpoint)
+            start = time.perf_counter()
+            result = await operator.attrgetter(operation)(client)(model=target.deployment,
+                                                                  **kwargs)
+        except BaseException as e:
+            pool.release(target, time.perf_counter() - start, e)
+            limiter.refund(reserved)
+            if not isinstance(e, Exception):
+                raise
+            await asyncio.sleep(_retry_delay(pool, target, limiter, e, attempt, attempts))
+            continue
+        pool.release(target, time.perf_counter() - start)
+        limiter.settle(tokens, ratelimit.used_tokens(result))
+        limiter.succeeded()
+        return result
@@ -0,0 +1,465 @@
+# service.py
+
+import argparse
+import asyncio
+import json
+import mimetypes
+import os
+import posixpath
+import time
+import uuid
+from urllib.parse import parse_qs, urlsplit
+from clients import get_async_http_session, close_async_clients
+from store import ClassificationStore
+import main as pipeline
+import ratelimit
+import tracing
+
+# HTTP front-end running the pipeline as a long-lived service.
+#
+# POST /complaints takes one audio complaint, either as the raw request body
+# (the file name, for its extension, in ?filename=) or as a JSON body
+# {"audio_url": ...} pointing to the recording. The reply is a stream of
+# server-sent events: "accepted" once the complaint has a slot, one "stage"
+# event per finished stage carrying the results available so far (the
+# transcription first, the classification last), then "done" or "error".
+# Every complaint runs the async stages of main.py on the service's event
+# loop, sharing the pooled clients of clients.py.
+#
+# Admission control: at most SERVICE_MAX_CONCURRENCY complaints run at once
+# and at most SERVICE_MAX_QUEUE more wait for a slot. Beyond that a request
+# is answered 503 with a Retry-After header before its upload is read, so
+# callers back off instead of piling up behind the deployments' quotas.
+#
+# The server speaks the small part of HTTP/1.1 the pipeline needs, on
+# asyncio streams: one request per connection, bodies sent with a
+# Content-Length.
+#
+# audio_url makes the service fetch a URL chosen by its caller, so it is
+# off unless SERVICE_AUDIO_URL_HOSTS lists the hosts recordings may be
+# downloaded from. Only http(s) URLs to those hosts are fetched, redirects
+# included, and the download is streamed and aborted as soon as it passes
+# SERVICE_MAX_UPLOAD_BYTES instead of being read whole first.
+
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_QUEUE = 64
+DEFAULT_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+DEFAULT_RETRY_AFTER = 5
+
+AUDIO_URL_SCHEMES = ("http", "https")
+MAX_REDIRECTS = 5
+
+# Results streamed after the stage that produced them.
+RESULT_FIELDS = ("transcription", "description", "classification")
+
+MAX_HEADER_BYTES = 16 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 411: "Length Required",
+           413: "Payload Too Large", 415: "Unsupported Media Type",
+           502: "Bad Gateway", 503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    """
+    Answered to the client as a JSON error with its status code.
+    """
+
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.headers = list(headers)
+
+
+class Request:
+    """
+    A parsed HTTP request, its body not read yet.
+    """
+
+    __slots__ = ("method", "path", "query", "headers")
+
+    def __init__(self, method, path, query, headers):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+
+    def param(self, name, default=None):
+        values = self.query.get(name)
+        return values[0] if values else default
+
+
+async def read_request(reader):
+    """
+    Reads the request line and the headers of a request.
+
+    Returns:
+    Request: The request, or None when the client closed the connection.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(400, "The request headers are too large.")
+
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Invalid request line.")
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+    url = urlsplit(target)
+    return Request(method.upper(), url.path, parse_qs(url.query), headers)
+
+
+async def read_body(reader, request, max_bytes):
+    """
+    Reads the body of a request, refusing bodies larger than max_bytes.
+    """
+    if "chunked" in request.headers.get("transfer-encoding", "").lower():
+        raise HTTPError(411, "Send the body with a Content-Length.")
+    try:
+        length = int(request.headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(400, "Invalid Content-Length.")
+    if length > max_bytes:
+        raise HTTPError(413, f"The body is larger than {max_bytes} bytes.")
+    return await reader.readexactly(length) if length else b""
+
+
+def _head(status, headers):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+    lines += [f"{name}: {value}" for name, value in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_json(writer, status, payload, headers=()):
+    body = json.dumps(payload).encode("utf-8")
+    writer.write(_head(status, [("Content-Type", "application/json"),
+                                ("Content-Length", len(body)),
+                                ("Connection", "close"), *headers]) + body)
+    await writer.drain()
+
+
+class EventStream:
+    """
+    Server-sent events written to a client.
+
+    Waiting for the socket to drain after every event applies the client's
+    backpressure. A client that went away only stops the events: its
+    complaint still runs to the end and is stored.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.open = True
+
+    async def start(self):
+        self.writer.write(_head(200, [("Content-Type", "text/event-stream"),
+                                      ("Cache-Control", "no-cache"),
+                                      ("Connection", "close")]))
+        await self._drain()
+
+    async def send(self, event, data):
+        if not self.open:
+            return
+        self.writer.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+        await self._drain()
+
+    async def _drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.open = False
+
+
+def _audio_extension(name, content_type=None):
+    extension = os.path.splitext(name or "")[1].lower()
+    if not extension and content_type:
+        extension = mimetypes.guess_extension(content_type.split(";")[0].strip()) or ""
+    if extension not in pipeline.AUDIO_EXTENSIONS:
+        raise HTTPError(415, f"Unsupported audio format '{extension or content_type}', "
+                             f"expected one of {pipeline.AUDIO_EXTENSIONS}.")
+    return extension
+
+
+def parse_hosts(value):
+    """
+    Parses a comma-separated list of host names, such as
+    SERVICE_AUDIO_URL_HOSTS.
+    """
+    return frozenset(host.strip().lower() for host in (value or "").split(",") if host.strip())
+
+
+def check_audio_url(audio_url, allowed_hosts):
+    """
+    Refuses an audio_url that is not http(s) or points outside allowed_hosts.
+
+    Raises:
+    HTTPError: 400 for an invalid URL, 403 for a host that is not allowed.
+    """
+    parts = urlsplit(audio_url)
+    if parts.scheme.lower() not in AUDIO_URL_SCHEMES or not parts.hostname:
+        raise HTTPError(400, f"Invalid audio_url '{audio_url}', expected an http(s) URL.")
+    if parts.hostname.lower() not in allowed_hosts:
+        raise HTTPError(403, f"Downloads from '{parts.hostname}' are not allowed.")
+
+
+def _too_large(max_bytes):
+    return HTTPError(413, f"The recording is larger than {max_bytes} bytes.")
+
+
+async def _download_audio(audio_url, max_bytes, allowed_hosts):
+    client = get_async_http_session()
+    # Redirects are followed by hand, so that every hop is checked.
+    for _ in range(MAX_REDIRECTS + 1):
+        check_audio_url(audio_url, allowed_hosts)
+        async with client.stream("GET", audio_url, follow_redirects=False) as response:
+            if response.is_redirect:
+                audio_url = str(response.url.join(response.headers["location"]))
+                continue
+            response.raise_for_status()
+            length = response.headers.get("content-length", "")
+            if length.isdigit() and int(length) > max_bytes:
+                raise _too_large(max_bytes)
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > max_bytes:
+                    raise _too_large(max_bytes)
+                chunks.append(chunk)
+            return b"".join(chunks)
+    raise HTTPError(502, f"Too many redirects downloading {audio_url}.")
+
+
+def _write_audio(path, audio_bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(audio_bytes)
+
+
+class ComplaintService:
+    """
+    Runs complaints posted over HTTP through the async pipeline.
+
+    Parameters:
+        categories_meta (CategoryCatalog): The categories, see
+                                           main.read_categories().
+        output_root (str): Directory receiving one folder per complaint and
+                           the classification.jsonl store.
+        mode (str): Default pipeline mode, overridden by ?mode=.
+        max_concurrency (int): Complaints running at once.
+        max_queue (int): Complaints waiting for a slot before new ones are
+                         turned away.
+        max_upload_bytes (int): Largest recording accepted.
+        audio_url_hosts (iterable): Hosts audio_url may download from. Empty
+                                    turns audio_url off.
+        retry_after (int): Seconds callers are told to wait when turned away.
+    """
+
+    def __init__(self, categories_meta, output_root="output/service", mode="full",
+                 image_sample_rate=0.0, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_queue=DEFAULT_MAX_QUEUE, max_upload_bytes=DEFAULT_MAX_UPLOAD_BYTES,
+                 retry_after=DEFAULT_RETRY_AFTER, audio_url_hosts=()):
+        self.categories_meta = categories_meta
+        self.output_root = output_root
+        self.mode = mode
+        self.image_sample_rate = image_sample_rate
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_upload_bytes = max_upload_bytes
+        self.retry_after = retry_after
+        self.audio_url_hosts = frozenset(host.lower() for host in audio_url_hosts)
+        self.store = ClassificationStore(os.path.join(output_root, "classification.jsonl"))
+        # Created in serve(), on the service's event loop.
+        self.slots = None
+        self.waiting = 0
+        self.running = 0
+        self.finished = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def health(self):
+        return {"status": "ok", "running": self.running, "waiting": self.waiting,
+                "max_concurrency": self.max_concurrency, "max_queue": self.max_queue,
+                "finished": self.finished, "failed": self.failed,
+                "rejected": self.rejected}
+
+    def _admit(self):
+        # Complaints beyond the free slots wait, up to max_queue of them.
+        if self.running + self.waiting >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            raise HTTPError(503, "Too many complaints in progress, retry later.",
+                            headers=[("Retry-After", self.retry_after)])
+        self.waiting += 1
+
+    async def handle(self, reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is not None:
+                await self.route(request, reader, writer)
+        except HTTPError as e:
+            try:
+                await send_json(writer, e.status, {"error": str(e)}, e.headers)
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, request, reader, writer):
+        if request.path == "/health":
+            if request.method != "GET":
+                raise HTTPError(405, "Use GET.")
+            await send_json(writer, 200, self.health())
+            return
+        if request.path != "/complaints":
+            raise HTTPError(404, f"No such endpoint {request.path}.")
+        if request.method != "POST":
+            raise HTTPError(405, "Use POST.")
+
+        mode = request.param("mode", self.mode)
+        if mode not in pipeline.MODES:
+            raise HTTPError(400, f"Unknown mode '{mode}', expected one of {pipeline.MODES}.")
+        self._admit()
+        try:
+            job = await self._read_complaint(request, reader, mode)
+        except BaseException:
+            self.waiting -= 1
+            raise
+        await self._run(job, EventStream(writer))
+
+    async def _read_complaint(self, request, reader, mode):
+        body = await read_body(reader, request, self.max_upload_bytes)
+        content_type = request.headers.get("content-type", "")
+        complaint_id = request.param("id") or uuid.uuid4().hex[:12]
+        if posixpath.basename(complaint_id) != complaint_id or complaint_id.startswith("."):
+            raise HTTPError(400, f"Invalid complaint id '{complaint_id}'.")
+
+        if content_type.startswith("application/json"):
+            try:
+                audio_url = json.loads(body).get("audio_url")
+            except (ValueError, AttributeError):
+                audio_url = None
+            if not isinstance(audio_url, str):
+                raise HTTPError(400, "The JSON body has no 'audio_url' string.")
+            if not self.audio_url_hosts:
+                raise HTTPError(403, "audio_url is disabled, set SERVICE_AUDIO_URL_HOSTS "
+                                     "to the hosts recordings may be downloaded from.")
+            check_audio_url(audio_url, self.audio_url_hosts)
+            extension = _audio_extension(urlsplit(audio_url).path)
+            try:
+                body = await ratelimit.call_async(None, None, _download_audio, audio_url,
+                                                  self.max_upload_bytes, self.audio_url_hosts)
+            except HTTPError:
+                raise
+            except Exception as e:
+                raise HTTPError(502, f"Could not download {audio_url}: {e}")
+        else:
+            extension = _audio_extension(request.param("filename"), content_type)
+        if not body:
+            raise HTTPError(400, "The recording is empty.")
+
+        output_dir = os.path.join(self.output_root, complaint_id)
+        audio_path = os.path.join(output_dir, "audio" + extension)
+        await asyncio.to_thread(_write_audio, audio_path, body)
+        return pipeline.new_job(audio_path, output_dir, self.categories_meta,
+                                complaint_id=complaint_id, mode=mode,
+                                image_sample_rate=self.image_sample_rate)
+
+    async def _run(self, job, events):
+        start = time.perf_counter()
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            await events.start()
+            await events.send("accepted", {"id": job["id"], "mode": job["mode"]})
+            job = await self._run_stages(job, events)
+            classification = await asyncio.to_thread(pipeline.finish_job, job, self.store)
+        except Exception as e:
+            self.failed += 1
+            print(f"Failed to process complaint {job['id']}: {e}")
+            await events.send("error", {"id": job["id"],
+                                        "error": f"{type(e).__name__}: {e}"})
+            return
+        finally:
+            self.running -= 1
+            self.slots.release()
+        self.finished += 1
+        await events.send("done", {"id": job["id"], "classification": classification,
+                                   "seconds": round(time.perf_counter() - start, 3)})
+
+    async def _run_stages(self, job, events):
+        with tracing.complaint(job["id"]), tracing.span("complaint", mode=job["mode"]):
+            for name, stage in pipeline.pipeline_stages(job["mode"], use_async=True):
+                before = {field: job.get(field) for field in RESULT_FIELDS}
+                job = await stage(job)
+                # Only the results this stage added or changed are sent.
+                results = {field: job[field] for field in RESULT_FIELDS
+                           if job.get(field) is not None and job.get(field) != before[field]}
+                await events.send("stage", {"id": job["id"], "stage": name, **results})
+        return job
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        """
+        Serves requests until cancelled, then closes the pooled clients.
+        """
+        self.slots = asyncio.Semaphore(self.max_concurrency)
+        server = await asyncio.start_server(self.handle, host, port,
+                                            limit=MAX_HEADER_BYTES)
+        print(f"Serving complaints on http://{host}:{port} "
+              f"({self.max_concurrency} at once, {self.max_queue} waiting).")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await close_async_clients()
+
+
+def service_from_env(categories_meta, output_root="output/service", mode="full"):
+    """
+    Creates the service with the limits set by SERVICE_MAX_CONCURRENCY,
+    SERVICE_MAX_QUEUE, SERVICE_MAX_UPLOAD_BYTES and SERVICE_RETRY_AFTER.
+    """
+    return ComplaintService(
+        categories_meta, output_root=output_root, mode=mode,
+        image_sample_rate=float(os.getenv("SERVICE_IMAGE_SAMPLE_RATE", 0.0)),
+        max_concurrency=int(os.getenv("SERVICE_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+        max_queue=int(os.getenv("SERVICE_MAX_QUEUE", DEFAULT_MAX_QUEUE)),
+        max_upload_bytes=int(os.getenv("SERVICE_MAX_UPLOAD_BYTES", DEFAULT_MAX_UPLOAD_BYTES)),
+        retry_after=int(os.getenv("SERVICE_RETRY_AFTER", DEFAULT_RETRY_AFTER)),
+        audio_url_hosts=parse_hosts(os.getenv("SERVICE_AUDIO_URL_HOSTS")))
+
+
+# Example Usage (for testing purposes, remove/comment when deploying):
+if __name__ == "__main__":
+    from dotenv import load_dotenv, find_dotenv
+    dotenv_path = find_dotenv()
+    load_dotenv(dotenv_path)
+
+    parser = argparse.ArgumentParser(description="Serve the complaint pipeline over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--output", default="output/service",
+                        help="directory receiving one folder per complaint")
+    parser.add_argument("--mode", choices=pipeline.MODES, default="full",
+                        help="default pipeline mode, overridden by ?mode=")
+    args = parser.parse_args()
+
+    categories_meta = pipeline.read_categories()
+    if categories_meta is not None:
+        service = service_from_env(categories_meta, output_root=args.output, mode=args.mode)
+        try:
+            asyncio.run(service.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,165 @@
+# store.py
+
+import argparse
+import csv
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process are coordinated.
+    fcntl = None
+
+# Columns of the classification CSV written by compact().
+CSV_COLUMNS = ['product', 'category', 'subcategory']
+
+
+class ClassificationStore:
+    """
+    Append-only store of classification results, kept as one JSON object per
+    line.
+
+    Adding a result writes a single line at the end of the file, so it costs
+    the same whatever the size of the store. Many threads and processes can
+    append at the same time: every row is written with one O_APPEND write
+    while holding a shared lock, and compact() takes the lock exclusively
+    while it rewrites the file.
+
+    Parameters:
+        path (str): Path to the JSONL file.
+    """
+
+    def __init__(self, path="output/classification.jsonl"):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self._thread_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _locked(self, exclusive):
+        return _FileLock(self.lock_path, exclusive, self._thread_lock)
+
+    def append(self, classification_obj, complaint_id=None, **fields):
+        """
+        Appends a classification result.
+
+        Parameters:
+            classification_obj (dict): The product, category and subcategory.
+            complaint_id (str): Identifier of the complaint, used by compact()
+                                to keep only its latest result.
+            fields: Extra columns stored with the row.
+        """
+        row = dict(classification_obj)
+        row.update(fields)
+        if complaint_id is not None:
+            row["complaint_id"] = complaint_id
+        row.setdefault("created_at", time.time())
+        line = (json.dumps(row) + "\n").encode("utf-8")
+
+        with self._locked(exclusive=False):
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def rows(self):
+        """
+        Yields the stored rows in the order they were appended. A line left
+        incomplete by a crashed writer is skipped.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def compact(self, csv_path=None):
+        """
+        Rewrites the store keeping only the latest row of every complaint,
+        and optionally exports it as a classification CSV.
+
+        Parameters:
+            csv_path (str): Where to write the CSV, with the same columns as
+                            output/classification.txt. Skipped when None.
+
+        Returns:
+        int: The number of rows left in the store.
+        """
+        with self._locked(exclusive=True):
+            latest = {}
+            for index, row in enumerate(self.rows()):
+                latest[row.get("complaint_id", index)] = row
+            rows = list(latest.values())
+
+            _atomic_write(self.path, "".join(json.dumps(row) + "\n" for row in rows))
+
+        if csv_path is not None:
+            export_csv(rows, csv_path)
+        return len(rows)
+
+
+class _FileLock:
+    # Holds an flock on a lock file that is never replaced, so appenders
+    # and compaction agree on it even after the data file was rewritten.
+
+    def __init__(self, path, exclusive, thread_lock):
+        self.path = path
+        self.exclusive = exclusive
+        self.thread_lock = thread_lock
+        self.fd = None
+
+    def __enter__(self):
+        if self.exclusive:
+            self.thread_lock.acquire()
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+        if self.exclusive:
+            self.thread_lock.release()
+
+
+def _atomic_write(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+    with os.fdopen(fd, "w", encoding="utf-8", newline="") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def export_csv(rows, csv_path):
+    """
+    Writes classification rows to a CSV with the product, category and
+    subcategory columns.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(csv_path) or ".")
+    with os.fdopen(fd, "w", encoding="utf-8", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS, extrasaction="ignore",
+                                lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, csv_path)
+
+
+# Example Usage (for testing purposes, remove/comment when deploying):
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact a classification store.")
+    parser.add_argument("store", nargs="?", default="output/classification.jsonl")
+    parser.add_argument("--csv", default="output/classification.txt",
+                        help="CSV file to export the compacted rows to")
+    args = parser.parse_args()
+
+    count = ClassificationStore(args.store).compact(csv_path=args.csv)
+    print(f"Compacted {args.store} to {count} row(s), exported to {args.csv}")
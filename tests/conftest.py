@@ -0,0 +1,8 @@
+# conftest.py
+
+import os
+import sys
+
+# The modules of the pipeline sit at the root of the repository, next to
+# main.py, and are imported from there as the scripts themselves do.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
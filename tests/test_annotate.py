@@ -0,0 +1,38 @@
+# test_annotate.py
+
+import numpy as np
+from annotate import normalize_boxes
+
+SHAPE = (100, 200, 3)
+
+
+def test_boxes_are_sorted_rounded_and_clamped():
+    boxes, kept = normalize_boxes([[50.4, 80, 10, 20], [-10, -10, 300, 300]], SHAPE)
+    assert boxes.dtype == np.int32
+    assert boxes.tolist() == [[10, 20, 50, 80], [0, 0, 199, 99]]
+    assert kept.tolist() == [0, 1]
+
+
+def test_point_pairs_and_arrays_are_accepted():
+    expected = [[1, 2, 30, 40]]
+    assert normalize_boxes([[[1, 2], [30, 40]]], SHAPE)[0].tolist() == expected
+    assert normalize_boxes(np.array([[1, 2, 30, 40]]), SHAPE)[0].tolist() == expected
+
+
+def test_invalid_boxes_are_dropped_with_their_indices():
+    boxes, kept = normalize_boxes([
+        [1, 2, 3],                 # Three numbers.
+        [10, 10, 20, 20],
+        ["a", 1, 2, 3],            # Not numbers.
+        [5, 5, float("nan"), 9],   # Not finite.
+        [300, 10, 400, 20],        # Outside the image.
+        [7, 7, 7, 30],             # No width.
+    ], SHAPE)
+    assert boxes.tolist() == [[10, 10, 20, 20]]
+    assert kept.tolist() == [1]
+
+
+def test_no_boxes():
+    boxes, kept = normalize_boxes([], SHAPE)
+    assert boxes.shape == (0, 4)
+    assert kept.size == 0
@@ -0,0 +1,37 @@
+# test_batch_ids.py
+
+import pytest
+import main
+from main import complaint_ids
+
+
+def test_ids_are_file_names_without_extension():
+    assert complaint_ids(["audio/a.mp3", "audio/b.wav"]) == ["a", "b"]
+
+
+def test_files_sharing_a_name_keep_their_extension():
+    assert complaint_ids(main.list_audio_files("audio")) == [
+        "sample_complaint_audio_mp3", "sample_complaint_audio_mp4"]
+    assert complaint_ids(["x/call.MP4", "x/call.m4a", "x/other.mp3"]) == [
+        "call_mp4", "call_m4a", "other"]
+
+
+@pytest.mark.parametrize("audio_files", [
+    ["a/call.mp3", "b/call.mp3"],
+    ["call.mp3", "call.wav", "call_mp3.wav"],
+])
+def test_clashing_ids_raise(audio_files):
+    with pytest.raises(ValueError):
+        complaint_ids(audio_files)
+
+
+def test_a_batch_with_clashing_ids_processes_nothing(tmp_path, monkeypatch):
+    for folder in ("a", "b"):
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "call.mp3").write_bytes(b"")
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("a/call.mp3\nb/call.mp3\n")
+    monkeypatch.setattr(main, "pipeline_stages", lambda mode: [])
+    with pytest.raises(ValueError):
+        main.run_batch(str(manifest), output_root=str(tmp_path / "output"))
+    assert not (tmp_path / "output" / "call").exists()
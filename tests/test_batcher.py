@@ -0,0 +1,33 @@
+# test_batcher.py
+
+import pytest
+import main
+
+
+@pytest.fixture(autouse=True)
+def batch_size(monkeypatch):
+    monkeypatch.setenv("CLASSIFY_BATCH_SIZE", "10")
+    main.stage_batcher.cache_clear()
+    yield
+    main.stage_batcher.cache_clear()
+
+
+def test_batches_are_capped_at_the_classify_workers():
+    assert main.stage_batcher(4).batch_size == 4
+    assert main.stage_batcher(32).batch_size == 10
+    assert main.stage_batcher(1) is None
+
+
+def test_complaints_are_only_batched_inside_run_batch(monkeypatch, tmp_path):
+    assert main.current_batcher() is None
+    seen = []
+
+    def stage(job):
+        seen.append(main.current_batcher().batch_size)
+        return job
+
+    monkeypatch.setattr(main, "pipeline_stages", lambda mode: [("classify", stage)])
+    monkeypatch.setattr(main, "finish_job", lambda job, store: {})
+    main.run_batch("audio", output_root=str(tmp_path), max_workers=2)
+    assert seen == [2, 2]
+    assert main.current_batcher() is None
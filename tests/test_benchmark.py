@@ -0,0 +1,14 @@
+# test_benchmark.py
+
+import pytest
+import benchmark
+
+INSTANT = {name: "fixed:0.01" for name in ("chat", "audio", "images", "download")}
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_classify_scenario_runs_against_the_mock_server(use_async):
+    rows = benchmark.benchmark(scenarios=["classify"], concurrency_levels=[2], requests=3,
+                               latencies=INSTANT, use_async=use_async)
+    assert [(row["name"], row["calls"], row["errors"]) for row in rows] == [
+        ("classify", 3, 0)]
@@ -0,0 +1,61 @@
+# test_cache.py
+
+import os
+import time
+from cache import StageCache
+
+
+def _age(cache, key, seconds_ago):
+    # Backdates an entry, as if it was last used seconds_ago.
+    when = time.time() - seconds_ago
+    os.utime(cache._path(key), (when, when))
+
+
+def test_put_and_get_round_trip(tmp_path):
+    cache = StageCache(str(tmp_path))
+    key = cache.key("stage", "input")
+    assert cache.get(key) is None
+    cache.put_text(key, "result")
+    assert cache.get_text(key) == "result"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_keys_depend_on_stage_and_part_boundaries(tmp_path):
+    cache = StageCache(str(tmp_path))
+    assert cache.key("a", "x") != cache.key("b", "x")
+    assert cache.key("a", "ab", "c") != cache.key("a", "a", "bc")
+    assert cache.key("a", {"x": 1, "y": 2}) == cache.key("a", {"y": 2, "x": 1})
+
+
+def test_overwrite_does_not_count_twice(tmp_path):
+    cache = StageCache(str(tmp_path), max_bytes=1000)
+    key = cache.key("stage", "input")
+    for _ in range(5):
+        cache.put(key, b"x" * 300)
+    assert cache._size == 300
+    assert cache.get(key) == b"x" * 300
+
+
+def test_eviction_drops_least_recently_used_down_to_low_water(tmp_path):
+    cache = StageCache(str(tmp_path), max_bytes=1000, low_water=0.5)
+    keys = [cache.key("stage", str(i)) for i in range(4)]
+    for age, key in zip((40, 30, 20, 10), keys):
+        cache.put(key, b"x" * 300)
+        _age(cache, key, age)
+    # The fourth put went past the cap: the oldest entries go until the
+    # cache holds at most 500 bytes.
+    assert [cache.get(key) is not None for key in keys] == [False, False, False, True]
+    assert cache._size == 300
+
+
+def test_eviction_keeps_recently_read_entries(tmp_path):
+    cache = StageCache(str(tmp_path), max_bytes=700, low_water=0.9)
+    old, middle = cache.key("stage", "old"), cache.key("stage", "middle")
+    cache.put(old, b"x" * 300)
+    _age(cache, old, 20)
+    cache.put(middle, b"x" * 300)
+    _age(cache, middle, 10)
+    cache.get(old)  # Now the most recently used.
+    cache.put(cache.key("stage", "new"), b"x" * 300)
+    assert cache.get(old) is not None
+    assert cache.get(middle) is None
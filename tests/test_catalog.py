@@ -0,0 +1,63 @@
+# test_catalog.py
+
+import json
+import pytest
+import prompt_prefix
+from catalog import CategoryCatalog, normalize, snap_classification
+
+CATEGORIES = {
+    "Electronics": ["Audio & Headphones", "Cameras & Photography"],
+    "Toys & Games": ["Rubber Ducks", "Board Games"],
+    "Sports": ["Board Sports"],
+}
+
+
+@pytest.fixture
+def catalog():
+    return CategoryCatalog(CATEGORIES)
+
+
+def test_normalize_folds_case_ampersands_and_punctuation():
+    assert normalize("Audio & Headphones") == normalize("audio and headphones!")
+
+
+@pytest.mark.parametrize("category, subcategory, expected", [
+    ("Electronics", "Audio & Headphones", ("Electronics", "Audio & Headphones")),
+    ("electronics", "audio and headphones", ("Electronics", "Audio & Headphones")),
+    ("Electronics", "Audio & Headphone", ("Electronics", "Audio & Headphones")),
+    # A subcategory filed under the wrong category, unique in the catalog.
+    ("Electronics", "Rubber Ducks", ("Toys & Games", "Rubber Ducks")),
+    ("Gardening", "Lawn Mowers", None),
+    (None, "Rubber Ducks", None),
+])
+def test_snap(catalog, category, subcategory, expected):
+    assert catalog.snap(category, subcategory) == expected
+
+
+def test_snap_classification_leaves_unmatched_replies(catalog):
+    msg = json.dumps({"product": "mower", "category": "Garden", "subcategory": "Mowers"})
+    assert snap_classification(msg, catalog) == msg
+    assert snap_classification("not json", catalog) == "not json"
+
+
+@pytest.mark.parametrize("categories", [
+    {}, {"Toys": []}, {"Toys": ["Ducks", "ducks"]}, {"Toys": ["A"], "toys": ["B"]},
+])
+def test_invalid_taxonomies_are_rejected(categories):
+    with pytest.raises(ValueError):
+        CategoryCatalog(categories)
+
+
+def test_prompt_forms(catalog):
+    assert catalog.prompt().splitlines()[0] == \
+        "Electronics: Audio & Headphones | Cameras & Photography"
+    assert json.loads(catalog.prompt(verbose=True)) == CATEGORIES
+    assert catalog.prompt() is catalog.prompt()
+
+
+def test_cacheable_keeps_the_verbose_form_only_when_it_reaches_the_cache():
+    short = "x" * (prompt_prefix.CACHE_MIN_TOKENS * prompt_prefix.CHARS_PER_TOKEN - 4)
+    long = short + "x" * 8
+    assert prompt_prefix.cacheable(short, long) == long
+    assert prompt_prefix.cacheable(long, long + "y") == long
+    assert prompt_prefix.cacheable("abc", "abcdef") == "abc"
@@ -0,0 +1,11 @@
+# test_extract_audio.py
+
+import os
+from extract_audio import DEFAULT_OUTPUT_SUBDIR, audio_output_path
+
+
+def test_audio_goes_to_its_own_folder_by_default():
+    assert audio_output_path(os.path.join("calls", "call.mp4")) == \
+        os.path.join("calls", DEFAULT_OUTPUT_SUBDIR, "call.m4a")
+    assert audio_output_path(os.path.join("calls", "call.mov"), "recordings", "mp3") == \
+        os.path.join("recordings", "call.mp3")
@@ -0,0 +1,100 @@
+# test_gpt_batch.py
+
+import json
+from types import SimpleNamespace
+import pytest
+import gpt
+import replies
+
+CATEGORIES = json.dumps({"Toys": ["Rubber Ducks", "Board Games"],
+                         "Kitchen": ["Blenders", "Toasters"]})
+
+
+def _reply(content):
+    message = SimpleNamespace(content=content, refusal=None)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def _classification(complaint_id=None):
+    item = {"product": "duck", "category": "Toys", "subcategory": "Rubber Ducks"}
+    if complaint_id is not None:
+        item["id"] = complaint_id
+    return item
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    """
+    Replaces the chat completions of gpt.py, answering batches through
+    chat.batch(ids) and single classifications with a valid reply.
+    """
+    fake = SimpleNamespace(requests=[], batch=None)
+
+    def call(pool, operation, messages, **kwargs):
+        fake.requests.append(kwargs)
+        prompt = messages[-1]["content"][0]["text"]
+        if prompt.startswith("Complaints"):
+            ids = list(json.loads(prompt.split("\n", 2)[2]))
+            return _reply(fake.batch(ids))
+        return _reply(json.dumps(_classification()))
+
+    monkeypatch.setattr(gpt.routing, "call", call)
+    monkeypatch.delenv("GPT_RESPONSE_FORMAT", raising=False)
+    return fake
+
+
+def test_parse_batch_accepts_wrapped_list_and_keyed_object():
+    wrapped = json.dumps({"classifications": [_classification("1"), _classification("9")]})
+    assert list(gpt.parse_batch_classification(wrapped, ["1", "2"])) == ["1"]
+    bare = json.dumps([_classification("2")])
+    assert list(gpt.parse_batch_classification(bare, ["1", "2"])) == ["2"]
+    keyed = json.dumps({"1": _classification()})
+    assert list(gpt.parse_batch_classification(keyed, ["1"])) == ["1"]
+    assert gpt.parse_batch_classification("no json here", ["1"]) == {}
+
+
+def test_parse_batch_snaps_to_the_catalog():
+    item = dict(_classification("1"), category="toys", subcategory="rubber duck")
+    results = gpt.parse_batch_classification(json.dumps([item]), ["1"],
+                                             gpt.as_catalog(CATEGORIES))
+    assert (results["1"]["category"], results["1"]["subcategory"]) == ("Toys", "Rubber Ducks")
+
+
+def test_split_batches_respects_size_and_token_budget():
+    descriptions = {str(i): "x" * 40 for i in range(5)}
+    assert gpt.split_batches(descriptions, batch_size=2) == [["0", "1"], ["2", "3"], ["4"]]
+    assert gpt.split_batches(descriptions, batch_size=10, max_prompt_tokens=25) == \
+        [["0", "1"], ["2", "3"], ["4"]]
+
+
+def test_dropped_complaints_are_resubmitted(chat):
+    replies_left = [["1"], ["2"]]
+    chat.batch = lambda ids: json.dumps(
+        {"classifications": [_classification(i) for i in replies_left.pop(0)]})
+    stats = gpt.BatchStats()
+    results = gpt.classify_batch_with_gpt({"1": "a", "2": "b"}, CATEGORIES, stats=stats)
+    assert sorted(results) == ["1", "2"]
+    assert (stats.requests, stats.resubmitted, stats.failed) == (2, 1, 0)
+
+
+def test_failed_batch_falls_back_without_losing_other_batches(chat):
+    def batch(ids):
+        if "bad" in ids:
+            raise RuntimeError("deployment down")
+        return json.dumps({"classifications": [_classification(i) for i in ids]})
+
+    chat.batch = batch
+    stats = gpt.BatchStats()
+    descriptions = {"1": "a", "2": "b", "bad": "c", "3": "d"}
+    results = gpt.classify_batch_with_gpt(descriptions, CATEGORIES, batch_size=2,
+                                          stats=stats)
+    assert sorted(results) == ["1", "2", "3", "bad"]
+    assert stats.fallbacks == 2
+
+
+def test_batches_ask_for_json_when_configured(chat, monkeypatch):
+    chat.batch = lambda ids: json.dumps({"classifications": [_classification(i) for i in ids]})
+    monkeypatch.setenv("GPT_RESPONSE_FORMAT", "json_schema")
+    gpt.classify_batch_with_gpt({"1": "a"}, CATEGORIES)
+    schema = chat.requests[-1]["response_format"]["json_schema"]["schema"]
+    assert schema == replies.BATCH_CLASSIFICATION_SCHEMA
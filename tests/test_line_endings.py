@@ -0,0 +1,29 @@
+# test_line_endings.py
+
+import os
+import subprocess
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHECKED = (".py", ".md", ".json")
+
+
+def _tracked_files():
+    try:
+        output = subprocess.run(["git", "ls-files"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("Not a git checkout.")
+    # The sample outputs are written by the pipeline as they come.
+    return [path for path in output.splitlines()
+            if path.endswith(CHECKED) and not path.startswith("output/")]
+
+
+def test_tracked_text_files_use_crlf():
+    bare = []
+    for path in _tracked_files():
+        with open(os.path.join(ROOT, path), "rb") as file:
+            data = file.read()
+        if data.count(b"\n") != data.count(b"\r\n"):
+            bare.append(path)
+    assert bare == [], f"Files with LF line endings: {bare}"
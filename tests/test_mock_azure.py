@@ -0,0 +1,42 @@
+# test_mock_azure.py
+
+import pytest
+import gpt
+from catalog import CategoryCatalog
+from gpt import BatchStats
+from mock_azure import MockAzureServer
+
+CATEGORIES = {"Toys & Games": ["Rubber Ducks"], "Electronics": ["Cameras & Photography"]}
+INSTANT = {name: "fixed:0" for name in ("chat", "audio", "images", "download")}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.delenv("GPT_ENDPOINTS", raising=False)
+    monkeypatch.delenv("GPT_RESPONSE_FORMAT", raising=False)
+    with MockAzureServer(INSTANT, categories=CATEGORIES) as server:
+        yield server
+
+
+def _deployment(server):
+    return dict(gpt_api_version="2024-06-01", gpt_api_key="mock-key",
+                gpt_endpoint=server.url, gpt_deployment_name="gpt")
+
+
+def test_classify_with_gpt(server):
+    reply = gpt.classify_with_gpt("A rubber duck with a hole.", CategoryCatalog(CATEGORIES),
+                                 **_deployment(server))
+    assert gpt.Classification.parse(reply).to_dict() == {
+        "product": "Rubber duck", "category": "Toys & Games", "subcategory": "Rubber Ducks"}
+
+
+def test_classify_batch_with_gpt(server):
+    stats = BatchStats()
+    descriptions = {f"c{i}": f"Complaint number {i} about a duck." for i in range(5)}
+    results = gpt.classify_batch_with_gpt(descriptions, CategoryCatalog(CATEGORIES), batch_size=3,
+                                          stats=stats, **_deployment(server))
+    assert sorted(results) == sorted(descriptions)
+    assert {result["subcategory"] for result in results.values()} == {"Rubber Ducks"}
+    # Every complaint was classified by its batch, none one by one.
+    assert stats.fallbacks == 0
+    assert server.requests["chat"] == 2
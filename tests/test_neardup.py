@@ -0,0 +1,48 @@
+# test_neardup.py
+
+import pytest
+from neardup import NearDuplicateIndex, distance, fingerprint
+
+COMPLAINT = ("The rubber duck I ordered last week arrived with a split seam "
+             "and it sinks as soon as it touches the water")
+
+
+@pytest.fixture
+def index(tmp_path):
+    return NearDuplicateIndex(str(tmp_path / "near_duplicates.jsonl"), max_distance=3)
+
+
+def test_find_matches_a_near_duplicate(index):
+    index.add("c1", fingerprint(COMPLAINT), classification={"category": "Toys & Games"})
+    match = index.find(fingerprint(COMPLAINT.replace("last week", "last week,")))
+    assert match["id"] == "c1"
+    assert match["distance"] == 0
+    assert match["classification"] == {"category": "Toys & Games"}
+
+
+def test_find_picks_the_closest(index):
+    value = fingerprint(COMPLAINT)
+    index.add("far", value ^ 0b111)
+    index.add("near", value ^ 0b1)
+    assert index.find(value)["id"] == "near"
+
+
+def test_find_ignores_fingerprints_beyond_max_distance(index):
+    value = fingerprint(COMPLAINT)
+    index.add("c1", value ^ 0b1111)
+    assert index.find(value) is None
+    assert distance(value, value ^ 0b1111) == 4
+
+
+def test_find_reads_lines_appended_by_other_processes(index):
+    other = NearDuplicateIndex(index.path, max_distance=3)
+    other.add("c1", fingerprint(COMPLAINT))
+    assert index.find(fingerprint(COMPLAINT))["id"] == "c1"
+    assert len(index) == 1
+
+
+def test_short_transcriptions_are_not_accepted(index):
+    assert not index.accepts("")
+    assert not index.accepts(None)
+    assert not index.accepts("yes thank you")
+    assert index.accepts(COMPLAINT)
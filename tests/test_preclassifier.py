@@ -0,0 +1,48 @@
+# test_preclassifier.py
+
+import json
+from preclassifier import PreClassifier, tokenize
+
+CATEGORIES = {
+    "Toys": ["Rubber Ducks", "Board Games"],
+    "Kitchen": ["Blenders", "Toasters"],
+}
+KEYWORDS = {"Toys": {"Rubber Ducks": ["rubber duck", "bath toy"]}}
+
+
+def test_tokenize_drops_stop_words_and_adds_bigrams():
+    assert tokenize("The ducks are in the bath") == ["duck", "bath", "duck bath"]
+
+
+def test_predict_matches_keywords():
+    preclassifier = PreClassifier(CATEGORIES, keywords=KEYWORDS)
+    prediction = preclassifier.predict("A yellow rubber duck with a hole in it.")
+    assert (prediction["category"], prediction["subcategory"]) == ("Toys", "Rubber Ducks")
+    assert prediction["product"] == "rubber duck"
+    assert preclassifier.is_confident(prediction)
+
+
+def test_learning_is_off_by_default():
+    preclassifier = PreClassifier(CATEGORIES)
+    classification = json.dumps({"category": "Kitchen", "subcategory": "Toasters"})
+    preclassifier.classify("Burnt crumpets everywhere", CATEGORIES, lambda *a, **k: classification)
+    assert preclassifier._learned == [0, 0, 0, 0]
+
+
+def test_learning_is_capped_per_pair():
+    preclassifier = PreClassifier(CATEGORIES, learn_limit=2)
+    results = [preclassifier.learn(f"crumpet {i}", "Kitchen", "Toasters") for i in range(3)]
+    assert results == [True, True, False]
+    assert not preclassifier.learn("crumpet", "Kitchen", "Kettles")
+
+
+def test_learned_terms_are_refit_in_batches():
+    preclassifier = PreClassifier(CATEGORIES, learn_limit=10, refit_every=3)
+    preclassifier.learn("crumpet crumpet", "Kitchen", "Toasters")
+    # Not refit yet: the new term is ignored rather than misaligning the matrix.
+    assert preclassifier.predict("crumpet")["score"] == 0
+    preclassifier.learn("crumpet", "Kitchen", "Toasters")
+    preclassifier.learn("crumpet bread", "Kitchen", "Toasters")
+    prediction = preclassifier.predict("crumpet")
+    assert (prediction["category"], prediction["subcategory"]) == ("Kitchen", "Toasters")
+    assert prediction["score"] > 0
@@ -0,0 +1,85 @@
+# test_ratelimit.py
+
+from types import SimpleNamespace
+import pytest
+import ratelimit
+from ratelimit import DeploymentLimiter, TokenBucket
+
+
+class ServerError(Exception):
+    status_code = 500
+    response = None
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ratelimit, "backoff_delay", lambda attempt, error: 0.0)
+    monkeypatch.setattr(ratelimit, "_limiters", {})
+
+
+def test_bucket_waits_for_the_refill():
+    bucket = TokenBucket(60)  # One token a second.
+    assert bucket.reserve(60, now=bucket.updated) == 0
+    assert bucket.reserve(3, now=bucket.updated) == pytest.approx(3.0)
+    # Two seconds later, one token is still owed.
+    assert bucket.reserve(0, now=bucket.updated + 2) == pytest.approx(1.0)
+
+
+def test_bucket_refill_is_capped_and_scaled():
+    bucket = TokenBucket(60)
+    start = bucket.updated
+    bucket.reserve(0, now=start + 3600)
+    assert bucket.tokens == 60
+    bucket.reserve(60, now=start + 3600)
+    assert bucket.reserve(0, now=start + 3610, rate_scale=0.5) == 0
+    assert bucket.tokens == pytest.approx(5.0)
+
+
+def test_settle_gives_back_unused_tokens():
+    limiter = DeploymentLimiter(tpm=1000)
+    limiter.reserve(400)
+    limiter.settle(400, 100)
+    assert limiter.tokens.tokens == pytest.approx(900, abs=1)
+
+
+def test_throttle_pauses_and_lowers_the_rate():
+    limiter = DeploymentLimiter(rpm=60)
+    limiter.throttle(5.0)
+    assert limiter.rate_scale == ratelimit.RATE_DECREASE
+    assert limiter.reserve() == pytest.approx(5.0, abs=0.1)
+    limiter.succeeded()
+    assert limiter.rate_scale == pytest.approx(ratelimit.RATE_DECREASE + ratelimit.RATE_INCREASE)
+
+
+def test_failed_attempts_refund_their_tokens():
+    ratelimit.configure("endpoint", "deployment", tpm=1000)
+    failures = [ServerError(), ServerError()]
+
+    def fn():
+        if failures:
+            raise failures.pop()
+        return SimpleNamespace(usage=SimpleNamespace(total_tokens=300))
+
+    ratelimit.call("endpoint", "deployment", fn, tokens=300)
+    tokens = ratelimit.get_limiter("endpoint", "deployment").tokens.tokens
+    assert tokens == pytest.approx(700, abs=1)
+
+
+def test_final_errors_are_raised_with_their_tokens_refunded():
+    ratelimit.configure("endpoint", "deployment", tpm=1000)
+
+    def fn():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        ratelimit.call("endpoint", "deployment", fn, tokens=300)
+    tokens = ratelimit.get_limiter("endpoint", "deployment").tokens.tokens
+    assert tokens == pytest.approx(1000, abs=1)
+
+
+def test_estimate_tokens_counts_text_images_and_the_reply():
+    messages = [{"role": "system", "content": "x" * 40},
+                {"role": "user", "content": [
+                    {"type": "text", "text": "y" * 8},
+                    {"type": "image_url", "image_url": {"url": "data:", "detail": "low"}}]}]
+    assert ratelimit.estimate_tokens(messages, 100) == 100 + 11 + 3 + 85
@@ -0,0 +1,49 @@
+# test_replies.py
+
+import pytest
+import replies
+from replies import Classification, ReplyError, extract_json, response_format_args
+
+
+@pytest.mark.parametrize("text", [
+    '{"a": 1}',
+    '```json\n{"a": 1}\n```',
+    'Here is the result: {"a": 1} as requested.',
+    'Not {json} but {"a": 1}',
+])
+def test_extract_json_skips_fences_and_prose(text):
+    assert extract_json(text) == {"a": 1}
+
+
+def test_extract_json_accepts_other_openers():
+    assert extract_json('The list: [1, 2]', openers="[{") == [1, 2]
+
+
+@pytest.mark.parametrize("text", [None, "", "no json here", '{"a": '])
+def test_extract_json_raises_reply_error(text):
+    with pytest.raises(ReplyError):
+        extract_json(text)
+
+
+def test_classification_needs_every_field():
+    with pytest.raises(ReplyError):
+        Classification.parse('{"product": "Duck", "category": "Toys & Games"}')
+
+
+def test_response_format_defaults_to_text(monkeypatch):
+    monkeypatch.delenv("GPT_RESPONSE_FORMAT", raising=False)
+    assert response_format_args("classification", replies.CLASSIFICATION_SCHEMA) == {}
+
+
+def test_response_formats_are_opt_in(monkeypatch):
+    monkeypatch.setenv("GPT_RESPONSE_FORMAT", "json_object")
+    assert response_format_args("classification", replies.CLASSIFICATION_SCHEMA) == {
+        "response_format": {"type": "json_object"}}
+
+    monkeypatch.setenv("GPT_RESPONSE_FORMAT", "json_schema")
+    args = response_format_args("classification", replies.CLASSIFICATION_SCHEMA)
+    assert args["response_format"]["json_schema"]["strict"] is True
+
+    monkeypatch.setenv("GPT_RESPONSE_FORMAT", "xml")
+    with pytest.raises(ValueError):
+        response_format_args("classification", replies.CLASSIFICATION_SCHEMA)
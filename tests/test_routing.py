@@ -0,0 +1,80 @@
+# test_routing.py
+
+import pytest
+import routing
+from routing import CLOSED, HALF_OPEN, OPEN, EndpointPool, Target
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+@pytest.fixture(autouse=True)
+def no_pauses(monkeypatch):
+    monkeypatch.setattr(routing, "_paused_until", lambda target: 0.0)
+
+
+def _pool(cooldown=0.0, count=2):
+    targets = [Target(f"https://e{i}.example.com/", "key", "v", "gpt") for i in range(count)]
+    return EndpointPool(targets, breaker_failures=2, cooldown=cooldown)
+
+
+def _fail(pool, target, error):
+    # As if acquire() had picked it.
+    target.outstanding += 1
+    pool.release(target, 1.0, error)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    pool = _pool(cooldown=60.0)
+    target = pool.targets[0]
+    _fail(pool, target, StatusError(500))
+    assert target.state == CLOSED
+    _fail(pool, target, StatusError(500))
+    assert target.state == OPEN
+    assert all(pool.acquire() is pool.targets[1] for _ in range(5))
+
+
+def test_checks_do_not_turn_the_breaker_half_open():
+    pool = _pool()
+    target = pool.targets[0]
+    _fail(pool, target, StatusError(500))
+    _fail(pool, target, StatusError(500))
+    assert pool.has_alternative(pool.targets[1])
+    assert target.state == OPEN
+
+
+def test_probe_closes_or_reopens_the_breaker():
+    pool = _pool(count=1)
+    target = pool.targets[0]
+    _fail(pool, target, StatusError(500))
+    _fail(pool, target, StatusError(500))
+
+    assert pool.acquire() is target
+    assert target.state == HALF_OPEN
+    pool.release(target, 1.0, StatusError(503))
+    assert target.state == OPEN
+
+    pool.acquire()
+    pool.release(target, 1.0)
+    assert target.state == CLOSED
+    assert target.failures == 0
+
+
+@pytest.mark.parametrize("error, state", [
+    (StatusError(429), OPEN),
+    (StatusError(400), CLOSED),
+    (KeyboardInterrupt(), OPEN),
+])
+def test_probe_never_stays_half_open(error, state):
+    pool = _pool(count=1)
+    target = pool.targets[0]
+    _fail(pool, target, StatusError(500))
+    _fail(pool, target, StatusError(500))
+    pool.acquire()
+    assert target.state == HALF_OPEN
+    pool.release(target, 1.0, error)
+    assert target.state == state
+    assert target.outstanding == 0
@@ -0,0 +1,70 @@
+# test_service_download.py
+
+import asyncio
+import httpx
+import pytest
+import service
+from service import HTTPError, check_audio_url, parse_hosts
+
+HOSTS = parse_hosts("Recordings.example.com, cdn.example.com")
+
+
+def _serve(monkeypatch, handler):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(service, "get_async_http_session", lambda: client)
+
+
+def _download(url, max_bytes=100):
+    return asyncio.run(service._download_audio(url, max_bytes, HOSTS))
+
+
+def test_parse_hosts():
+    assert HOSTS == {"recordings.example.com", "cdn.example.com"}
+    assert parse_hosts(None) == frozenset()
+
+
+@pytest.mark.parametrize("url, status", [
+    ("file:///etc/passwd", 400),
+    ("ftp://recordings.example.com/a.wav", 400),
+    ("http://169.254.169.254/latest/meta-data", 403),
+    ("http://localhost:8080/a.wav", 403),
+])
+def test_check_audio_url_refuses(url, status):
+    with pytest.raises(HTTPError) as e:
+        check_audio_url(url, HOSTS)
+    assert e.value.status == status
+
+
+def test_download_streams_allowed_host(monkeypatch):
+    _serve(monkeypatch, lambda request: httpx.Response(200, content=b"RIFF"))
+    assert _download("https://recordings.example.com/a.wav") == b"RIFF"
+
+
+def test_download_refuses_large_content_length(monkeypatch):
+    _serve(monkeypatch, lambda request: httpx.Response(
+        200, headers={"content-length": "1000"}, content=b"x" * 1000))
+    with pytest.raises(HTTPError) as e:
+        _download("https://recordings.example.com/a.wav")
+    assert e.value.status == 413
+
+
+def test_download_aborts_stream_past_limit(monkeypatch):
+    async def chunks():
+        for _ in range(10):
+            yield b"x" * 50
+        raise AssertionError("The download should have stopped.")
+    _serve(monkeypatch, lambda request: httpx.Response(200, content=chunks()))
+    with pytest.raises(HTTPError) as e:
+        _download("https://recordings.example.com/a.wav")
+    assert e.value.status == 413
+
+
+def test_download_checks_redirects(monkeypatch):
+    def handler(request):
+        if request.url.host == "recordings.example.com":
+            return httpx.Response(302, headers={"location": "http://169.254.169.254/a.wav"})
+        return httpx.Response(200, content=b"secret")
+    _serve(monkeypatch, handler)
+    with pytest.raises(HTTPError) as e:
+        _download("https://recordings.example.com/a.wav")
+    assert e.value.status == 403
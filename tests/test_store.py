@@ -0,0 +1,42 @@
+# test_store.py
+
+import json
+from store import ClassificationStore
+
+DUCK = {"product": "Duck", "category": "Toys & Games", "subcategory": "Rubber Ducks"}
+CAMERA = {"product": "Camera", "category": "Electronics",
+          "subcategory": "Cameras & Photography"}
+
+
+def test_compact_keeps_the_latest_row_of_every_complaint(tmp_path):
+    store = ClassificationStore(str(tmp_path / "classification.jsonl"))
+    store.append(CAMERA, complaint_id="a")
+    store.append(CAMERA, complaint_id="b")
+    store.append(DUCK, complaint_id="a", path="full")
+    store.append(DUCK)
+    store.append(DUCK)
+
+    assert store.compact() == 4
+    rows = list(store.rows())
+    assert [(row.get("complaint_id"), row["product"]) for row in rows] == [
+        ("a", "Duck"), ("b", "Camera"), (None, "Duck"), (None, "Duck")]
+    assert rows[0]["path"] == "full"
+    # Compacting again changes nothing.
+    assert store.compact() == 4
+
+
+def test_compact_skips_torn_lines_and_exports_csv(tmp_path):
+    store = ClassificationStore(str(tmp_path / "classification.jsonl"))
+    store.append(DUCK, complaint_id="a")
+    with open(store.path, "a", encoding="utf-8") as file:
+        file.write('{"product": "Cam')
+    csv_path = tmp_path / "classification.txt"
+
+    assert store.compact(csv_path=str(csv_path)) == 1
+    assert [json.loads(line)["complaint_id"] for line in open(store.path)] == ["a"]
+    assert csv_path.read_text() == "product,category,subcategory\nDuck,Toys & Games,Rubber Ducks\n"
+
+
+def test_compact_of_a_missing_store(tmp_path):
+    store = ClassificationStore(str(tmp_path / "classification.jsonl"))
+    assert store.compact() == 0
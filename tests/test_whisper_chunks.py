@@ -0,0 +1,58 @@
+# test_whisper_chunks.py
+
+import pytest
+from whisper import plan_chunks, stitch_transcripts
+
+# Silences of a 42.66 s recording, as media.detect_silences() reports them.
+SILENCES = [(5.0, 5.5), (12.0, 13.0), (25.0, 26.0), (38.0, 39.0)]
+
+
+def _cuts(chunks, overlap_seconds):
+    # The cut points between chunks, overlap removed.
+    return [round(start + overlap_seconds, 6) for start, _ in chunks[1:]]
+
+
+def test_short_recording_is_one_chunk():
+    assert plan_chunks(42.66, SILENCES, chunk_seconds=300) == [(0.0, 42.66)]
+
+
+def test_cuts_land_on_silences():
+    chunks = plan_chunks(42.66, SILENCES, chunk_seconds=20, overlap_seconds=1,
+                         search_seconds=10)
+    assert _cuts(chunks, 1) == [12.5, 25.5]
+    assert chunks[-1][0] + chunks[-1][1] == pytest.approx(42.66)
+
+
+@pytest.mark.parametrize("chunk_seconds", [1, 5, 10, 30])
+def test_chunks_shorter_than_the_search_window_terminate(chunk_seconds):
+    chunks = plan_chunks(42.66, SILENCES, chunk_seconds=chunk_seconds, overlap_seconds=0)
+    starts = [start for start, _ in chunks]
+    assert starts == sorted(set(starts))
+    assert all(length >= chunk_seconds / 2 for _, length in chunks[:-1])
+    assert sum(length for _, length in chunks) == pytest.approx(42.66)
+
+
+def test_non_positive_chunks_are_rejected():
+    with pytest.raises(ValueError):
+        plan_chunks(42.66, SILENCES, chunk_seconds=0)
+
+
+def test_stitch_drops_the_repeated_words():
+    stitched = stitch_transcripts(["I bought a rubber duck last week.",
+                                   "duck last week. It has a hole."])
+    assert stitched == "I bought a rubber duck last week. It has a hole."
+
+
+def test_stitch_keeps_the_punctuation_of_the_cut():
+    stitched = stitch_transcripts(["It arrived broken and",
+                                   "arrived broken and, frankly, useless."])
+    assert stitched == "It arrived broken and, frankly, useless."
+
+
+def test_stitch_keeps_a_single_repeated_word():
+    assert stitch_transcripts(["I want the", "the refund please."]) == \
+        "I want the the refund please."
+
+
+def test_stitch_skips_empty_transcripts():
+    assert stitch_transcripts(["", "Hello there.", "  ", "Bye."]) == "Hello there. Bye."
@@ -0,0 +1,66 @@
+# test_workqueue.py
+
+import pytest
+from workqueue import DONE, FAILED, QUEUED, LeaseLost, WorkQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    assert queue.enqueue({"id": "c1", "audio_path": "c1.mp3"})
+    assert not queue.enqueue({"id": "c1", "audio_path": "./c1.mp3"})
+    return queue
+
+
+def test_an_id_queued_for_another_file_is_refused(queue):
+    with pytest.raises(ValueError):
+        queue.enqueue({"id": "c1", "audio_path": "other/c1.mp3"})
+    assert queue.counts() == {QUEUED: 1}
+
+
+def test_enqueue_batch_queues_files_sharing_a_name(tmp_path):
+    import main
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"))
+    assert main.enqueue_batch("audio", queue, output_root=str(tmp_path / "batch")) == 2
+    assert main.enqueue_batch("audio", queue, output_root=str(tmp_path / "batch")) == 0
+
+
+def test_a_leased_complaint_is_not_leased_again(queue):
+    lease = queue.lease("w1", 60)
+    assert (lease.complaint_id, lease.state, lease.next_stage, lease.attempts) == \
+        ("c1", QUEUED, 0, 1)
+    assert queue.lease("w2", 60) is None
+
+
+def test_an_expired_lease_resumes_after_the_last_checkpoint(queue):
+    queue.lease("w1", 60)
+    # The worker checkpoints its first stage with a lease that has already
+    # run out, as if it died right after.
+    queue.checkpoint("c1", "w1", 1, "transcribed", {"id": "c1", "transcription": "hi"}, -1)
+
+    lease = queue.lease("w2", 60)
+    assert (lease.state, lease.next_stage, lease.attempts) == ("transcribed", 1, 2)
+    assert lease.job["transcription"] == "hi"
+
+
+def test_the_previous_owner_loses_the_lease(queue):
+    queue.lease("w1", -1)
+    queue.lease("w2", 60)
+    with pytest.raises(LeaseLost):
+        queue.checkpoint("c1", "w1", 1, "transcribed", {"id": "c1"}, 60)
+    with pytest.raises(LeaseLost):
+        queue.complete("c1", "w1")
+    queue.complete("c1", "w2")
+    assert queue.counts() == {DONE: 1}
+
+
+def test_failed_complaints_can_be_retried(queue):
+    queue.lease("w1", 60)
+    queue.release("c1", "w1", "boom", give_up=True)
+    assert queue.failures() == [("c1", "boom")]
+    assert queue.lease("w1", 60) is None
+
+    assert queue.retry_failed() == 1
+    assert queue.counts() == {QUEUED: 1}
+    assert queue.lease("w1", 60).attempts == 1
+    assert FAILED not in queue.counts()
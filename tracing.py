@@ -0,0 +1,386 @@
+# tracing.py
+
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # OpenTelemetry export is optional.
+    otel_trace = None
+
+# Structured spans of the pipeline.
+#
+# main.py opens a span for every stage of every complaint, and the stage
+# modules open one around every SDK call, recording the deployment and the
+# token usage of the reply. The HTTP clients of clients.py report every
+# request they send to the innermost span, so SDK spans also hold the number
+# of attempts (retries included), the status codes and the payload sizes.
+#
+# Tracing is opt-in. Finished spans are appended to the JSONL file set by
+# PIPELINE_TRACE_FILE, one object per line, and sent to OpenTelemetry when
+# it is installed and PIPELINE_TRACE_OTEL is set.
+
+# Where the summary command reads spans from when PIPELINE_TRACE_FILE is unset.
+DEFAULT_TRACE_FILE = os.path.join("output", "traces.jsonl")
+
+RUN_ID = uuid.uuid4().hex[:16]
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_complaint_id = contextvars.ContextVar("complaint_id", default=None)
+
+
+class Span:
+    """
+    A timed operation, with the complaint it belongs to and free-form
+    attributes.
+    """
+
+    def __init__(self, name, parent=None, complaint_id=None, **attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.complaint_id = complaint_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, name, value):
+        """
+        Adds value to a numeric attribute.
+        """
+        with self._lock:
+            self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def record_usage(self, response):
+        """
+        Records the token usage of an SDK reply, when it reports one,
+        including the prompt tokens served from the server's prompt cache.
+        """
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        for field in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            value = getattr(usage, field, None)
+            if value is not None:
+                self.add(field, value)
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None)
+        if cached is not None:
+            self.add("cached_tokens", cached)
+
+    def to_dict(self):
+        return {
+            "run_id": RUN_ID,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "complaint_id": self.complaint_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """
+    Writes finished spans to a JSONL file and, optionally, to OpenTelemetry.
+
+    Parameters:
+        path (str): JSONL file receiving the spans, or None to skip it.
+        otel (bool): Also export spans through the OpenTelemetry API.
+    """
+
+    def __init__(self, path=DEFAULT_TRACE_FILE, otel=False):
+        self.path = path
+        self.otel = otel_trace.get_tracer("complaint-pipeline") if otel and otel_trace else None
+        self._lock = threading.Lock()
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def export(self, span):
+        if self.path:
+            line = json.dumps(span.to_dict(), default=str) + "\n"
+            with self._lock:
+                with open(self.path, "a") as file:
+                    file.write(line)
+
+
+@lru_cache(maxsize=None)
+def get_tracer():
+    """
+    Returns the tracer configured by the PIPELINE_TRACE_FILE and
+    PIPELINE_TRACE_OTEL environment variables, or None when neither is set
+    and tracing is off.
+    """
+    path = os.getenv("PIPELINE_TRACE_FILE")
+    otel = bool(os.getenv("PIPELINE_TRACE_OTEL"))
+    if not path and not otel:
+        return None
+    return Tracer(path or None, otel=otel)
+
+
+def current_span():
+    return _current_span.get()
+
+
+@contextmanager
+def complaint(complaint_id):
+    """
+    Tags the spans opened inside the block with a complaint id.
+    """
+    token = _complaint_id.set(complaint_id)
+    try:
+        yield
+    finally:
+        _complaint_id.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the block as a span nested in the current one.
+
+    Yields:
+    Span: The span, to add attributes to. When tracing is off the span is
+          still created, but never exported.
+    """
+    tracer = get_tracer()
+    current = Span(name, _current_span.get(), _complaint_id.get(), **attributes)
+    token = _current_span.set(current)
+    otel_context = otel_span = None
+    if tracer is not None and tracer.otel is not None:
+        otel_context = tracer.otel.start_as_current_span(name)
+        otel_span = otel_context.__enter__()
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        if otel_span is not None:
+            # OpenTelemetry attributes only take scalars and lists of them.
+            otel_span.set_attributes({
+                key: value for key, value in dict(
+                    current.attributes, complaint_id=current.complaint_id).items()
+                if isinstance(value, (str, bool, int, float, list))
+            })
+            if current.error:
+                otel_span.set_status(otel_trace.Status(
+                    otel_trace.StatusCode.ERROR, current.error))
+            otel_context.__exit__(None, None, None)
+        if tracer is not None:
+            tracer.export(current)
+
+
+def traced_stage(name, stage):
+    """
+    Wraps a stage of main.py, a function or coroutine function taking and
+    returning a job dict, in a span named "stage.<name>" tagged with the
+    job's complaint id.
+    """
+    if asyncio.iscoroutinefunction(stage):
+        @functools.wraps(stage)
+        async def traced_async(job):
+            with complaint(job["id"]), span(f"stage.{name}"):
+                return await stage(job)
+        return traced_async
+
+    @functools.wraps(stage)
+    def traced(job):
+        with complaint(job["id"]), span(f"stage.{name}"):
+            return stage(job)
+    return traced
+
+
+def run_in_context(fn):
+    """
+    Wraps fn so it runs in a copy of the caller's context, keeping the
+    current span and complaint id when fn is handed to a thread pool.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+
+# HTTP hooks, installed on the clients of clients.py. Every request, retries
+# included, is counted on the innermost span.
+
+
+def _content_length(headers):
+    try:
+        return int(headers.get("content-length", 0))
+    except ValueError:
+        return 0
+
+
+def on_request(request):
+    current = _current_span.get()
+    if current is not None:
+        current.add("attempts", 1)
+        current.add("request_bytes", _content_length(request.headers))
+
+
+def on_response(response):
+    current = _current_span.get()
+    if current is not None:
+        current.add("response_bytes", _content_length(response.headers))
+        with current._lock:
+            current.attributes.setdefault("status_codes", []).append(response.status_code)
+
+
+async def on_request_async(request):
+    on_request(request)
+
+
+async def on_response_async(response):
+    on_response(response)
+
+
+def event_hooks(use_async=False):
+    """
+    Returns the httpx event hooks reporting requests to the current span.
+    """
+    if use_async:
+        return {"request": [on_request_async], "response": [on_response_async]}
+    return {"request": [on_request], "response": [on_response]}
+
+
+# Summary of a trace file.
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def read_spans(path=DEFAULT_TRACE_FILE, run_id=None):
+    """
+    Reads the spans of a trace file, skipping lines cut short by a crash.
+
+    Parameters:
+        run_id (str): Only keep the spans of this run.
+
+    Returns:
+    list: The span dicts.
+    """
+    spans = []
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if run_id is None or record.get("run_id") == run_id:
+                spans.append(record)
+    return spans
+
+
+def summarize(spans):
+    """
+    Aggregates spans by name.
+
+    Returns:
+    list: One dict per span name with its count, errors, duration
+          percentiles, mean attempts, total tokens and cached prompt
+          tokens, slowest first.
+    """
+    groups = {}
+    for record in spans:
+        groups.setdefault(record["name"], []).append(record)
+
+    rows = []
+    for name, records in groups.items():
+        durations = [r["duration"] for r in records if r.get("duration") is not None]
+        if not durations:
+            continue
+        attributes = [r.get("attributes") or {} for r in records]
+        attempts = [a["attempts"] for a in attributes if "attempts" in a]
+        rows.append({
+            "name": name,
+            "count": len(records),
+            "errors": sum(1 for r in records if r.get("status") == "error"),
+            "p50": _percentile(durations, 0.50),
+            "p95": _percentile(durations, 0.95),
+            "p99": _percentile(durations, 0.99),
+            "total": sum(durations),
+            "attempts": sum(attempts) / len(attempts) if attempts else None,
+            "prompt_tokens": sum(a.get("prompt_tokens", 0) for a in attributes),
+            "completion_tokens": sum(a.get("completion_tokens", 0) for a in attributes),
+            "cached_tokens": sum(a.get("cached_tokens", 0) for a in attributes),
+        })
+    rows.sort(key=lambda row: row["total"], reverse=True)
+    return rows
+
+
+def slowest_complaints(spans, count=5):
+    """
+    Returns the complaints whose stages took the longest in total, as
+    (complaint id, seconds, {stage: seconds}) tuples.
+    """
+    totals = {}
+    for record in spans:
+        if not record["name"].startswith("stage.") or record.get("duration") is None:
+            continue
+        stages = totals.setdefault(record.get("complaint_id"), {})
+        stage = record["name"][len("stage."):]
+        stages[stage] = stages.get(stage, 0.0) + record["duration"]
+    ranked = sorted(((complaint_id, sum(stages.values()), stages)
+                     for complaint_id, stages in totals.items()),
+                    key=lambda item: item[1], reverse=True)
+    return ranked[:count]
+
+
+def print_summary(path=DEFAULT_TRACE_FILE, run_id=None, slowest=5):
+    spans = read_spans(path, run_id)
+    print(f"{len(spans)} span(s) in {path}.")
+    print(f"{'span':<28}{'count':>7}{'errors':>7}{'p50 s':>9}{'p95 s':>9}"
+          f"{'p99 s':>9}{'total s':>10}{'attempts':>9}{'prompt tok':>11}{'cached tok':>11}"
+          f"{'compl tok':>10}")
+    for row in summarize(spans):
+        attempts = "-" if row["attempts"] is None else f"{row['attempts']:.2f}"
+        print(f"{row['name']:<28}{row['count']:>7}{row['errors']:>7}{row['p50']:>9.3f}"
+              f"{row['p95']:>9.3f}{row['p99']:>9.3f}{row['total']:>10.1f}{attempts:>9}"
+              f"{row['prompt_tokens']:>11}{row['cached_tokens']:>11}"
+              f"{row['completion_tokens']:>10}")
+
+    if slowest:
+        print("\nSlowest complaints:")
+        for complaint_id, seconds, stages in slowest_complaints(spans, slowest):
+            breakdown = ", ".join(f"{stage} {value:.2f}s" for stage, value in stages.items())
+            print(f"  {complaint_id}: {seconds:.2f}s ({breakdown})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize pipeline traces.")
+    parser.add_argument("path", nargs="?",
+                        default=os.getenv("PIPELINE_TRACE_FILE") or DEFAULT_TRACE_FILE,
+                        help="JSONL trace file")
+    parser.add_argument("--run", metavar="RUN_ID", help="only summarize one run")
+    parser.add_argument("--slowest", type=int, default=5,
+                        help="number of slowest complaints to list")
+    args = parser.parse_args()
+    print_summary(args.path, run_id=args.run, slowest=args.slowest)
@@ -1,122 +1,586 @@
 # vision.py
 
 import os
-from openai import AzureOpenAI
+import asyncio
 from mimetypes import guess_type
 import base64
 import cv2
+import numpy as np
 import json
+from functools import lru_cache
+import tracing
+import ratelimit
+import routing
+import prompt_prefix
+import replies
+from replies import Description
+from image_profile import ImageProfile, VISION_FORMATS
+from catalog import as_catalog
+import annotate
 
-# Function to describe the generated image and annotate issues
-def describe_image(image_path, complaint, annotated_image_path,
-                   gpt_api_version=None, gpt_api_key=None,
-                   gpt_endpoint=None,gpt_deployment_name=None):
-    """
-    Describes an image and identifies key visual elements related to the customer complaint.
-
-    Returns:
-    str: A description of the image, including the annotated details.
-    """
 
+def _check_credentials(gpt_api_version, gpt_api_key, gpt_endpoint,
+                       gpt_deployment_name):
     if not gpt_api_version or not gpt_api_key \
        or not gpt_endpoint or not gpt_deployment_name:
         raise ValueError(
             "Azure OpenAI GPT credentials not set. "
             "Make sure GPT settings are defined."
         )
-    
-    # Load the generated image.
-    data_url = local_image_to_data_url(image_path)
 
-    # Call the model to describe the image and identify key elements.   
-    system_prompt = "You are a helpful assistant"
 
-    prompt = """Respond with a JSON string that is formatted as follows:
+SYSTEM_PROMPT = "You are a helpful assistant"
+
+# Instructions of the vision prompts, sent ahead of the complaint and the
+# image so every call starts with the same bytes (see prompt_prefix.py).
+DESCRIPTION_FORMAT = """Respond with a JSON string that is formatted as follows:
 
 {
     "message": [your response message],
     "bounding_box": [x1,y1,x2,y2] #bounding box localizing the reported issue
 }
 Start and end with json, no additional text.
+"""
+
+DESCRIPTION_CLASSIFICATION_FORMAT = """Respond with a JSON string that is formatted as follows:
+
+{
+    "message": [your response message],
+    "bounding_box": [x1,y1,x2,y2], #bounding box localizing the reported issue
+    "product": [product],
+    "category": [category],
+    "subcategory": [subcategory]
+}
+Start and end with json, no additional text.
+"""
+
+BOUNDING_BOX_INSTRUCTIONS = """
+Bounding boxes gives coordinates to annotate the customer issues with the product. Each coordinate is in (x,y) format, in pixels of the image, whose size is given with the issue. Each co-ordinate is represented as (x,y). (0,0) is the top-left point.
+
+Replace [your response message] with a description of the image."""
 
-Bounding boxes gives coordinates to annotate the customer issues with the product. Each coordinate is in (x,y) format. The image size is (width, height) = (1024x1024). Each co-ordinate is represented as (x,y). (0,0) is the top-left point.
-
-Replace [your response message] with a description of the image.
-
-Issue: """ + complaint
-
-    gptclient = AzureOpenAI(
-        api_version=gpt_api_version,
-        api_key=gpt_api_key,
-        azure_endpoint=gpt_endpoint
-    )
-
-    response = gptclient.chat.completions.create(
-        model=gpt_deployment_name,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": data_url}}
-                ]
-            }
-        ],
-        max_tokens=1024
-    )
-    msg = response.choices[0].message.content.replace("```json", "")
-    msg = msg.replace("```", "")
+DESCRIPTION_INSTRUCTIONS = (f"{SYSTEM_PROMPT}\n\n{DESCRIPTION_FORMAT}"
+                            f"{BOUNDING_BOX_INSTRUCTIONS}")
 
+
+@lru_cache(maxsize=16)
+def _description_classification_instructions(catalog):
+    # Built once per catalog, so the prefix is byte-identical on every call.
+    instructions = (f"{SYSTEM_PROMPT}\n\n{DESCRIPTION_CLASSIFICATION_FORMAT}"
+                    f"{BOUNDING_BOX_INSTRUCTIONS}\n\n"
+                    "Determine the product, category, and subcategory from the image and "
+                    "the issue. The list of categories and subcategories are available "
+                    "here, one category per line followed by its subcategories:\n\n")
+    return prompt_prefix.cacheable(f"{instructions}{catalog.prompt()}",
+                                   f"{instructions}{catalog.prompt(verbose=True)}")
+
+
+def _issue_message(data_url, complaint, image_size, detail):
+    # The part of the vision prompts that changes with every complaint.
+    image_url = {"url": data_url}
+    if detail is not None:
+        image_url["detail"] = detail
+    text = (f"The image size is (width, height) = ({image_size[0]}x{image_size[1]}).\n\n"
+            f"Issue: {complaint}")
+    return {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": text},
+            {"type": "image_url", "image_url": image_url}
+        ]
+    }
+
+
+def build_description_messages(data_url, complaint, image_size=(1024, 1024),
+                               detail=None):
+    """
+    Builds the chat messages asking the model to describe an image and
+    localize the reported issue: the instructions first, the complaint and
+    the image last.
+
+    Parameters:
+        image_size (tuple): (width, height) of the image sent, which the
+                            bounding box coordinates refer to.
+        detail (str): Vision detail level, or None for the model's default.
+
+    Returns:
+    list: The messages to send to the chat completions API.
+    """
+    return [
+        {"role": "system", "content": DESCRIPTION_INSTRUCTIONS},
+        _issue_message(data_url, complaint, image_size, detail),
+    ]
+
+
+def build_description_classification_messages(data_url, complaint, categories,
+                                              image_size=(1024, 1024), detail=None):
+    """
+    Builds the chat messages asking the model to describe an image, localize
+    the reported issue and classify the complaint, all in one reply.
+
+    Parameters:
+        categories (CategoryCatalog): The categories, or the text of the
+                                      categories metadata file.
+        image_size (tuple), detail (str): See build_description_messages().
+
+    Returns:
+    list: The messages to send to the chat completions API.
+    """
+    system_prompt = _description_classification_instructions(as_catalog(categories))
+    return [
+        {"role": "system", "content": system_prompt},
+        _issue_message(data_url, complaint, image_size, detail),
+    ]
+
+
+def split_description_classification(msg, categories):
+    """
+    Splits a combined reply into the description, as describe_image()
+    returns it, and the classification, as gpt.classify_with_gpt() returns
+    it, with its pair snapped to the categories.
+
+    Returns:
+    tuple: The description and classification JSON strings.
+    """
+    description, classification = replies.parse_description_classification(msg)
+    classification_obj = classification.to_dict()
+    as_catalog(categories).snap_classification(classification_obj)
+    return description.to_json(), json.dumps(classification_obj)
+
+
+def _annotate(msg, image, annotated_image_path=None):
     # Create annotated image
-    obj = json.loads(msg)
-    bb = obj["bounding_box"]
-    draw_bounding_boxes(image_path, [[[bb[0], bb[1]], [bb[2], bb[3]]]], annotated_image_path)
+    bb = Description.parse(msg).bounding_box
+    return draw_bounding_boxes(image, [[[bb[0], bb[1]], [bb[2], bb[3]]]],
+                               annotated_image_path)
+
+
+def _cached_description(cache, messages, gpt_deployment_name, stage="describe"):
+    # Returns the cache key and the cached reply (None on a miss, or when
+    # caching is off).
+    if cache is None:
+        return None, None
+    cache_key = cache.key(stage, messages, gpt_deployment_name)
+    return cache_key, cache.get_text(cache_key)
+
+
+def _vision_upload(image_bytes, mime_type, profile):
+    # Decodes the image once, for the annotation, and returns it with the
+    # data URL sent to the model and the size that URL's image has.
+    image = decode_image(image_bytes)
+    upload, upload_mime, upload_size = prepare_vision_image(image, image_bytes,
+                                                            mime_type, profile)
+    return image, image_to_data_url(upload, upload_mime), upload_size
+
+
+# Function to describe the generated image and annotate issues
+def describe_image(image_path, complaint, annotated_image_path,
+                   gpt_api_version=None, gpt_api_key=None,
+                   gpt_endpoint=None,gpt_deployment_name=None,
+                   cache=None, profile=None):
+    """
+    Describes an image and identifies key visual elements related to the customer complaint.
 
-    # Extract the description and return it.
+    Parameters:
+        cache (StageCache): Optional cache of descriptions, keyed by the
+                            prompt (image bytes and complaint included) and
+                            the deployment name. The annotated image is drawn
+                            again on a hit.
+        profile (ImageProfile): How the image is encoded and scaled for the
+                                model. Bounding boxes are always returned in
+                                the coordinates of the original image.
+
+    Returns:
+    str: A description of the image, including the annotated details.
+    """
+    # Load the generated image.
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+    msg, _ = describe_image_bytes(image_bytes, complaint, annotated_image_path,
+                                  gpt_api_version=gpt_api_version,
+                                  gpt_api_key=gpt_api_key,
+                                  gpt_endpoint=gpt_endpoint,
+                                  gpt_deployment_name=gpt_deployment_name,
+                                  cache=cache, mime_type=_mime_type(image_path),
+                                  profile=profile)
     return msg
 
-def local_image_to_data_url(image_path):
+
+def describe_image_bytes(image_bytes, complaint, annotated_image_path=None,
+                         gpt_api_version=None, gpt_api_key=None,
+                         gpt_endpoint=None, gpt_deployment_name=None,
+                         cache=None, mime_type="image/png", profile=None):
+    """
+    Describes an image held in memory, such as the bytes returned by
+    dalle.generate_image_bytes(), and annotates the reported issue on it.
+
+    The bytes are decoded once, to draw the annotation and, when the profile
+    asks for it, to downscale and re-encode the image sent to the model.
+    Nothing goes through the disk.
+
+    Parameters:
+        annotated_image_path (str): Where to write the annotated image, or
+                                    None to only return it.
+        cache (StageCache): Optional cache of descriptions, see describe_image().
+        mime_type (str): Type of the image bytes.
+        profile (ImageProfile): See describe_image().
+
+    Returns:
+    tuple: The description (str, as returned by describe_image()) and the
+           annotated image (a BGR NumPy array).
+    """
+    _check_credentials(gpt_api_version, gpt_api_key, gpt_endpoint,
+                       gpt_deployment_name)
+
+    profile = profile or ImageProfile()
+    image, data_url, upload_size = _vision_upload(image_bytes, mime_type, profile)
+    messages = build_description_messages(data_url, complaint, upload_size,
+                                          profile.detail)
+    cache_key, msg = _cached_description(cache, messages, gpt_deployment_name)
+
+    fresh = msg is None
+    if fresh:
+        # Call the model to describe the image and identify key elements.
+        gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                                   gpt_endpoint, gpt_deployment_name)
+
+        with tracing.span("vision.describe", deployment=gpt_deployment_name,
+                          image_url_bytes=len(data_url)) as span:
+            prompt_prefix.check(span.name, messages, gpt_deployment_name, span)
+            description = replies.call_parsed(
+                lambda: routing.call(
+                    gptpool, "chat.completions.create",
+                    messages=messages,
+                    max_tokens=1024,
+                    tokens=ratelimit.estimate_tokens(messages, 1024),
+                    **replies.response_format_args("description", replies.DESCRIPTION_SCHEMA)
+                ),
+                Description.parse, span)
+        msg = to_image_coordinates(description.to_json(), upload_size, image)
+
+    # Create the annotated image, then extract the description and return it.
+    annotated = _annotate(msg, image, annotated_image_path)
+    # Only cache replies that could be parsed and annotated.
+    if fresh and cache_key is not None:
+        cache.put_text(cache_key, msg)
+    return msg, annotated
+
+
+async def describe_image_async(image_path, complaint, annotated_image_path,
+                               gpt_api_version=None, gpt_api_key=None,
+                               gpt_endpoint=None, gpt_deployment_name=None,
+                               cache=None, profile=None):
+    """
+    Async version of describe_image() using the shared AsyncAzureOpenAI client.
+
+    Returns:
+    str: A description of the image, including the annotated details.
+    """
+    image_bytes = await asyncio.to_thread(_read_image, image_path)
+    msg, _ = await describe_image_bytes_async(
+        image_bytes, complaint, annotated_image_path,
+        gpt_api_version=gpt_api_version, gpt_api_key=gpt_api_key,
+        gpt_endpoint=gpt_endpoint, gpt_deployment_name=gpt_deployment_name,
+        cache=cache, mime_type=_mime_type(image_path), profile=profile)
+    return msg
+
+
+async def describe_image_bytes_async(image_bytes, complaint, annotated_image_path=None,
+                                     gpt_api_version=None, gpt_api_key=None,
+                                     gpt_endpoint=None, gpt_deployment_name=None,
+                                     cache=None, mime_type="image/png",
+                                     profile=None):
+    """
+    Async version of describe_image_bytes() using the shared AsyncAzureOpenAI
+    client.
+
+    Returns:
+    tuple: The description and the annotated image.
+    """
+    _check_credentials(gpt_api_version, gpt_api_key, gpt_endpoint,
+                       gpt_deployment_name)
+
+    profile = profile or ImageProfile()
+    image, data_url, upload_size = await asyncio.to_thread(
+        _vision_upload, image_bytes, mime_type, profile)
+    messages = build_description_messages(data_url, complaint, upload_size,
+                                          profile.detail)
+    cache_key, msg = await asyncio.to_thread(_cached_description, cache, messages,
+                                             gpt_deployment_name)
+
+    fresh = msg is None
+    if fresh:
+        gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                                   gpt_endpoint, gpt_deployment_name)
+        with tracing.span("vision.describe", deployment=gpt_deployment_name,
+                          image_url_bytes=len(data_url)) as span:
+            prompt_prefix.check(span.name, messages, gpt_deployment_name, span)
+            description = await replies.call_parsed_async(
+                lambda: routing.call_async(
+                    gptpool, "chat.completions.create",
+                    messages=messages,
+                    max_tokens=1024,
+                    tokens=ratelimit.estimate_tokens(messages, 1024),
+                    **replies.response_format_args("description", replies.DESCRIPTION_SCHEMA)
+                ),
+                Description.parse, span)
+        msg = to_image_coordinates(description.to_json(), upload_size, image)
+
+    annotated = await asyncio.to_thread(_annotate, msg, image, annotated_image_path)
+    # Only cache replies that could be parsed and annotated.
+    if fresh and cache_key is not None:
+        cache.put_text(cache_key, msg)
+    return msg, annotated
+
+
+# Combined mode: one call describes the image, localizes the issue and
+# classifies the complaint, instead of a description call followed by a
+# classification call that only sees the description.
+
+def describe_and_classify_image_bytes(image_bytes, complaint, categories,
+                                      annotated_image_path=None,
+                                      gpt_api_version=None, gpt_api_key=None,
+                                      gpt_endpoint=None, gpt_deployment_name=None,
+                                      cache=None, mime_type="image/png", profile=None):
+    """
+    Describes an image held in memory, annotates the reported issue on it
+    and classifies the complaint with a single chat completion.
+
+    Parameters:
+        categories (CategoryCatalog): The categories, see
+                                      build_description_classification_messages().
+        cache (StageCache): Optional cache of replies, keyed by the prompt
+                            (image bytes, complaint and categories included)
+                            and the deployment name.
+        annotated_image_path, mime_type, profile: See describe_image_bytes().
+
+    Returns:
+    tuple: The description (str, as returned by describe_image()), the
+           classification (str, as returned by gpt.classify_with_gpt()) and
+           the annotated image (a BGR NumPy array).
+    """
+    _check_credentials(gpt_api_version, gpt_api_key, gpt_endpoint,
+                       gpt_deployment_name)
+
+    profile = profile or ImageProfile()
+    image, data_url, upload_size = _vision_upload(image_bytes, mime_type, profile)
+    messages = build_description_classification_messages(
+        data_url, complaint, categories, upload_size, profile.detail)
+    cache_key, msg = _cached_description(cache, messages, gpt_deployment_name,
+                                         stage="describe_classify")
+
+    fresh = msg is None
+    if fresh:
+        gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                                   gpt_endpoint, gpt_deployment_name)
+
+        with tracing.span("vision.describe_classify", deployment=gpt_deployment_name,
+                          image_url_bytes=len(data_url)) as span:
+            prompt_prefix.check(span.name, messages, gpt_deployment_name, span)
+            description, classification = replies.call_parsed(
+                lambda: routing.call(
+                    gptpool, "chat.completions.create",
+                    messages=messages,
+                    max_tokens=1024,
+                    tokens=ratelimit.estimate_tokens(messages, 1024),
+                    **replies.response_format_args(
+                        "description_classification",
+                        replies.DESCRIPTION_CLASSIFICATION_SCHEMA)
+                ),
+                replies.parse_description_classification, span)
+        combined = dict(description.to_dict(), **classification.to_dict())
+        msg = to_image_coordinates(json.dumps(combined), upload_size, image)
+
+    description, classification = split_description_classification(msg, categories)
+    annotated = _annotate(description, image, annotated_image_path)
+    # Only cache replies that could be parsed and annotated.
+    if fresh and cache_key is not None:
+        cache.put_text(cache_key, msg)
+    return description, classification, annotated
+
+
+async def describe_and_classify_image_bytes_async(image_bytes, complaint, categories,
+                                                  annotated_image_path=None,
+                                                  gpt_api_version=None, gpt_api_key=None,
+                                                  gpt_endpoint=None,
+                                                  gpt_deployment_name=None,
+                                                  cache=None, mime_type="image/png",
+                                                  profile=None):
+    """
+    Async version of describe_and_classify_image_bytes() using the shared
+    AsyncAzureOpenAI client.
+
+    Returns:
+    tuple: The description, the classification and the annotated image.
+    """
+    _check_credentials(gpt_api_version, gpt_api_key, gpt_endpoint,
+                       gpt_deployment_name)
+
+    profile = profile or ImageProfile()
+    image, data_url, upload_size = await asyncio.to_thread(
+        _vision_upload, image_bytes, mime_type, profile)
+    messages = build_description_classification_messages(
+        data_url, complaint, categories, upload_size, profile.detail)
+    cache_key, msg = await asyncio.to_thread(_cached_description, cache, messages,
+                                             gpt_deployment_name, "describe_classify")
+
+    fresh = msg is None
+    if fresh:
+        gptpool = routing.get_pool("GPT", gpt_api_version, gpt_api_key,
+                                   gpt_endpoint, gpt_deployment_name)
+        with tracing.span("vision.describe_classify", deployment=gpt_deployment_name,
+                          image_url_bytes=len(data_url)) as span:
+            prompt_prefix.check(span.name, messages, gpt_deployment_name, span)
+            description, classification = await replies.call_parsed_async(
+                lambda: routing.call_async(
+                    gptpool, "chat.completions.create",
+                    messages=messages,
+                    max_tokens=1024,
+                    tokens=ratelimit.estimate_tokens(messages, 1024),
+                    **replies.response_format_args(
+                        "description_classification",
+                        replies.DESCRIPTION_CLASSIFICATION_SCHEMA)
+                ),
+                replies.parse_description_classification, span)
+        combined = dict(description.to_dict(), **classification.to_dict())
+        msg = to_image_coordinates(json.dumps(combined), upload_size, image)
+
+    description, classification = split_description_classification(msg, categories)
+    annotated = await asyncio.to_thread(_annotate, description, image,
+                                        annotated_image_path)
+    if fresh and cache_key is not None:
+        cache.put_text(cache_key, msg)
+    return description, classification, annotated
+
+
+def prepare_vision_image(image, image_bytes, mime_type, profile):
+    """
+    Returns the image to send to the vision model, downscaled and
+    re-encoded as the profile asks.
+
+    Parameters:
+        image (numpy.ndarray): The decoded image, or None when it could not
+                               be decoded, in which case it is sent as is.
+        image_bytes (bytes): The encoded image.
+
+    Returns:
+    tuple: The encoded image, its MIME type and its (width, height).
+    """
+    if image is None:
+        return image_bytes, mime_type, (1024, 1024)
+    height, width = image.shape[:2]
+    if not profile.reencodes():
+        return image_bytes, mime_type, (width, height)
+
+    max_side = profile.vision_max_side
+    if max_side and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+    extension, upload_mime = VISION_FORMATS[profile.vision_format or "png"]
+    params = []
+    if extension == ".jpg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, profile.vision_quality]
+    elif extension == ".webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, profile.vision_quality]
+    ok, encoded = cv2.imencode(extension, image, params)
+    if not ok:
+        raise RuntimeError(f"Could not encode the image as {extension}.")
+    # The encoded array's buffer is base64-encoded directly, without a copy.
+    return memoryview(encoded), upload_mime, (width, height)
+
+
+def to_image_coordinates(msg, upload_size, image):
+    """
+    Scales the bounding box of a description reply from the coordinates of
+    the image sent to the model to those of the original image.
+
+    Returns:
+    str: The reply, unchanged when both sizes are the same.
+    """
+    if image is None:
+        return msg
+    height, width = image.shape[:2]
+    if (width, height) == tuple(upload_size):
+        return msg
+    obj = replies.extract_json(msg)
+    scale_x = width / upload_size[0]
+    scale_y = height / upload_size[1]
+    x1, y1, x2, y2 = obj["bounding_box"]
+    obj["bounding_box"] = [round(x1 * scale_x), round(y1 * scale_y),
+                           round(x2 * scale_x), round(y2 * scale_y)]
+    return json.dumps(obj)
+
+def _mime_type(image_path):
     mime_type, _ = guess_type(image_path)
-    if mime_type is None:
-        mime_type = 'application/octet-stream'
+    return mime_type or 'application/octet-stream'
 
+def _read_image(image_path):
     with open(image_path, "rb") as image_file:
-        base64_encoded_data = base64.b64encode(
-            image_file.read()).decode('utf-8')
+        return image_file.read()
+
+def image_to_data_url(image_bytes, mime_type="image/png"):
+    """
+    Encodes image bytes (or any buffer, such as a memoryview) as a data URL.
+    """
+    base64_encoded_data = base64.b64encode(image_bytes).decode('ascii')
     return f"data:{mime_type};base64,{base64_encoded_data}"
 
-def draw_bounding_boxes(image_path, boxes, output_path):
+def local_image_to_data_url(image_path):
+    return image_to_data_url(_read_image(image_path), _mime_type(image_path))
+
+def decode_image(image_bytes):
+    """
+    Decodes encoded image bytes (PNG, JPEG...) into a BGR NumPy array, or
+    None when they are not a valid image.
+    """
+    return cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def save_image(output_path, image):
+    """
+    Writes a decoded image to a file, in the format of its extension.
+    """
+    return annotate.write_image(output_path, image)
+
+def draw_bounding_boxes(image, boxes, output_path=None, labels=None):
     """
     Draw bounding boxes on an image.
 
     Parameters:
-        image_path (str): Path to the input image.
+        image (str or numpy.ndarray): Path to the input image, or the image
+                                      already decoded. A decoded image is
+                                      left untouched; boxes go on a copy.
         boxes (list of lists): List of bounding boxes, where each box is defined by two points
-                               [[x1, y1], [x2, y2]].
-        output_path (str): Path to save the output image with bounding boxes.
+                               [[x1, y1], [x2, y2]]. Boxes are clamped to the
+                               image, and malformed ones skipped.
+        output_path (str): Path to save the output image with bounding boxes,
+                           or None to only return it.
+        labels (list): Optional text drawn with each box.
+
+    Returns:
+    numpy.ndarray: The image with the boxes drawn, or None when it could not
+                   be read.
     """
     # Load the image
-    image = cv2.imread(image_path)
+    from_path = isinstance(image, str)
+    if from_path:
+        image_path = image
+        image = cv2.imread(image_path)
+    else:
+        image_path = "memory"
 
     if image is None:
         print(f"Error: Could not read image from {image_path}")
-        return
-
-    # Set default color and thickness
-    color = (0, 0, 255)  # Red
-    thickness = 2
-
-    # Draw each bounding box
-    for box in boxes:
-        top_left = tuple(box[0])
-        bottom_right = tuple(box[1])
+        return None
 
-        # Draw the rectangle
-        cv2.rectangle(image, top_left, bottom_right, color, thickness)
+    # Draw the boxes, on a copy unless the image was just read.
+    image = annotate.draw_boxes(image, boxes, labels, copy=not from_path)
 
     # Save the resulting image
-    cv2.imwrite(output_path, image)
+    if output_path is not None:
+        annotate.write_image(output_path, image)
+    return image
 
 # Example Usage (for testing purposes, remove/comment when deploying):
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ from mimetypes import guess_type
 import base64
 import cv2
 import json
+import annotate
 
 # Function to describe the generated image and annotate issues
 def describe_image(image_path, complaint, annotated_image_path,
@@ -121,7 +122,9 @@ def draw_bounding_boxes(image_path, boxes, output_path):
     Parameters:
         image_path (str): Path to the input image.
         boxes (list of lists): List of bounding boxes, where each box is defined by two points
-                               [[x1, y1], [x2, y2]].
+                               [[x1, y1], [x2, y2]]. The model may return
+                               malformed boxes: they are skipped, and the
+                               others clamped to the image.
         output_path (str): Path to save the output image with bounding boxes.
     """
     # Load the image
@@ -131,20 +134,8 @@ def draw_bounding_boxes(image_path, boxes, output_path):
         print(f"Error: Could not read image from {image_path}")
         return
 
-    # Set default color and thickness
-    color = (0, 0, 255)  # Red
-    thickness = 2
-
-    # Draw each bounding box
-    for box in boxes:
-        top_left = tuple(box[0])
-        bottom_right = tuple(box[1])
-
-        # Draw the rectangle
-        cv2.rectangle(image, top_left, bottom_right, color, thickness)
-
-    # Save the resulting image
-    cv2.imwrite(output_path, image)
+    # Draw the bounding boxes and save the resulting image
+    annotate.write_image(output_path, annotate.draw_boxes(image, boxes, copy=False))
 
 # Example Usage (for testing purposes, remove/comment when deploying):
 if __name__ == "__main__":
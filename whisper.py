@@ -1,42 +1,323 @@
 # whisper.py
 
 import os
-from openai import AzureOpenAI
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from cache import hash_file
+import media
+import tracing
+import routing
+from replies import Transcription
 
 # Function to transcribe customer audio complaints using the Whisper model
 
 
-def transcribe_audio(audio_file_path, api_version, api_key, endpoint, deployment_name):
+def _cache_key(cache, audio_file_path, deployment_name, preprocess=None):
+    if cache is None or not os.path.exists(audio_file_path):
+        return None
+    # Preprocessing changes what Whisper hears, so it is part of the key.
+    extra = (preprocess,) if preprocess else ()
+    return cache.key("transcribe", hash_file(audio_file_path), deployment_name, *extra)
+
+
+def _load_audio(audio_file_path, preprocess=None):
+    # Returns the file name and bytes to upload, and the PreprocessedAudio
+    # when they were shrunk. A file that cannot be preprocessed, or holds
+    # nothing but silence, is uploaded as it is.
+    name = os.path.basename(audio_file_path)
+    if preprocess and os.path.exists(audio_file_path):
+        try:
+            audio = media.preprocess_speech(audio_file_path, codec=preprocess)
+        except RuntimeError as e:
+            print(f"Could not preprocess {audio_file_path}, uploading it as is: {e}")
+        else:
+            if audio.data and audio.seconds > 0:
+                print(audio.report(name))
+                return os.path.splitext(name)[0] + audio.extension, audio.data, audio
+    return name, _read_audio(audio_file_path), None
+
+
+def _audio_attributes(audio_bytes, audio):
+    attributes = {"audio_bytes": len(audio_bytes)}
+    if audio is not None:
+        attributes.update(source_bytes=audio.source_bytes, audio_seconds=audio.seconds,
+                          source_seconds=audio.source_seconds)
+    return attributes
+
+
+def transcribe_audio(audio_file_path, api_version, api_key, endpoint, deployment_name,
+                     cache=None, preprocess=None):
     """
     Transcribes an audio file into text using OpenAI's Whisper model.
 
+    Parameters:
+        cache (StageCache): Optional cache of transcriptions, keyed by the
+                            audio bytes and the deployment name.
+        preprocess (str): Codec of media.SPEECH_CODECS to shrink the audio
+                          to before uploading it, see
+                          media.preprocess_speech(), or None to upload the
+                          file as it is.
+
     Returns:
     str: The transcribed text of the audio file.
     """
+    cache_key = _cache_key(cache, audio_file_path, deployment_name, preprocess)
+    if cache_key is not None:
+        cached = cache.get_text(cache_key)
+        if cached is not None:
+            return cached
 
     # Configure OpenAI to use Azure
-    openaiclient = AzureOpenAI(
-        api_version=api_version,
-        api_key=api_key,
-        azure_endpoint=endpoint
-    )
-    
+    whisperpool = routing.get_pool("WHISPER", api_version, api_key, endpoint, deployment_name)
+
     try:
-        # Load the audio file.
-        with open(audio_file_path, "rb") as audio_file:
-            # Call the Whisper model to transcribe the audio file.
-            result = openaiclient.audio.transcriptions.create(
-                model=deployment_name,
-                file=audio_file
+        # Load the audio file, preprocessed when asked. It is held in memory
+        # so a retried request sends it again from the start.
+        file_name, audio_bytes, audio = _load_audio(audio_file_path, preprocess)
+        with tracing.span("whisper.transcribe", deployment=deployment_name,
+                          **_audio_attributes(audio_bytes, audio)) as span:
+            # Call the Whisper model to transcribe the audio file, within the
+            # deployment's quota and retrying on throttling.
+            result = routing.call(
+                whisperpool, "audio.transcriptions.create",
+                file=(file_name, audio_bytes)
             )
-            # Extract the transcription and return it.
-            return result.text
+            span.record_usage(result)
+        # Extract the transcription and return it.
+        text = Transcription.from_result(result).text
+        if cache_key is not None:
+            cache.put_text(cache_key, text)
+        return text
     except FileNotFoundError:
         raise FileNotFoundError(
             f"Audio file '{audio_file_path}' not found. Please check the path."
         )
+    except openai.APIError:
+        # Keep the status code and headers of failed calls visible to callers.
+        raise
+    except Exception as e:
+        raise RuntimeError(f"An error occurred during transcription: {e}") from e
+
+
+def _read_audio(audio_file_path):
+    with open(audio_file_path, "rb") as audio_file:
+        return audio_file.read()
+
+
+async def transcribe_audio_async(audio_file_path, api_version, api_key, endpoint, deployment_name,
+                                 cache=None, preprocess=None):
+    """
+    Async version of transcribe_audio() using the shared AsyncAzureOpenAI client.
+
+    Returns:
+    str: The transcribed text of the audio file.
+    """
+    cache_key = await asyncio.to_thread(_cache_key, cache, audio_file_path,
+                                        deployment_name, preprocess)
+    if cache_key is not None:
+        cached = cache.get_text(cache_key)
+        if cached is not None:
+            return cached
+    whisperpool = routing.get_pool("WHISPER", api_version, api_key, endpoint, deployment_name)
+
+    try:
+        # Load, and preprocess, the audio file without blocking the event loop.
+        file_name, audio_bytes, audio = await asyncio.to_thread(
+            _load_audio, audio_file_path, preprocess)
+        with tracing.span("whisper.transcribe", deployment=deployment_name,
+                          **_audio_attributes(audio_bytes, audio)) as span:
+            result = await routing.call_async(
+                whisperpool, "audio.transcriptions.create",
+                file=(file_name, audio_bytes)
+            )
+            span.record_usage(result)
+        text = Transcription.from_result(result).text
+        if cache_key is not None:
+            cache.put_text(cache_key, text)
+        return text
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"Audio file '{audio_file_path}' not found. Please check the path."
+        )
+    except openai.APIError:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"An error occurred during transcription: {e}") from e
+
+# Chunked transcription for long calls. The recording is cut into
+# overlapping chunks on silences, the chunks are transcribed in parallel and
+# the transcripts stitched back together. Only the chunks currently being
+# uploaded are held in memory, as small mono MP3s.
+
+WORD_RE = re.compile(r"[\w']+")
+
+
+def plan_chunks(duration, silences, chunk_seconds=300.0, overlap_seconds=2.0,
+                search_seconds=30.0):
+    """
+    Splits a recording into chunks ending on silences where possible.
+
+    Parameters:
+        duration (float): Length of the recording in seconds.
+        silences (list): (start, end) pairs from media.detect_silences().
+        chunk_seconds (float): Target chunk length.
+        overlap_seconds (float): Audio shared by neighbouring chunks, so no
+                                 word is lost at a cut.
+        search_seconds (float): How far before a target cut a silence is
+                                looked for, at most half a chunk.
+
+    Returns:
+    list: (start, duration) pairs in seconds, overlap included.
+    """
+    if chunk_seconds <= 0:
+        raise ValueError(f"chunk_seconds must be positive, got {chunk_seconds}.")
+    # Candidate cut points are the middles of the silences.
+    cut_points = [(start + (end if end is not None else duration)) / 2
+                  for start, end in silences]
+    # Every chunk is at least half its target length, so every cut moves
+    # forward, whatever chunk_seconds and search_seconds are.
+    search_seconds = min(search_seconds, chunk_seconds / 2)
+
+    cuts = [0.0]
+    while duration - cuts[-1] > chunk_seconds:
+        target = cuts[-1] + chunk_seconds
+        candidates = [point for point in cut_points
+                      if target - search_seconds <= point <= target]
+        cuts.append(max(candidates) if candidates else target)
+    cuts.append(duration)
+
+    chunks = []
+    for start, end in zip(cuts, cuts[1:]):
+        chunk_start = max(0.0, start - overlap_seconds)
+        chunk_end = min(duration, end + overlap_seconds)
+        chunks.append((chunk_start, chunk_end - chunk_start))
+    return chunks
+
+
+def _normalize(word):
+    return word.lower().strip("'")
+
+
+def stitch_transcripts(transcripts, max_overlap_words=40, min_overlap_words=3):
+    """
+    Joins chunk transcripts in order, dropping the words repeated at the start
+    of a chunk because its audio overlaps the previous one.
+
+    Parameters:
+        max_overlap_words (int): Most words looked at on each side of a cut.
+        min_overlap_words (int): Fewest repeated words dropped, so a chunk
+                                 merely starting with the word the previous
+                                 one ends with ("the", "I") keeps it.
+
+    Returns:
+    str: The stitched transcription.
+    """
+    text = ""
+    for transcript in transcripts:
+        transcript = transcript.strip()
+        if not text:
+            text = transcript
+            continue
+        if not transcript:
+            continue
+
+        tail = [_normalize(w) for w in WORD_RE.findall(text)[-max_overlap_words:]]
+        head_matches = list(WORD_RE.finditer(transcript))[:max_overlap_words]
+        head = [_normalize(m.group()) for m in head_matches]
+
+        # Longest run of words ending the text that also starts the chunk.
+        overlap = 0
+        for size in range(min(len(tail), len(head)), max(min_overlap_words, 1) - 1, -1):
+            if tail[-size:] == head[:size]:
+                overlap = size
+                break
+
+        if overlap:
+            transcript = transcript[head_matches[overlap - 1].end():].lstrip()
+            # Keep the punctuation that followed the repeated words, unless
+            # the text already ends with some.
+            punctuation = len(transcript) - len(transcript.lstrip(",.;:!?"))
+            if punctuation:
+                if text[-1] not in ",.;:!?":
+                    text += transcript[:punctuation]
+                transcript = transcript[punctuation:].lstrip()
+        text = f"{text} {transcript}".strip()
+    return text
+
+
+def transcribe_audio_chunked(audio_file_path, api_version, api_key, endpoint,
+                             deployment_name, chunk_seconds=300.0,
+                             overlap_seconds=2.0, max_workers=4, cache=None,
+                             preprocess=None):
+    """
+    Transcribes a long recording as overlapping chunks cut on silences,
+    transcribed in parallel and stitched back in order.
+
+    Recordings shorter than chunk_seconds are sent whole with
+    transcribe_audio(), preprocessed as asked. Chunks are already mono MP3s
+    at 16 kHz and are not preprocessed further.
+
+    Parameters:
+        chunk_seconds (float): Target chunk length, which also keeps every
+                               upload well under the Whisper size limit.
+        overlap_seconds (float): Audio shared by neighbouring chunks.
+        max_workers (int): Number of chunks transcribed at once.
+        cache (StageCache): Optional cache of transcriptions.
+
+    Returns:
+    str: The transcribed text of the audio file.
+    """
+    if not os.path.exists(audio_file_path):
+        raise FileNotFoundError(
+            f"Audio file '{audio_file_path}' not found. Please check the path."
+        )
+
+    duration = media.probe_duration(audio_file_path)
+    if duration <= chunk_seconds:
+        return transcribe_audio(audio_file_path, api_version, api_key, endpoint,
+                                deployment_name, cache=cache, preprocess=preprocess)
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key("transcribe_chunked", hash_file(audio_file_path),
+                              chunk_seconds, overlap_seconds, deployment_name)
+        cached = cache.get_text(cache_key)
+        if cached is not None:
+            return cached
+
+    chunks = plan_chunks(duration, media.detect_silences(audio_file_path),
+                         chunk_seconds, overlap_seconds)
+    whisperpool = routing.get_pool("WHISPER", api_version, api_key, endpoint, deployment_name)
+
+    def transcribe_chunk(index_and_chunk):
+        index, (start, length) = index_and_chunk
+        audio_bytes = media.extract_audio_segment(audio_file_path, start, length)
+        with tracing.span("whisper.transcribe_chunk", deployment=deployment_name,
+                          chunk=index, audio_bytes=len(audio_bytes)) as span:
+            result = routing.call(
+                whisperpool, "audio.transcriptions.create",
+                file=(f"chunk_{index:04d}.mp3", audio_bytes)
+            )
+            span.record_usage(result)
+        return Transcription.from_result(result).text
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # Chunks keep the caller's span and complaint id.
+            transcripts = list(pool.map(tracing.run_in_context(transcribe_chunk),
+                                        enumerate(chunks)))
+    except openai.APIError:
+        raise
     except Exception as e:
-        raise RuntimeError(f"An error occurred during transcription: {e}")
+        raise RuntimeError(f"An error occurred during transcription: {e}") from e
+
+    transcription = stitch_transcripts(transcripts)
+    if cache_key is not None:
+        cache.put_text(cache_key, transcription)
+    return transcription
+
 
 # Example Usage (for testing purposes, remove/comment when deploying):
 if __name__ == "__main__":
@@ -0,0 +1,283 @@
+# workqueue.py
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+# Durable queue of complaints, kept in a SQLite database.
+#
+# Every complaint is one row holding its job dict (the artifacts of the
+# stages done so far, such as the transcription, the image path, the
+# description and the classification), the index of its next stage, and a
+# lease. A worker leases a complaint, runs its next stages and checkpoints
+# the row after each of them, renewing the lease. A worker that dies leaves
+# its lease to expire, after which another worker leases the complaint
+# again and resumes at the stage after the last checkpoint.
+#
+# Any number of worker processes can share the database, on one machine or
+# on machines sharing a file system with working locks. Transactions that
+# pick a complaint take the database's write lock, so a complaint is only
+# ever leased to one worker at a time.
+
+# States a complaint is in after each stage, see main.pipeline_stages().
+STAGE_STATES = {
+    "transcribe": "transcribed",
+    "generate_image": "image_generated",
+    "describe": "described",
+    "classify": "classified",
+    "describe_classify": "classified",
+}
+
+QUEUED = "queued"
+# The classification is being appended to the store.
+STORING = "storing"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS complaints (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    next_stage INTEGER NOT NULL DEFAULT 0,
+    job TEXT NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS complaints_pending ON complaints (state, lease_expires);
+"""
+
+
+class LeaseLost(RuntimeError):
+    """
+    Raised when a worker checkpoints a complaint whose lease expired and was
+    taken over by another worker.
+    """
+
+
+class Lease:
+    """
+    A complaint leased to a worker.
+
+    Parameters:
+        complaint_id (str): The complaint.
+        state (str): Its state when it was leased.
+        next_stage (int): Index of the first stage still to run.
+        job (dict): Its job dict, as last checkpointed.
+        attempts (int): Number of times it was leased, this time included.
+    """
+
+    __slots__ = ("complaint_id", "state", "next_stage", "job", "attempts")
+
+    def __init__(self, complaint_id, state, next_stage, job, attempts):
+        self.complaint_id = complaint_id
+        self.state = state
+        self.next_stage = next_stage
+        self.job = job
+        self.attempts = attempts
+
+
+class WorkQueue:
+    """
+    SQLite-backed queue of complaints with leases and checkpoints.
+
+    Connections are opened per call, so one WorkQueue can be shared by the
+    threads of a worker.
+
+    Parameters:
+        path (str): Path to the database, created when missing.
+        timeout (float): Seconds to wait for another process's write lock.
+    """
+
+    def __init__(self, path="output/queue.sqlite", timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        # isolation_level=None leaves transactions to the explicit BEGINs.
+        connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                     isolation_level=None)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return _Closing(connection)
+
+    def enqueue(self, job):
+        """
+        Adds a complaint, unless one with the same id is already queued.
+
+        Parameters:
+            job (dict): The complaint's job dict, JSON-serializable.
+
+        Returns:
+        bool: Whether the complaint was added.
+
+        Raises:
+        ValueError: When the complaint already queued under that id is
+                    another audio file, which would otherwise never be
+                    processed.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO complaints (id, state, job, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (job["id"], QUEUED, json.dumps(job), time.time()))
+            if cursor.rowcount == 1:
+                return True
+            (saved,) = connection.execute(
+                "SELECT job FROM complaints WHERE id = ?", (job["id"],)).fetchone()
+        queued_path = json.loads(saved).get("audio_path")
+        if _same_path(queued_path, job.get("audio_path")):
+            return False
+        raise ValueError(f"Complaint '{job['id']}' is already queued for {queued_path}, "
+                         f"not {job.get('audio_path')}. Rename one of them.")
+
+    def lease(self, owner, lease_seconds):
+        """
+        Leases the complaint waiting the longest, including complaints whose
+        previous lease expired.
+
+        Returns:
+        Lease: The leased complaint, or None when none is available.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT id, state, next_stage, job, attempts FROM complaints "
+                    "WHERE state NOT IN (?, ?) "
+                    "AND (lease_expires IS NULL OR lease_expires < ?) "
+                    "ORDER BY updated_at LIMIT 1",
+                    (DONE, FAILED, now)).fetchone()
+                if row is None:
+                    connection.execute("COMMIT")
+                    return None
+                complaint_id, state, next_stage, job, attempts = row
+                connection.execute(
+                    "UPDATE complaints SET lease_owner = ?, lease_expires = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    (owner, now + lease_seconds, complaint_id))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return Lease(complaint_id, state, next_stage, json.loads(job), attempts + 1)
+
+    def _update_leased(self, complaint_id, owner, assignments, values):
+        with self._connect() as connection:
+            cursor = connection.execute(
+                f"UPDATE complaints SET {assignments}, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ?",
+                (*values, time.time(), complaint_id, owner))
+            if cursor.rowcount != 1:
+                raise LeaseLost(f"The lease of complaint {complaint_id} was lost.")
+
+    def checkpoint(self, complaint_id, owner, next_stage, state, job, lease_seconds):
+        """
+        Records a finished stage and renews the lease.
+
+        Raises:
+        LeaseLost: When the lease now belongs to another worker.
+        """
+        self._update_leased(
+            complaint_id, owner,
+            "next_stage = ?, state = ?, job = ?, lease_expires = ?, error = NULL",
+            (next_stage, state, json.dumps(job), time.time() + lease_seconds))
+
+    def complete(self, complaint_id, owner):
+        """
+        Marks a complaint done and releases its lease.
+        """
+        self._update_leased(complaint_id, owner,
+                            "state = ?, lease_owner = NULL, lease_expires = NULL",
+                            (DONE,))
+
+    def release(self, complaint_id, owner, error, give_up=False):
+        """
+        Releases the lease of a complaint whose stage failed, so it is
+        retried, or marks it failed when give_up is set.
+        """
+        assignments = "error = ?, lease_owner = NULL, lease_expires = NULL"
+        values = (error,)
+        if give_up:
+            assignments += ", state = ?"
+            values += (FAILED,)
+        self._update_leased(complaint_id, owner, assignments, values)
+
+    def retry_failed(self):
+        """
+        Queues the failed complaints again, from the stage that failed.
+
+        Returns:
+        int: The number of complaints queued again.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE complaints SET state = ?, attempts = 0, updated_at = ? "
+                "WHERE state = ?", (QUEUED, time.time(), FAILED))
+            return cursor.rowcount
+
+    def counts(self):
+        """
+        Returns:
+        dict: Number of complaints in every state.
+        """
+        with self._connect() as connection:
+            return dict(connection.execute(
+                "SELECT state, COUNT(*) FROM complaints GROUP BY state").fetchall())
+
+    def failures(self):
+        """
+        Returns:
+        list: (complaint id, error) of the failed complaints.
+        """
+        with self._connect() as connection:
+            return connection.execute(
+                "SELECT id, error FROM complaints WHERE state = ? ORDER BY id",
+                (FAILED,)).fetchall()
+
+
+def _same_path(a, b):
+    if a is None or b is None:
+        return a == b
+    return os.path.normpath(a) == os.path.normpath(b)
+
+
+class _Closing:
+    # Closes the connection when the block ends; sqlite3's own context
+    # manager only ends the transaction.
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, *exc):
+        self.connection.close()
+
+
+# Example Usage (for testing purposes, remove/comment when deploying):
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show or reset a complaint queue.")
+    parser.add_argument("queue", nargs="?", default="output/queue.sqlite")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="queue the failed complaints again")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue)
+    if args.retry_failed:
+        print(f"Queued {queue.retry_failed()} failed complaint(s) again.")
+    for state, count in sorted(queue.counts().items()):
+        print(f"{state:<16}{count:>8}")
+    for complaint_id, error in queue.failures():
+        print(f"  {complaint_id}: {error}")